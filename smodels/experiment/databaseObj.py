@@ -22,6 +22,7 @@ import time
 from smodels.experiment import datasetObj
 from smodels.installation import cacheDirectory
 from smodels.experiment.metaObj import Meta
+from smodels.experiment import mmapDatabase
 from smodels.experiment.expResultObj import ExpResult
 from smodels.experiment.exceptions import DatabaseNotFoundException
 from smodels.tools.physicsUnits import TeV
@@ -42,9 +43,10 @@ class Database(object):
     """
 
     def __init__(self, base=None, force_load = None, discard_zeroes = True,
-                  progressbar = False, subpickle = True):
+                  progressbar = False, subpickle = True, lazyLoading = False):
         """
-        :param base: path to the database, or pickle file (string), or http
+        :param base: path to the database, or pickle file (string), or
+                     memory-mappable binary file (.smdb, see createBinaryFile), or http
                      address. If None, "official", or "official_fastlim",
                      use the official database for your code version
                      (including fastlim results, if specified).
@@ -56,14 +58,24 @@ class Database(object):
                             (needs the python-progressbar module)
         :param subpickle: produce small pickle files per exp result.
                           Should only be used when working on the database.
+        :param lazyLoading: when parsing the text database, only build the data
+                            grids and triangulations of the txnames when first
+                            used (e.g. by getValueFor), so results which are
+                            not selected are never fully built. Txnames with
+                            only zeroes are then discarded by getExpResults.
+                            No small pickle files are written in this case.
+                            The text database is always parsed, no binary
+                            file is read or written; lazyLoading is ignored
+                            if a binary database is requested.
         """
 
         self.url = base
         self.source=""
-        if force_load == None and base.endswith(".pcl"):
+        if force_load == None and base.endswith((".pcl",".smdb")):
             force_load = "pcl"
         self.force_load = force_load
         self.subpickle = subpickle
+        self.lazyLoading = lazyLoading
         obase = base ## keep old name for more checks for 'latest'
         if base in [ None, "official" ]:
             from smodels.installation import officialDatabase
@@ -81,6 +93,15 @@ class Database(object):
             from smodels.installation import testDatabase
             base = testDatabase()
         base, pclfile = self.checkPathName(base, discard_zeroes )
+        if self.lazyLoading:
+            if self.force_load == "pcl" or self.source != "txt":
+                logger.warning( "lazy loading only works with the text database, "
+                                "but a binary database is loaded. Ignoring lazyLoading." )
+                self.lazyLoading = False
+            else:
+                ## pickling would build all data grids, so we parse the
+                ## text database and do not write a binary file
+                self.force_load = "txt"
         self.pcl_meta = Meta( pclfile )
         self.expResultList = []
         self.txt_meta = self.pcl_meta
@@ -167,18 +188,37 @@ class Database(object):
             return
         if type(self.databaseParticles) == type(None):
             return
-        for ctr,er in enumerate(self.expResultList):
-            if not hasattr ( er.globalInfo, "_databaseParticles" ):
-                er.globalInfo._databaseParticles = self.databaseParticles
-            elif type(er.globalInfo._databaseParticles) == type(None):
-                er.globalInfo._databaseParticles = self.databaseParticles
+        for globalInfo in self._getGlobalInfos():
+            if not hasattr ( globalInfo, "_databaseParticles" ):
+                globalInfo._databaseParticles = self.databaseParticles
+            elif type(globalInfo._databaseParticles) == type(None):
+                globalInfo._databaseParticles = self.databaseParticles
+
+    def _getGlobalInfos( self ):
+        """ the globalInfo objects of all results, without loading
+            the results (if loaded lazily from a .smdb file) """
+        if isinstance ( self.expResultList, mmapDatabase.MmapExpResultList ):
+            return self.expResultList.globalInfos
+        return [ er.globalInfo for er in self.expResultList ]
+
+    def _getCounts( self ):
+        """ the globalInfo, the number of datasets and the number of txnames
+            of all results, without loading the results (if loaded lazily
+            from a .smdb file) """
+        if isinstance ( self.expResultList, mmapDatabase.MmapExpResultList ) and \
+                self.expResultList.counts != None:
+            return [ ( gi, nds, ntx ) for gi,(nds,ntx) in \
+                     zip ( self.expResultList.globalInfos, self.expResultList.counts ) ]
+        return [ ( er.globalInfo, len(er.datasets),
+                   sum ( [ len(ds.txnameList) for ds in er.datasets ] ) ) \
+                 for er in self.expResultList ]
 
     def removeLinksToModel ( self ):
         """ remove the links of globalInfo._databaseParticles to the model.
             Currently not used. """
-        for ctr,er in enumerate(self.expResultList):
-            if hasattr ( er.globalInfo, "_databaseParticles" ):
-                del er.globalInfo._databaseParticles
+        for globalInfo in self._getGlobalInfos():
+            if hasattr ( globalInfo, "_databaseParticles" ):
+                del globalInfo._databaseParticles
 
     def loadBinaryFile( self, lastm_only = False ):
         """
@@ -195,6 +235,9 @@ class Database(object):
         if not os.path.exists( self.pcl_meta.pathname ):
             return None
 
+        if mmapDatabase.isMmapDatabase( self.pcl_meta.pathname ):
+            return self.loadMmapFile( lastm_only )
+
         try:
             with open( self.pcl_meta.pathname, "rb" ) as f:
                 t0=time.time()
@@ -239,6 +282,36 @@ class Database(object):
         # self.txt_meta = self.pcl_meta
         return self
 
+    def loadMmapFile( self, lastm_only = False ):
+        """
+        Load a memory-mappable binary database (see createBinaryFile).
+        Only the index (meta information, globalInfo objects) is read;
+        the experimental results are loaded when accessed.
+
+        :param lastm_only: if true, only the meta information is read.
+        :returns: database object
+        """
+        t0=time.time()
+        pclfilename = self.pcl_meta.pathname
+        expResultList = mmapDatabase.MmapExpResultList( pclfilename )
+        self.pcl_meta = expResultList.meta
+        self.pcl_meta.pathname = pclfilename
+        if self.force_load == "pcl":
+            self.txt_meta = self.pcl_meta
+        if lastm_only:
+            return self
+        if not self.force_load == "pcl" and self.pcl_meta.needsUpdate( self.txt_meta ):
+            logger.warning( "Something changed in the environment."
+                             "Regenerating." )
+            self.createBinaryFile( pclfilename )
+            return self
+        self.expResultList = expResultList
+        self.databaseParticles = expResultList.databaseParticles
+        logger.info( "Loaded index of %d results from %s in %.1f secs." % \
+                ( len(expResultList), pclfilename, time.time()-t0 ) )
+        self.createLinksToModel()
+        return self
+
     def checkBinaryFile( self ):
         nu=self.needsUpdate()
         logger.debug( "Checking binary db file." )
@@ -264,7 +337,11 @@ class Database(object):
 
     def createBinaryFile(self, filename=None):
         """ create a pcl file from the text database,
-            potentially overwriting an old pcl file. """
+            potentially overwriting an old pcl file.
+            If filename ends with .smdb, the memory-mappable format is
+            written instead: a small index plus one block per result, with the
+            numerical arrays stored separately, so results can be loaded
+            individually and the arrays are mapped from the file. """
         ## make sure we have a model to pickle with the database!
         if self.txt_meta == None:
             logger.error("Trying to create database pickle, but no txt_meta defined." )
@@ -278,6 +355,15 @@ class Database(object):
             type(self.databaseParticles) == type(None):
            self._setParticles(self._getParticles())
         logger.debug(  " * create %s" % binfile )
+        if binfile.endswith ( ".smdb" ):
+            self.loadTextDatabase()
+            logger.debug(  " * write %s db version %s, memory-mappable format" % \
+                    ( binfile, self.txt_meta.databaseVersion ) )
+            ptcl = min ( 4, serializer.HIGHEST_PROTOCOL )
+            mmapDatabase.writeMmapDatabase( binfile, self.txt_meta,
+                    list(self.expResultList), self.databaseParticles, protocol=ptcl )
+            logger.info(  "%s created." % ( binfile ) )
+            return
         with open( binfile, "wb" ) as f:
             logger.debug(  " * load text database" )
             self.loadTextDatabase()
@@ -483,19 +569,18 @@ class Database(object):
         datasets = 0
         txnames = 0
         s = { 8:0, 13:0  }
-        for expRes in self.expResultList:
-            Id = expRes.globalInfo.getInfo('id')
-            sqrts = expRes.globalInfo.getInfo('sqrts').asNumber( TeV )
+        for globalInfo,ndatasets,ntxnames in self._getCounts():
+            Id = globalInfo.getInfo('id')
+            sqrts = globalInfo.getInfo('sqrts').asNumber( TeV )
             if not sqrts in s.keys():
                 s[sqrts] = 0
             s[sqrts]+=1
-            datasets += len( expRes.datasets )
-            for ds in expRes.datasets:
-                txnames += len( ds.txnameList )
+            datasets += ndatasets
+            txnames += ntxnames
             if "ATLAS" in Id:
-                atlas.append( expRes )
+                atlas.append( Id )
             if "CMS" in Id:
-                cms.append( expRes )
+                cms.append( Id )
         idList += "%d CMS, %d ATLAS, " % ( len(cms), len(atlas) )
         for sqrts in s.keys():
             idList += "%d @ %d TeV, " % ( s[sqrts], sqrts )
@@ -626,8 +711,11 @@ class Database(object):
             logger.error( "exception %s" % e )
         if not expres: ## create from text file
             expres = ExpResult(root, discard_zeroes = self.txt_meta.discard_zeroes,
-                databaseParticles = self.databaseParticles)
-            if self.subpickle and expres: expres.writePickle( self.databaseVersion )
+                databaseParticles = self.databaseParticles,
+                lazyLoading = self.lazyLoading)
+            ## writing the pickle file would build all data grids
+            if self.subpickle and expres and not self.lazyLoading:
+                expres.writePickle( self.databaseVersion )
         if expres:
             contact = expres.globalInfo.getInfo("contact")
             if contact and "fastlim" in contact.lower():
@@ -676,15 +764,17 @@ class Database(object):
 
         import fnmatch
         expResultList = []
-        for expResult in self.expResultList:
+        ## select by the globalInfo objects first, so results
+        ## stored in .smdb files are only loaded if selected
+        for iexp,globalInfo in enumerate(self._getGlobalInfos()):
             superseded = None
-            if hasattr(expResult.globalInfo,'supersededBy'):
-                superseded = expResult.globalInfo.supersededBy.replace(" ","")
+            if hasattr(globalInfo,'supersededBy'):
+                superseded = globalInfo.supersededBy.replace(" ","")
             if superseded and (not useSuperseded):
                 continue
 
-            analysisID = expResult.globalInfo.getInfo('id')
-            sqrts = expResult.globalInfo.getInfo('sqrts')
+            analysisID = globalInfo.getInfo('id')
+            sqrts = globalInfo.getInfo('sqrts')
 
             # Skip analysis not containing any of the required ids:
             if analysisIDs != ['all']:
@@ -711,6 +801,17 @@ class Database(object):
                 if not hits:
                     continue
 
+            if txnames != ['all'] and \
+                    isinstance(self.expResultList, mmapDatabase.MmapExpResultList):
+                hits=False
+                for txName in self.expResultList.txnames[iexp]:
+                    if any([fnmatch.fnmatch(txName,pattern) for pattern in txnames]):
+                        hits = True
+                        break
+                if not hits:
+                    continue
+
+            expResult = self.expResultList[iexp]
             newExpResult = ExpResult()
             newExpResult.path = expResult.path
             newExpResult.globalInfo = expResult.globalInfo
@@ -768,6 +869,9 @@ class Database(object):
                     if onlyWithExpected and dataset.dataInfo.dataType == \
                         "upperLimit" and not txname.txnameDataExp:
                         continue
+                    if self.lazyLoading and self.txt_meta.discard_zeroes and \
+                            txname.hasOnlyZeroes():
+                        continue
                     newDataSet.txnameList.append(txname)
                 # Skip data set not containing any of the required txnames:
                 if not newDataSet.txnameList or newDataSet.txnameList == []:
@@ -11,7 +11,9 @@
 import os,glob,json
 from smodels.experiment import txnameObj,infoObj
 from smodels.tools.physicsUnits import fb
-from smodels.tools.simplifiedLikelihoods import LikelihoodComputer, Data, UpperLimitComputer
+from smodels.tools.simplifiedLikelihoods import LikelihoodComputer, Data, UpperLimitComputer, \
+     StatisticalModel
+from smodels.tools import ulCache
 from smodels.experiment.exceptions import SModelSExperimentError as SModelSError
 from smodels.theory.auxiliaryFunctions import getAttributesFrom,getValuesForObj
 from smodels.tools.smodelsLogging import logger
@@ -19,6 +21,7 @@ from smodels.theory.auxiliaryFunctions import elementsInStr
 from smodels.theory.element import Element
 
 import itertools
+import numpy as np
 
 # if on, will check for overlapping constraints
 _complainAboutOverlappingConstraints = True
@@ -29,9 +32,11 @@ class DataSet(object):
     """
 
     def __init__(self, path=None, info=None, createInfo=True,
-                    discard_zeroes=True, databaseParticles = None):
+                    discard_zeroes=True, databaseParticles = None,
+                    lazyLoading = False):
         """
         :param discard_zeroes: discard txnames with zero-only results
+        :param lazyLoading: only build the data grids of the txnames when first used
         """
 
         self.path = path
@@ -51,8 +56,11 @@ class DataSet(object):
             for txtfile in glob.iglob(os.path.join(path,"*.txt")):
                 try:
                     txname = txnameObj.TxName(txtfile,self.globalInfo,
-                                            self.dataInfo, databaseParticles)
-                    if discard_zeroes and txname.hasOnlyZeroes():
+                                            self.dataInfo, databaseParticles,
+                                            lazyLoading = lazyLoading)
+                    ## with lazy loading, zero-only txnames are
+                    ## discarded when selected (see Database.getExpResults)
+                    if discard_zeroes and not lazyLoading and txname.hasOnlyZeroes():
                         logger.debug ( "%s, %s has only zeroes. discard it." % \
                                          ( self.path, txname.txName ) )
                         continue
@@ -204,6 +212,40 @@ class DataSet(object):
 
         return ret
 
+    def likelihoods(self, nsigs, deltas_rel=0.2, marginalize=False, expected=False ):
+        """
+        Computes the likelihoods for several signal hypotheses at once
+        (see likelihood).
+        :param nsigs: array of predicted signals
+        :param deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+        :param marginalize: if true, marginalize nuisances. Else, profile them.
+        :param expected: Compute expected instead of observed likelihoods
+        :returns: array of likelihoods
+        """
+        obs = self.dataInfo.observedN
+        if expected:
+            obs = self.dataInfo.expectedBG
+
+        m = Data( obs, self.dataInfo.expectedBG, self.dataInfo.bgError**2,
+                       deltas_rel=deltas_rel )
+        computer = LikelihoodComputer(m)
+        return computer.likelihoods(nsigs, marginalize=marginalize)
+
+    def chi2s(self, nsigs, deltas_rel=0.2, marginalize=False):
+        """
+        Computes the chi2 values for several signal hypotheses at once
+        (see chi2).
+        :param nsigs: array of predicted signals
+        :param deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+        :param marginalize: if true, marginalize nuisances. Else, profile them.
+        :return: array of chi2 values
+        """
+
+        m = Data(self.dataInfo.observedN, self.dataInfo.expectedBG,
+                    self.dataInfo.bgError**2,deltas_rel=deltas_rel)
+        computer = LikelihoodComputer(m)
+        return computer.chi2s(nsigs, marginalize=marginalize)
+
 
     def folderName(self):
         """
@@ -300,6 +342,69 @@ class DataSet(object):
             return None
 
 
+    def getUpperLimitsFor(self,elements,expected = False, txnames = None
+                         ,compute=False,alpha=0.05,deltas_rel=0.2):
+        """
+        Batch version of getUpperLimitFor. Returns the upper limits for a list
+        of elements (or masses) and a single txname. For UL results all
+        the elements are interpolated in a single call.
+        For EM results the upper limit is the same for all elements.
+
+        :param elements: list of Element objects or mass arrays with units
+        :param txnames: TxName object or txname string (only for UL-type results)
+        :param alpha: Can be used to change the C.L. value. The default value is 0.05
+                      (= 95% C.L.) (only for  efficiency-map results)
+        :param deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+        :param expected: Compute expected limit, i.e. Nobserved = NexpectedBG
+                         (only for efficiency-map results)
+        :param compute: If True, the upper limit will be computed
+                        from expected and observed number of events.
+                        If False, the value listed in the database will be used
+                        instead.
+        :return: list of upper limits (Unum objects)
+        """
+
+        if self.getType() == 'efficiencyMap':
+            upperLimit = self.getUpperLimitFor(expected=expected,alpha=alpha,compute=compute,
+                                               deltas_rel=deltas_rel)
+            return [upperLimit]*len(elements)
+
+        elif self.getType() == 'upperLimit':
+            if not txnames:
+                logger.error("A TxName must be defined when \
+                             computing ULs for upper-limit results.")
+                return False
+            elif isinstance(txnames,list):
+                if len(txnames) != 1:
+                    logger.error("txnames must be a TxName object, a string or a list with a single Txname object")
+                    return False
+                else:
+                    txname = txnames[0]
+            else:
+                txname = txnames
+
+            if not isinstance(txname, txnameObj.TxName) and \
+            not isinstance(txname, str):
+                logger.error("txname must be a TxName object or a string")
+                return False
+
+            for element in elements:
+                if not isinstance(element, list) and not isinstance(element,Element):
+                    logger.error("Element must be an element object or a mass array")
+                    return False
+
+            upperLimits = [None]*len(elements)
+            for tx in self.txnameList:
+                if tx == txname or tx.txName == txname:
+                    upperLimits = tx.getULsFor(elements,expected)
+
+            return upperLimits
+
+        else:
+            logger.warning("Unkown data type: %s. Data will be ignored.",
+                           self.getType())
+            return None
+
     def getSRUpperLimit(self,alpha = 0.05, expected = False, compute = False, deltas_rel=0.2):
         """
         Computes the 95% upper limit on the signal*efficiency for a given dataset (signal region).
@@ -362,11 +467,23 @@ class CombinedDataSet(object):
         self._marginalize = False
         self.sortDataSets()
         self.bestCB = None# To store the index of the best combination
+        self._pyhfData = {} # To store the pyhf workspaces and models for each signal
+        self._statModels = {} # To store the simplified likelihood models for each signal
 
     def __str__(self):
         ret = "Combined Dataset (%i datasets)" %len(self._datasets)
         return ret
 
+    def __getstate__(self):
+        """
+        The pyhf workspaces and models and the simplified likelihood
+        models are not pickled.
+        """
+        state = self.__dict__.copy()
+        state["_pyhfData"] = {}
+        state["_statModels"] = {}
+        return state
+
 
 
     def sortDataSets(self):
@@ -459,11 +576,75 @@ class CombinedDataSet(object):
             nsignals.append(subSig)
         # Loading the jsonFiles, unless we already have them (because we pickled)
         from smodels.tools.pyhfInterface import PyhfData, PyhfUpperLimitComputer
-        data = PyhfData(nsignals, jsons )
-        if data.errorFlag: return None
+        # The patched workspaces and pyhf models are kept for each signal
+        if not hasattr(self, "_pyhfData"):
+            self._pyhfData = {}
+        key = hash(tuple(tuple(subSig) for subSig in nsignals))
+        data = self._pyhfData.get(key)
+        if data is None:
+            data = PyhfData(nsignals, jsons )
+            if data.errorFlag: return None
+            if len(self._pyhfData) >= 10:
+                self._pyhfData.pop(next(iter(self._pyhfData)))
+            self._pyhfData[key] = data
         ulcomputer = PyhfUpperLimitComputer(data)
         return ulcomputer,combinations
 
+    def getStatisticalModel(self, nsig, deltas_rel=0.2):
+        """
+        Get the simplified likelihood model for the signal nsig (for a
+        covariance matrix). The model is kept for the last few signals, so the
+        observed and expected upper limits, the likelihood and the chi2
+        of a signal share the covariance algebra and the nuisance fits.
+
+        :param nsig: list of signal events in each signal region/dataset
+        :param deltas_rel: relative uncertainty in signal (float)
+
+        :return: StatisticalModel object
+        """
+
+        if not hasattr(self, "_statModels"):
+            self._statModels = {}
+        key = (tuple(float(s) for s in nsig), deltas_rel)
+        model = self._statModels.get(key)
+        if model is None:
+            nobs = [x.dataInfo.observedN for x in self._datasets]
+            bg = [x.dataInfo.expectedBG for x in self._datasets]
+            cov = self.globalInfo.covariance
+            model = StatisticalModel(Data(observed=nobs, backgrounds=bg, covariance=cov,
+                                          third_moment=None, nsignal=list(nsig),
+                                          deltas_rel=deltas_rel), ntoys=10000)
+            if len(self._statModels) >= 10:
+                self._statModels.pop(next(iter(self._statModels)))
+            self._statModels[key] = model
+        return model
+
+    def findBestCombination(self, ulcomputer, combinations):
+        """
+        Find the json combination with the best (lowest) expected upper
+        limit and keep it in self.bestCB. The expected limits of the
+        workspaces are independent fits, which are run in parallel if
+        runtime._ncpusPyhf > 1 (see PyhfUpperLimitComputer.ulSigmas).
+
+        :param ulcomputer: PyhfUpperLimitComputer object
+        :param combinations: list with the names of the json combinations
+
+        :return: expected upper limit of the best combination
+        """
+
+        logger.debug("Performing best expected combination")
+        uls = ulcomputer.ulSigmas(expected=True)
+        ulMin = float('+inf')
+        for i_ws,ul in enumerate(uls):
+            if ul == None:
+                continue
+            if ul < ulMin:
+                ulMin = ul
+                i_best = i_ws
+        self.bestCB = combinations[i_best] # Keeping the index of the best combination for later
+        logger.debug('Best combination : %s' % self.bestCB)
+        return ulMin
+
     def getCombinedUpperLimitFor(self, nsig, expected=False, deltas_rel=0.2):
         """
         Get combined upper limit. If covariances are given in globalInfo then simplified likelihood is used, else if json files are given pyhf cimbination is performed.
@@ -476,6 +657,39 @@ class CombinedDataSet(object):
         :returns: upper limit on sigma*eff
         """
 
+        cache = ulCache.getCache()
+        if cache is None:
+            return self._computeCombinedUpperLimitFor(nsig, expected, deltas_rel)
+        datasetIDs = [ds.getID() for ds in self._datasets]
+        pyhf = None
+        if not hasattr(self.globalInfo, "covariance") and \
+                hasattr(self.globalInfo, "jsonFiles"):
+            from smodels.tools.pyhfInterface import pyhfinfo
+            pyhf = (".".join(pyhfinfo["ver"]), pyhfinfo["backend"],
+                    pyhfinfo["backendver"])
+        key = cache.key(self.globalInfo.id, datasetIDs, expected, nsig,
+                        deltas_rel=deltas_rel, marginalize=self._marginalize,
+                        pyhf=pyhf)
+        cached = cache.get(key)
+        if cached is not None:
+            ret, bestCB = cached
+            if self.bestCB == None and bestCB != None:
+                self.bestCB = bestCB
+            if ret is not None:
+                ret = ret*fb
+            return ret
+        ret = self._computeCombinedUpperLimitFor(nsig, expected, deltas_rel)
+        value = ret
+        if value is not None:
+            value = value.asNumber(fb)
+        cache.set(key, value, self.bestCB)
+        return ret
+
+    def _computeCombinedUpperLimitFor(self, nsig, expected=False, deltas_rel=0.2):
+        """
+        Compute the combined upper limit (see getCombinedUpperLimitFor).
+        """
+
         if hasattr(self.globalInfo, "covariance" ):
             cov = self.globalInfo.covariance
             if type(cov) != list:
@@ -483,16 +697,8 @@ class CombinedDataSet(object):
             if len(cov) < 1:
                 raise SModelSError( "covariance matrix has length %d." % len(cov))
 
-            computer = UpperLimitComputer(ntoys=10000)
-
-            nobs = [x.dataInfo.observedN for x in self._datasets]
-            bg = [x.dataInfo.expectedBG for x in self._datasets]
-            no = nobs
-
-            ret = computer.ulSigma(Data(observed=no, backgrounds=bg, covariance=cov,
-                                        third_moment=None, nsignal=nsig, deltas_rel=deltas_rel),
-                                        marginalize=self._marginalize,
-                                        expected=expected)
+            model = self.getStatisticalModel(nsig, deltas_rel)
+            ret = model.upperLimit(marginalize=self._marginalize, expected=expected)
 
             if ret != None:
                 #Convert limit on total number of signal events to a limit on sigma*eff
@@ -513,23 +719,14 @@ class CombinedDataSet(object):
             else:
                 # Looking for the best combination
                 logger.debug('self.bestCB : {}'.format(self.bestCB))
+                ulMin = None
                 if self.bestCB == None:
-                    logger.debug("Performing best expected combination")
-                    ulMin = float('+inf')
-                    for i_ws in range(ulcomputer.nWS):
-                        ul = ulcomputer.ulSigma(expected=True, workspace_index=i_ws)
-                        if ul == None:
-                            continue
-                        if ul < ulMin:
-                            ulMin = ul
-                            i_best = i_ws
-                    self.bestCB = combinations[i_best] # Keeping the index of the best combination for later
-                    logger.debug('Best combination : %s' % self.bestCB)
+                    ulMin = self.findBestCombination(ulcomputer, combinations)
                 # Computing upper limit using best combination
                 if expected:
-                    try:
+                    if ulMin != None:
                         ret = ulMin/self.globalInfo.lumi
-                    except NameError:
+                    else:
                         ret = ulcomputer.ulSigma(expected=True, workspace_index=combinations.index(self.bestCB))
                         ret = ret/self.globalInfo.lumi
                 else:
@@ -560,11 +757,8 @@ class CombinedDataSet(object):
                 if isinstance(nsig,list):
                     nsig = nsig[0]
                 return self._datasets[0].likelihood(nsig,marginalize=marginalize)
-            nobs = [ x.dataInfo.observedN for x in self._datasets]
-            bg = [ x.dataInfo.expectedBG for x in self._datasets]
-            cov = self.globalInfo.covariance
-            computer = LikelihoodComputer(Data(nobs, bg, cov, None, nsig, deltas_rel=deltas_rel))
-            return computer.likelihood(nsig, marginalize=marginalize )
+            model = self.getStatisticalModel(nsig, deltas_rel)
+            return model.likelihood(marginalize=marginalize)
         elif hasattr(self.globalInfo, "jsonFiles"):
             # Getting the path to the json files
             # Loading the jsonFiles
@@ -574,15 +768,7 @@ class CombinedDataSet(object):
             else:
                 # Looking for the best combination
                 if self.bestCB == None:
-                    ulMin = float('+inf')
-                    for i_ws in range(ulcomputer.nWS):
-                        logger.debug("Performing best expected combination")
-                        ul = ulcomputer.ulSigma(expected=True, workspace_index=i_ws)
-                        if  ul < ulMin:
-                            ulMin = ul
-                            i_best = i_ws
-                    self.bestCB = combinations[i_best] # Keeping the index of the best combination for later
-                    logger.debug('Best combination : %d' % self.bestCB)
+                    self.findBestCombination(ulcomputer, combinations)
                 return ulcomputer.likelihood(workspace_index=combinations.index(self.bestCB))
         else:
             logger.error("Asked for combined likelihood, but no covariance or json file given." )
@@ -605,13 +791,8 @@ class CombinedDataSet(object):
                 if isinstance(nsig,list):
                     nsig = nsig[0]
                 return self._datasets[0].chi2(nsig, marginalize=marginalize)
-            nobs = [x.dataInfo.observedN for x in self._datasets ]
-            bg = [x.dataInfo.expectedBG for x in self._datasets ]
-            cov = self.globalInfo.covariance
-
-            computer = LikelihoodComputer(Data(nobs, bg, cov, deltas_rel=deltas_rel))
-
-            return computer.chi2(nsig, marginalize=marginalize)
+            model = self.getStatisticalModel(nsig, deltas_rel)
+            return model.chi2(marginalize=marginalize)
         elif hasattr(self.globalInfo, "jsonFiles"):
             # Getting the path to the json files
             # Loading the jsonFiles
@@ -621,16 +802,65 @@ class CombinedDataSet(object):
             else:
                 # Looking for the best combination
                 if self.bestCB == None:
-                    ulMin = float('+inf')
-                    for i_ws in range(ulcomputer.nWS):
-                        logger.debug("Performing best expected combination")
-                        ul = ulcomputer.ulSigma(expected=True, workspace_index=i_ws)
-                        if  ul < ulMin:
-                            ulMin = ul
-                            i_best = i_ws
-                    self.bestCB = combinations[i_best] # Keeping the index of the best combination for later
-                    logger.debug('Best combination : %d' % self.bestCB)
+                    self.findBestCombination(ulcomputer, combinations)
                 return ulcomputer.chi2(workspace_index=combinations.index(self.bestCB))
         else:
             logger.error("Asked for combined likelihood, but no covariance error given." )
             return None
+
+    def combinedLikelihoods(self, nsigs, marginalize=False, deltas_rel=0.2):
+        """
+        Computes the (combined) likelihoods for several signal hypotheses at
+        once (see combinedLikelihood). For a covariance matrix, the nuisances
+        are profiled for all hypotheses simultaneously.
+        :param nsigs: predicted signals (array with one row per hypothesis
+                      and one column per dataset, obeying the datasetOrder)
+        :param deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+
+        :returns: array of likelihoods
+        """
+
+        if hasattr(self.globalInfo, "covariance" ):
+            nsigs = np.asarray(nsigs, dtype=float)
+            if len(self._datasets) == 1:
+                return self._datasets[0].likelihoods(nsigs[:,0],marginalize=marginalize)
+            nobs = [ x.dataInfo.observedN for x in self._datasets]
+            bg = [ x.dataInfo.expectedBG for x in self._datasets]
+            cov = self.globalInfo.covariance
+            computer = LikelihoodComputer(Data(nobs, bg, cov, deltas_rel=deltas_rel))
+            return computer.likelihoods(nsigs, marginalize=marginalize )
+        elif hasattr(self.globalInfo, "jsonFiles"):
+            ## pyhf likelihoods are computed one by one
+            return np.array([self.combinedLikelihood(list(nsig), marginalize, deltas_rel)
+                             for nsig in nsigs])
+        else:
+            logger.error("Asked for combined likelihood, but no covariance or json file given." )
+            return None
+
+    def totalChi2s(self, nsigs, marginalize=False, deltas_rel=0.2):
+        """
+        Computes the total chi2 values for several signal hypotheses at
+        once (see totalChi2).
+        :param nsigs: predicted signals (array with one row per hypothesis
+                      and one column per dataset, obeying the datasetOrder)
+        :param deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+
+        :returns: array of chi2 values
+        """
+
+        if hasattr(self.globalInfo, "covariance" ):
+            nsigs = np.asarray(nsigs, dtype=float)
+            if len(self._datasets) == 1:
+                return self._datasets[0].chi2s(nsigs[:,0], marginalize=marginalize)
+            nobs = [x.dataInfo.observedN for x in self._datasets ]
+            bg = [x.dataInfo.expectedBG for x in self._datasets ]
+            cov = self.globalInfo.covariance
+            computer = LikelihoodComputer(Data(nobs, bg, cov, deltas_rel=deltas_rel))
+            return computer.chi2s(nsigs, marginalize=marginalize)
+        elif hasattr(self.globalInfo, "jsonFiles"):
+            ## pyhf chi2 values are computed one by one
+            return np.array([self.totalChi2(list(nsig), marginalize, deltas_rel)
+                             for nsig in nsigs])
+        else:
+            logger.error("Asked for combined likelihood, but no covariance error given." )
+            return None
@@ -27,11 +27,14 @@ class ExpResult(object):
     experimental result (experimental conference note or publication).
     """
 
-    def __init__(self, path = None, discard_zeroes = True, databaseParticles = None):
+    def __init__(self, path = None, discard_zeroes = True, databaseParticles = None,
+                 lazyLoading = False):
         """
         :param path: Path to the experimental result folder
         :param discard_zeroes: Discard maps with only zeroes
         :param databaseParticles: the model, i.e. the particle content
+        :param lazyLoading: only build the data grids (and triangulations)
+                            when first used
         """
 
         if not path:
@@ -62,7 +65,8 @@ class ExpResult(object):
                 try:
                     dataset = datasetObj.DataSet(root, self.globalInfo,
                             discard_zeroes = discard_zeroes,
-                            databaseParticles = databaseParticles)
+                            databaseParticles = databaseParticles,
+                            lazyLoading = lazyLoading)
                     if hasOrder:
                         datasets[dataset.dataInfo.dataId]=dataset
                     else:
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: mmapDatabase
+   :synopsis: Binary database format with a small index and memory-mapped
+              numerical blocks. The experimental results are only unpickled
+              when accessed, and the numerical arrays (data values, PCA
+              transformations and triangulations) are mapped from the file
+              instead of being read into memory.
+
+"""
+
+import io,mmap,struct
+import numpy as np
+from smodels.experiment.exceptions import SModelSExperimentError as SModelSError
+from smodels.tools.smodelsLogging import logger
+
+try:
+    import cPickle as serializer
+except ImportError as e:
+    import pickle as serializer
+
+magic = b"SMODELS-MMAPDB01" ## identifies the file format (and its version)
+_header = struct.Struct("<16sQQ") ## magic, offset and size of the index
+_alignment = 64 ## byte alignment of the blocks in the file
+_minArraySize = 256 ## smaller arrays (in bytes) are stored in the pickles
+
+def isMmapDatabase(filename):
+    """ check if filename is a memory-mappable database file """
+    try:
+        with open(filename,"rb") as f:
+            return f.read(len(magic)) == magic
+    except IOError:
+        return False
+
+class _Writer(object):
+    """
+    Writes the blocks of the database file, storing the
+    numerical arrays in separate (aligned) blocks.
+    """
+
+    def __init__(self, f, globalInfos):
+        """
+        :param f: file object
+        :param globalInfos: list of the globalInfo objects stored in the index
+        """
+
+        self.f = f
+        self.globalInfos = globalInfos
+        self._refs = {}
+        self._keep = []
+
+    def writeBlock(self, data):
+        """
+        Write data at the next aligned position.
+
+        :param data: bytes (or buffer) to be written
+        :return: offset and size of the block
+        """
+
+        offset = -(-self.f.tell()//_alignment)*_alignment
+        self.f.seek(offset)
+        self.f.write(data)
+        return offset,len(data)
+
+    def persistent_id(self, obj):
+        """
+        Store large numerical arrays as separate blocks and replace
+        the globalInfo objects by references to the index.
+        """
+        if id(obj) in self._refs:
+            return self._refs[id(obj)]
+        if type(obj) != np.ndarray or obj.size == 0:
+            return None
+        array = obj
+        if array.dtype == object:
+            ## arrays of floats (e.g. TxNameData.y_values) are
+            ## stored as float arrays
+            if not all(type(x) == float for x in array.flat):
+                return None
+            array = array.astype(float)
+        if array.nbytes < _minArraySize:
+            return None
+        array = np.ascontiguousarray(array)
+        offset,_ = self.writeBlock(array.view(np.uint8).ravel().data)
+        pid = ("array",offset,array.dtype.str,array.shape)
+        ## arrays referenced several times are written only once;
+        ## keep obj alive, so that its id is not reused during the dump
+        self._refs[id(obj)] = pid
+        self._keep.append(obj)
+        return pid
+
+    def dump(self, obj, protocol, useRefs=True):
+        """
+        Pickle obj (storing the arrays as separate blocks).
+
+        :param useRefs: if True, replace the globalInfo objects by references
+        :return: offset and size of the pickle block
+        """
+
+        self._refs = {}
+        if useRefs:
+            self._refs = dict([(id(gi),("globalInfo",i))
+                               for i,gi in enumerate(self.globalInfos)])
+        stream = io.BytesIO()
+        pickler = serializer.Pickler(stream, protocol=protocol)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(obj)
+        self._keep = []
+        return self.writeBlock(stream.getvalue())
+
+def writeMmapDatabase(filename, meta, expResultList, databaseParticles, protocol=4):
+    """
+    Write the database to a memory-mappable binary file.
+
+    :param filename: name of the file
+    :param meta: Meta object of the database
+    :param expResultList: list of ExpResult objects
+    :param databaseParticles: Model object with the particles used in the database
+    :param protocol: pickle protocol
+    """
+
+    globalInfos = [expRes.globalInfo for expRes in expResultList]
+    with open(filename,"wb") as f:
+        f.write(b"\0"*_header.size)
+        writer = _Writer(f,globalInfos)
+        results = [writer.dump(expRes,protocol) for expRes in expResultList]
+        txnames = [sorted(set([tx.txName for tx in expRes.getTxNames()]))
+                   for expRes in expResultList]
+        counts = [(len(expRes.datasets),
+                   sum([len(ds.txnameList) for ds in expRes.datasets]))
+                  for expRes in expResultList]
+        index = { "meta" : meta, "databaseParticles" : databaseParticles,
+                  "globalInfos" : globalInfos, "results" : results,
+                  "txnames" : txnames, "counts" : counts }
+        indexBlock = writer.dump(index, protocol, useRefs=False)
+        f.seek(0)
+        f.write(_header.pack(magic,*indexBlock))
+
+class MmapExpResultList(object):
+    """
+    List of the experimental results stored in a memory-mappable database
+    file. The ExpResult objects are only unpickled when accessed.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: name of the database file
+        """
+
+        self.filename = filename
+        with open(filename,"rb") as f:
+            self._mmap = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        self._arrays = {}
+        fileMagic,offset,size = _header.unpack(self._mmap[:_header.size])
+        if fileMagic != magic:
+            raise SModelSError("%s is not a valid database file" %filename)
+        index = self._load(offset,size)
+        self.meta = index["meta"]
+        self.databaseParticles = index["databaseParticles"]
+        self.globalInfos = index["globalInfos"]
+        self.txnames = index["txnames"]
+        ## numbers of datasets and txnames of each result
+        self.counts = index.get("counts",None)
+        self._results = index["results"]
+        self._expResults = [None]*len(self._results)
+
+    def _persistent_load(self, pid):
+        if pid[0] == "array":
+            ## an array shared by several objects is the same object after loading
+            if not pid in self._arrays:
+                _,offset,dtype,shape = pid
+                self._arrays[pid] = np.ndarray(shape,dtype=np.dtype(dtype),
+                                               buffer=self._mmap,offset=offset)
+            return self._arrays[pid]
+        if pid[0] == "globalInfo":
+            return self.globalInfos[pid[1]]
+        raise SModelSError("Unknown persistent id %s in %s" %(str(pid),self.filename))
+
+    def _load(self, offset, size):
+        """ unpickle the block at offset """
+        unpickler = serializer.Unpickler(io.BytesIO(self._mmap[offset:offset+size]),
+                                         encoding="latin1")
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()
+
+    def isLoaded(self, i):
+        """ has the i-th experimental result already been unpickled? """
+        return self._expResults[i] is not None
+
+    def __len__(self):
+        return len(self._results)
+
+    def __getitem__(self, i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._expResults[i] is None:
+            logger.debug("Loading %s from %s" %(self.globalInfos[i].id,self.filename))
+            self._expResults[i] = self._load(*self._results[i])
+        return self._expResults[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self):
+        """ pickled as a regular list """
+        return (list,(list(self),))
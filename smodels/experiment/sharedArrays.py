@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: sharedArrays
+   :synopsis: Moves the numerical arrays of the database (data values and
+              triangulations used for the interpolation) to a single read-only
+              memory block, which is shared by all forked processes.
+
+"""
+
+import os,mmap
+import numpy as np
+from smodels.tools.smodelsLogging import logger
+
+_alignment = 64 ## byte alignment of the arrays in the memory block
+_blocks = [] ## keep references to the memory blocks
+
+def getTxNameDatas(expResults):
+    """
+    Collect all the TxNameData objects (observed and expected) of the
+    experimental results.
+
+    :param expResults: list of ExpResult objects
+    :return: list of TxNameData objects
+    """
+
+    txnameDatas = []
+    for expResult in expResults:
+        for txname in expResult.getTxNames():
+            for txnameData in [txname.txnameData,txname.txnameDataExp]:
+                if txnameData is not None and not txnameData in txnameDatas:
+                    txnameDatas.append(txnameData)
+    return txnameDatas
+
+def _createBlock(size,filename=None):
+    """
+    Create a shared memory block.
+
+    :param size: size of the block (in bytes)
+    :param filename: if given, the block is mapped to this file, otherwise
+                     anonymous shared memory is used.
+    :return: memory block (mmap object) and the name of the temporary file
+             (None for anonymous shared memory)
+    """
+
+    if not filename:
+        return mmap.mmap(-1,size),None
+    tmpfile = filename+'.%i.tmp' %os.getpid()
+    with open(tmpfile,'wb+') as f:
+        f.truncate(size)
+        block = mmap.mmap(f.fileno(),size)
+    return block,tmpfile
+
+def shareArrays(expResults,filename=None):
+    """
+    Move the numerical arrays of all TxNameData objects of the experimental
+    results to a single read-only memory block. Forked processes (see ncpus and
+    ncpusPredictions) map this block instead of copying the arrays when the
+    reference counts of the objects change.
+    Arrays which are already read-only (i.e. already shared) are skipped.
+
+    :param expResults: list of ExpResult objects
+    :param filename: if given, store the arrays in this file and memory-map it
+                     (read-only), otherwise use anonymous shared memory.
+    :return: total size of the memory block (in bytes)
+    """
+
+    layout = []
+    size = 0
+    for txnameData in getTxNameDatas(expResults):
+        arrays = txnameData.getArrays()
+        entries = {}
+        for label,array in arrays.items():
+            if array.dtype == object or array.nbytes == 0:
+                continue
+            if not array.flags.writeable: #Already shared
+                continue
+            entries[label] = (size,np.ascontiguousarray(array))
+            size += -(-array.nbytes//_alignment)*_alignment
+        if entries:
+            layout.append((txnameData,entries))
+
+    if size == 0:
+        return 0
+
+    block,tmpfile = _createBlock(size,filename)
+    buf = np.frombuffer(block,dtype=np.uint8)
+    for txnameData,entries in layout:
+        for offset,array in entries.values():
+            buf[offset:offset+array.nbytes] = array.view(np.uint8).ravel()
+    del buf
+    if tmpfile:
+        #Map the file read-only:
+        block.flush()
+        block.close()
+        os.replace(tmpfile,filename)
+        with open(filename,'rb') as f:
+            block = mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+    _blocks.append(block)
+
+    for txnameData,entries in layout:
+        shared = {}
+        for label,(offset,array) in entries.items():
+            newArray = np.ndarray(array.shape,dtype=array.dtype,
+                                  buffer=block,offset=offset)
+            newArray.flags.writeable = False
+            shared[label] = newArray
+        txnameData.setArrays(shared)
+
+    logger.info("Moved the arrays of %i txname data to a shared block of %1.1f MB"
+                %(len(layout),size/1024.**2))
+    return size
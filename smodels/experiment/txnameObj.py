@@ -46,7 +46,12 @@ class TxName(object):
     file (constraint, condition,...) as well as the data.
     """
 
-    def __init__(self, path, globalObj, infoObj, databaseParticles):
+    def __init__(self, path, globalObj, infoObj, databaseParticles,
+                 lazyLoading=False):
+        """
+        :param lazyLoading: if True, the data grids are only built
+                            when first used (see TxNameData)
+        """
         self.path = path
         self.globalInfo = globalObj
         self._infoObj = infoObj
@@ -104,11 +109,13 @@ class TxName(object):
 
         self.txnameData = TxNameData(data, dataType, ident,
                                         Leff_inner=self.Leff_inner,
-                                        Leff_outer=self.Leff_outer)
+                                        Leff_outer=self.Leff_outer,
+                                        lazyLoading=lazyLoading)
         if expectedData:
             self.txnameDataExp = TxNameData( expectedData, dataType, ident,
                                             Leff_inner=self.Leff_inner,
-                                            Leff_outer=self.Leff_outer)
+                                            Leff_outer=self.Leff_outer,
+                                            lazyLoading=lazyLoading)
 
         #Builds up a list of elements appearing in constraints:
         elements = []
@@ -139,6 +146,8 @@ class TxName(object):
         for el in elements:
             self._topologyList.addElement(el)
 
+        self.getMatchKey() #Store the strings of the match key
+
     def hasOnlyZeroes(self):
         ozs = self.txnameData.onlyZeroValues()
         if self.txnameDataExp:
@@ -221,6 +230,36 @@ class TxName(object):
 
         return ul
 
+    def getULsFor(self,elements,expected=False):
+        """
+        Batch version of getULFor. Returns the upper limits (or expected)
+        for a list of elements (only for upperLimit-type), interpolating
+        all of them in a single call.
+
+        :param elements: list of Element objects or mass arrays (with units)
+        :param expected: look in self.txnameDataExp, not self.txnameData
+
+        :return: list of upper limits (same ordering as elements)
+        """
+
+        if hasattr ( self, "dbClient" ):
+            ## no batch queries for the database server
+            return [self.getULFor(el,expected) for el in elements]
+
+        if not self.txnameData.dataType == 'upperLimit':
+            logger.error("getULsFor method can only be used in UL-type data.")
+            raise SModelSError()
+
+        if not expected:
+            uls = self.txnameData.getValuesFor(elements)
+        else:
+            if not self.txnameDataExp:
+                return [None]*len(elements)
+            else:
+                uls = self.txnameDataExp.getValuesFor(elements)
+
+        return uls
+
     def addInfo(self,tag,value):
         """
         Adds the info field labeled by tag with value value to the object.
@@ -264,31 +303,79 @@ class TxName(object):
         Verify if the conditions or constraint in Txname contains the element.
         Check both branch orderings. If both orderings match, returns the one
         with the highest mass array.
+        The matching branch ordering is cached in the element, so it
+        is shared by all txnames with the same constraint and conditions.
 
         :param element: Element object
         :return: A copy of the element on the correct branch ordering appearing
                 in the Txname constraint or condition.
         """
 
+        matchKey = self.getMatchKey()
+        matches = getattr(element,'_txnameMatches',None)
+        if matches is None or not matchKey in matches:
+            ordering = self._getBranchOrdering(element)
+            if matches is not None:
+                matches[matchKey] = ordering
+        else:
+            ordering = matches[matchKey]
+
+        if ordering is None:
+            return False
+
+        newEl = element.copy()
+        newEl.branches = [element.branches[ibr].copy() for ibr in ordering]
+        return newEl
+
+    def getMatchKey(self):
+        """
+        Get the key identifying the constraint and condition elements.
+        Txnames with the same key match the same elements.
+        If the strings have not been stored (older pickle files), they are computed.
+        Since the same strings may define different elements for different
+        particle definitions, the key also holds the id of the database particles
+        (the ids are not stored, they are only valid within the running process).
+
+        :return: tuple with the id of the database particles, the constraint,
+                 condition and the final and intermediate states (strings)
+        """
+
+        if not hasattr(self,'_matchKey'):
+            self._matchKey = (str(getattr(self,'constraint',None)),
+                              str(getattr(self,'condition',None)),
+                              str(getattr(self,'finalState',None)),
+                              str(getattr(self,'intermediateState',None)))
+        databaseParticles = getattr(self.globalInfo,'_databaseParticles',None)
+        return (id(databaseParticles),) + self._matchKey
+
+    def _getBranchOrdering(self,element):
+        """
+        Get the branch ordering for which the element matches one
+        of the constraint or condition elements.
+        If more than one element ordering matches, return the one with largest
+        mass (relevant for clustering).
+
+        :param element: Element object
+        :return: tuple with the branch indices. None if the element does not match.
+        """
+
         #Stores all orderings of elements which matches the txname
-        matches = []
+        orderings = []
         for el in self._topologyList.getElements():
             #Compare branches:
-            for branchesA in itertools.permutations(element.branches):
-                branchesA = list(branchesA)
+            for ordering in itertools.permutations(range(len(element.branches))):
+                branchesA = [element.branches[ibr] for ibr in ordering]
                 if branchesA == el.branches:
-                    newEl = element.copy()
-                    newEl.branches = [br.copy() for br in branchesA]
-                    matches.append(newEl)
+                    orderings.append(ordering)
 
         #No elements matched:
-        if not matches:
-            return False
-        elif len(matches) == 1:
-            return matches[0]
-        else: #If more than one element ordering matches, return the one with largest mass (relevant for clustering)
-            matches = sorted(matches, key = lambda el: el.mass,reverse=True)
-            return matches[0]
+        if not orderings:
+            return None
+        elif len(orderings) == 1:
+            return orderings[0]
+        else:
+            masses = [[element.branches[ibr].mass for ibr in ordering] for ordering in orderings]
+            return max(zip(orderings,masses), key = lambda x: x[1])[0]
 
     def hasLikelihood(self):
         """ can I construct a likelihood for this map?
@@ -387,15 +474,55 @@ class TxName(object):
 
         return eff
 
+    def getEfficienciesFor(self,elements):
+        """
+        Batch version of getEfficiencyFor. Computes the efficiencies
+        for a list of elements, interpolating all of them in a single call.
+
+        :param elements: list of Element objects or mass arrays with units.
+        :return: list of efficiencies (floats)
+        """
+
+        if hasattr ( self, "dbClient" ):
+            ## no batch queries for the database server
+            return [self.getEfficiencyFor(el) for el in elements]
+
+        if self.txnameData.dataType == 'efficiencyMap':
+            effs = []
+            for eff in self.txnameData.getValuesFor(elements):
+                if not eff or math.isnan(eff):
+                    eff = 0. #Element is outside the grid or has zero efficiency
+                effs.append(eff)
+        elif self.txnameData.dataType == 'upperLimit':
+            effs = []
+            uls = self.txnameData.getValuesFor(elements)
+            for element,ul in zip(elements,uls):
+                if isinstance(element,Element):
+                    element._upperLimit = ul #Store the upper limit for convenience
+                if ul is None:
+                    effs.append(0.) #Element is outside the grid or the decays do not correspond to the txname
+                else:
+                    effs.append(1.)
+        else:
+            logger.error("Unknown txnameData type: %s" %self.txnameData.dataType)
+            raise SModelSError()
+
+        return effs
+
 class TxNameData(object):
     """
     Holds the data for the Txname object.  It holds Upper limit values or efficiencies.
     """
     _keep_values = False ## keep the original values, only for debugging
+    ## attributes built from the data (when lazy loading)
+    _dataAttributes = ['units','dataShape','widthPosition','y_values']
+    ## attributes built from the triangulation (when lazy loading)
+    _triangulationAttributes = ['_V','delta_x','tri','dimensionality',
+                                'full_dimensionality']
 
     def __init__(self,value,dataType,Id,
                     accept_errors_upto=.05,
-                    Leff_inner=None,Leff_outer=None):
+                    Leff_inner=None,Leff_outer=None,lazyLoading=False):
         """
         :param value: values in string format
         :param dataType: the dataType (upperLimit or efficiencyMap)
@@ -407,6 +534,10 @@ class TxNameData(object):
                 This method can be used to loosen the equal branches assumption.
         :param Leff_inner: is the effective inner radius of the detector, given in meters (used for reweighting prompt decays). If None, default values will be used.
         :param Leff_outer: is the effective outer radius of the detector, given in meters (used for reweighting decays outside the detector). If None, default values will be used.
+        :param lazyLoading: if True, the data is only parsed when the data values
+                            are first accessed and the PCA transformation and
+                            triangulation are only computed when first
+                            needed for interpolation.
 
 
         """
@@ -415,8 +546,11 @@ class TxNameData(object):
         self._accept_errors_upto=accept_errors_upto
         self.Leff_inner = Leff_inner
         self.Leff_outer = Leff_outer
-        self._V = None
-        self.loadData(value)
+        if lazyLoading:
+            self._value = value
+        else:
+            self._V = None
+            self.loadData(value)
         if self._keep_values:
             self.origdata = value
 
@@ -431,6 +565,39 @@ class TxNameData(object):
         """ a simple unique string identifier, mostly for _memoize """
         return str ( self._id )
 
+    def __getattr__(self, attr):
+        """
+        If the object was created with lazyLoading = True, parse the data
+        and compute the triangulation when the corresponding attributes
+        are first accessed.
+        """
+
+        state = self.__dict__
+        if attr in TxNameData._dataAttributes+TxNameData._triangulationAttributes:
+            if '_value' in state:
+                computeV = attr in TxNameData._triangulationAttributes
+                self.loadData(state.pop('_value'),computeV=computeV)
+                return getattr(self,attr)
+            if '_values' in state:
+                self.computeV(state.pop('_values'))
+                return getattr(self,attr)
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             %(type(self).__name__,attr))
+
+    def __getstate__(self):
+        """
+        Make sure the data and the triangulation are built
+        before pickling the object.
+        """
+
+        if '_value' in self.__dict__ or '_values' in self.__dict__:
+            self.tri
+        return self.__dict__
+
+    def isLoaded(self):
+        """ are the data and the triangulation already built? """
+        return not ('_value' in self.__dict__ or '_values' in self.__dict__)
+
     def round_to_n(self, x, n):
         if x==0.0:
             return x
@@ -664,13 +831,16 @@ class TxNameData(object):
 
         return massAndWidthArray
 
-    def loadData(self,value):
+    def loadData(self,value,computeV=True):
         """
         Uses the information in value to generate the data grid used for
         interpolation.
+
+        :param computeV: if False, only parse the data and postpone computing
+                         the PCA transformation and triangulation (lazy loading)
         """
 
-        if self._V:
+        if self.__dict__.get('_V') is not None:
             return
 
         if isinstance(value,str):
@@ -696,7 +866,10 @@ class TxNameData(object):
 
 
         self.y_values = np.array(values,dtype=object)[:,1]
-        self.computeV(values)
+        if computeV:
+            self.computeV(values)
+        else:
+            self._values = values
 
     def getValueFor(self,element):
         """
@@ -709,6 +882,76 @@ class TxNameData(object):
         :param element: Element object or mass array (with units)
         """
 
+        reweightFactor = self.getReweightFactor(element)
+
+        #Returns None or zero, if reweightFactor is None or zero:
+        if not reweightFactor:
+            return reweightFactor
+
+        #Extract the mass and width of the element
+        #and convert it to the PCA coordinates (len(point) = self.full_dimensionality):
+        point = self.dataToCoordinates(element,rotMatrix=self._V,
+                                          transVector=self.delta_x)
+        val = self.getValueForPoint(point)
+        if not isinstance(val,(float,int,unum.Unum)):
+            return val
+
+        #Apply reweightFactor (if data has no width or partial width dependence)
+        val *= reweightFactor
+
+        return val
+
+    def getValuesFor(self,elements):
+        """
+        Batch version of getValueFor. Interpolates the values for a list of
+        elements (or mass arrays) at once: all points are transformed to the
+        PCA coordinates with a single matrix multiplication and the
+        triangulation is searched only once for the whole set of points.
+
+        :param elements: list of Element objects or mass arrays (with units)
+
+        :return: list with the UL or efficiency for each element (same
+                 ordering as elements). Entries are None (or zero) if the
+                 value could not be computed.
+        """
+
+        values = [None]*len(elements)
+        reweightFactors = [self.getReweightFactor(el) for el in elements]
+        #Only interpolate the elements with non-vanishing reweight factors:
+        indices = []
+        for i,reweightFactor in enumerate(reweightFactors):
+            if not reweightFactor:
+                values[i] = reweightFactor
+            else:
+                indices.append(i)
+        if not indices:
+            return values
+
+        #Convert all the points to (untransformed) coordinates and
+        #transform them to the PCA coordinates in one go:
+        coords = np.array([self.dataToCoordinates(elements[i]) for i in indices])
+        points = np.dot(coords - self.delta_x, self._V)
+        vals = self.getValuesForPoints(points)
+        for i,val in zip(indices,vals):
+            if isinstance(val,(float,int,unum.Unum)):
+                #Apply reweightFactor (if data has no width or partial width dependence)
+                val *= reweightFactors[i]
+            values[i] = val
+
+        return values
+
+    def getReweightFactor(self,element):
+        """
+        Computes the reweight factor for the element according to the
+        lifetimes/widths of its particles (see getValueFor).
+        If a mass array is given as input, no lifetime reweighting is applied
+        and the factor is 1.
+
+        :param element: Element object or mass array (with units)
+
+        :return: reweight factor (float or None)
+        """
+
         #For backward compatibility:
         if not hasattr(self,'Leff_inner'):
             self.Leff_inner = None
@@ -745,22 +988,7 @@ class TxNameData(object):
             logger.error("Input of getValueFor must be an Element object or a mass array and not %s" %str(type(element)))
             raise SModelSError()
 
-        #Returns None or zero, if reweightFactor is None or zero:
-        if not reweightFactor:
-            return reweightFactor
-
-        #Extract the mass and width of the element
-        #and convert it to the PCA coordinates (len(point) = self.full_dimensionality):
-        point = self.dataToCoordinates(element,rotMatrix=self._V,
-                                          transVector=self.delta_x)
-        val = self.getValueForPoint(point)
-        if not isinstance(val,(float,int,unum.Unum)):
-            return val
-
-        #Apply reweightFactor (if data has no width or partial width dependence)
-        val *= reweightFactor
-
-        return val
+        return reweightFactor
 
     @_memoize
     def getValueForPoint(self,point):
@@ -789,6 +1017,79 @@ class TxNameData(object):
             val = self._returnProjectedValue()
         return val
 
+    def getValuesForPoints(self,points):
+        """
+        Returns the UL or efficiency for an array of points (in coordinates)
+        using interpolation. Points lying in the interpolation plane are
+        evaluated all at once, points which require extrapolation outside
+        the convex hull fall back to getValueForPoint.
+
+        :param points: array of points in coordinate space
+                       (shape = (N,self.full_dimensionality))
+
+        :return: list of UL or efficiency values (with units)
+        """
+
+        #Make sure the points are a 2D numpy array
+        points = np.atleast_2d(np.array(points,dtype=float))
+        projected_values = self.interpolateMany(points[:,:self.dimensionality])
+        #Check which points have larger dimensionality:
+        dps = np.sum(np.abs(points) > 10**-4,axis=1)
+        values = []
+        for point,dp,projected_value in zip(points,dps,projected_values):
+            if dp > self.dimensionality: ## we have data in different dimensions
+                #(as a list, so the cached values are found, see _memoize)
+                values.append(self.getValueForPoint(point.tolist()))
+                continue
+            if math.isnan(projected_value):
+                values.append(None)
+                continue
+            #Set value to zero if it is lower than machine precision (avoids fake negative values)
+            if abs(projected_value) < 100.*sys.float_info.epsilon:
+                projected_value = 0.
+            values.append(float(projected_value)*self.units[-1])
+        return values
+
+    def interpolateMany(self, points, fill_value=np.nan):
+        """
+        Returns the interpolated values for an array of points (in coordinates).
+        Vectorized version of interpolate.
+
+        :param points: array of points in coordinate space
+                       (shape = (N,self.dimensionality))
+
+        :return: array with the values for the points without units
+        """
+
+        tol = 1e-6
+        points = np.atleast_2d(np.array(points,dtype=float))
+        ret = np.full(len(points),fill_value,dtype=float)
+        simplices = np.asarray(self.tri.find_simplex(points, tol=tol))
+        inside = simplices != -1 ## points inside a simplex
+        if not inside.any():
+            return ret
+
+        simplices = simplices[inside]
+        #Transformation matrices for the simplices:
+        simplexTrans = np.take(self.tri.transform, simplices, axis=0)
+        #Space dimension:
+        d = simplexTrans.shape[-1]
+        #Rotation and translation to baryocentric coordinates:
+        delta_x = simplexTrans[:,d,:]
+        rot = simplexTrans[:,:d,:]
+        #Point coordinates in the baryocentric system
+        bary = np.einsum('ijk,ik->ij',rot,points[inside]-delta_x)
+        #Weights for the vertices:
+        wts = np.hstack([bary,1.-bary.sum(axis=1,keepdims=True)])
+        #Vertex indices:
+        vertices = np.take(self.tri.simplices, simplices, axis=0)
+        #Compute the values:
+        values = np.take(np.asarray(self.y_values,dtype=float), vertices)
+        vals = np.sum(values*wts,axis=1)
+        #If interpolation is below simplex values, take the smallest simplex value
+        ret[inside] = np.maximum(vals,values.min(axis=1))
+        return ret
+
     def interpolate(self, point, fill_value=np.nan):
         """
         Returns the interpolated value for the point (in coordinates)
@@ -818,7 +1119,7 @@ class TxNameData(object):
         #Vertex indices:
         vertices = np.take(self.tri.simplices, simplex, axis=0)
         #Compute the value:
-        values = np.array(self.y_values)
+        values = np.asarray(self.y_values)
         ret = np.dot(np.take(values, vertices),wts)
         minXsec = min(np.take(values, vertices))
         if ret < minXsec:
@@ -957,7 +1258,7 @@ class TxNameData(object):
 
         """
 
-        if not self._V is None:
+        if self.__dict__.get('_V') is not None:
             return
 
         #Convert nested mass arrays (with width tuples) to coordinates
@@ -1005,6 +1306,59 @@ class TxNameData(object):
         else:
             self.tri = Delaunay1D(MpCut)
 
+    def getArrays(self):
+        """
+        Collect the numerical arrays used for the interpolation (data values,
+        PCA transformation and triangulation), so they can be moved
+        to shared memory (see smodels.experiment.sharedArrays).
+
+        :return: dictionary with the array labels as keys and the arrays as values
+        """
+
+        arrays = {'_V' : self._V, 'delta_x' : self.delta_x}
+        try:
+            arrays['y_values'] = np.asarray(self.y_values,dtype=float)
+        except (TypeError,ValueError):
+            pass
+        if isinstance(self.tri,Delaunay1D):
+            labels = ['simplices','transform','convex_hull']
+        else:
+            labels = ['simplices','transform','neighbors','equations','points']
+        for label in labels:
+            arrays['tri.'+label] = getattr(self.tri,label)
+        return dict([(label,np.asarray(array)) for label,array in arrays.items()])
+
+    def setArrays(self,arrays):
+        """
+        Replace the numerical arrays used for the interpolation.
+
+        :param arrays: dictionary with the array labels (see getArrays) as
+                       keys and the new arrays as values
+        """
+
+        for label,array in arrays.items():
+            if not label.startswith('tri.'):
+                setattr(self,label,array)
+                continue
+            label = label[4:]
+            try:
+                setattr(self.tri,label,array)
+                continue
+            except AttributeError:
+                pass
+            #The transform and points of the qhull triangulation are read-only
+            #properties. Use the attribute storing their values only if the
+            #property returns it (checked for each scipy version),
+            #otherwise keep the triangulation's own (identical) arrays.
+            private = '_'+label
+            if not hasattr(self.tri,private):
+                continue
+            old = getattr(self.tri,private)
+            setattr(self.tri,private,array)
+            if getattr(self.tri,label) is not array:
+                setattr(self.tri,private,old)
+                logger.debug("Could not share the %s array of the triangulation" %label)
+
 
 class Delaunay1D:
     """
@@ -1046,6 +1400,10 @@ class Delaunay1D:
         :return: simplex index (int)
         """
 
+        if np.ndim(x) > 1:
+            #Array of points, find all simplices at once
+            return self.find_simplices(np.array(x)[:,0],tol=tol)
+
         xi = self.find_index(self.points,x)
         if xi == -1:
             if abs(x-self.points[0]) < tol:
@@ -1060,6 +1418,25 @@ class Delaunay1D:
         else:
             return xi
 
+    def find_simplices(self,xs,tol=0.):
+        """
+        Find 1D data intervals (simplices) for an array of points.
+        Vectorized version of find_simplex.
+
+        :param xs: 1D array of points (floats) without units
+        :param tol: Tolerance. If x is outside the data range with distance < tol, extrapolate.
+
+        :return: array of simplex indices (int)
+        """
+
+        pts = np.array(self.points,dtype=float)[:,0]
+        xis = np.searchsorted(pts,xs,side='left')-1
+        below = xis == -1
+        xis[below] = np.where(np.abs(xs[below]-pts[0]) < tol, 0, -1)
+        above = xis == len(self.simplices)
+        xis[above] = np.where(np.abs(xs[above]-pts[-1]) < tol, xis[above]-1, -1)
+        return xis
+
     def checkData(self,data):
         """
         Define the simplices according to data. Compute and store
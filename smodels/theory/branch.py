@@ -21,6 +21,8 @@ class Branch(object):
     A branch-element can be constructed from a string (e.g., ('[b,b],[W]').
     """
 
+    _signature = None #Cached canonical signature (see getSignature)
+
     def __init__(self, info=None, finalState=None, intermediateState=None, model=None):
         """
         Initializes the branch. If info is defined, tries to generate
@@ -161,6 +163,28 @@ class Branch(object):
     def __ne__( self, b2 ):
         return not self.__cmp__(b2) == 0
 
+    def getSignature(self):
+        """
+        Get the canonical signature of the branch. The signature is a
+        hashable tuple built from vertnumb, vertparts, the IDs of the odd particles
+        and the sorted IDs of the even particles in each vertex.
+        Branches with the same signature are equal (see __cmp__), but equal
+        branches may have distinct signatures, since distinct particles can have
+        equal properties (or match a MultiParticle).
+        The signature is computed once and cached.
+
+        :return: tuple with the signature
+        """
+
+        if self._signature is None:
+            info = self.getInfo()
+            oddIDs = tuple([ptc._id for ptc in self.oddParticles])
+            evenIDs = tuple([tuple(sorted([ptc._id for ptc in vertex]))
+                             for vertex in self.evenParticles])
+            self._signature = (info['vertnumb'],tuple(info['vertparts']),oddIDs,evenIDs)
+
+        return self._signature
+
     def __getattr__(self, attr):
         """
         If the attribute has not been defined for the element
@@ -226,6 +250,7 @@ class Branch(object):
         if self.getInfo() != other.getInfo():
             raise SModelSError("Can not add branches with distinct topologies")
 
+        self._signature = None
         #Combine odd particles
         for iptc,ptc in enumerate(other.oddParticles):
             self.oddParticles[iptc] += ptc
@@ -299,6 +324,7 @@ class Branch(object):
         self.oddParticles = self.oddParticles[:iv] + self.oddParticles[iv+1:]
         self.evenParticles = self.evenParticles[:iv] + self.evenParticles[iv+1:]
         self.setInfo()
+        self._signature = None
 
     def copy(self):
         """
@@ -485,6 +511,15 @@ class InclusiveBranch(Branch):
             self.vertnumb = InclusiveValue()
         self.vertparts = InclusiveList()
 
+    def getSignature(self):
+        """
+        Inclusive branches match distinct branches, so they have no signature.
+
+        :return: None
+        """
+
+        return None
+
     def __cmp__(self,other):
         """
         Always returns true. The only exception is if a final state particle has been
@@ -10,7 +10,7 @@
 from smodels.theory import crossSection
 from smodels.theory.element import Element
 from smodels.experiment.datasetObj import DataSet,CombinedDataSet
-from smodels.tools.physicsUnits import fb
+from smodels.tools.physicsUnits import fb, GeV
 from smodels.theory.exceptions import SModelSTheoryError as SModelSError
 from smodels.theory.auxiliaryFunctions import average
 import numpy as np
@@ -224,6 +224,13 @@ class ElementCluster(object):
         :return: Element object
         """
 
+        #Use the average element computed when clustering, if the
+        #cluster has not changed since
+        avgEl = getattr(self,'_averageElement',None)
+        if avgEl is not None and len(avgEl.elements) == len(self.elements) and \
+                all(elA is elB for elA,elB in zip(avgEl.elements,self.elements)):
+            return avgEl
+
         avgEl = AverageElement(self.elements[:])
         if self.dataset:
             avgEl._upperLimit = self.dataset.getUpperLimitFor(avgEl,
@@ -407,8 +414,54 @@ def clusterElements(elements, maxDist, dataset):
 
     for cluster in clusters:
         cluster.txnames = txnames
+
+    #Compute the upper limits of the average elements at once
+    if dataset.getType() == 'upperLimit':
+        avgElements = [AverageElement(cluster.elements[:]) for cluster in clusters]
+        prefetchUpperLimits(avgElements,dataset)
+        for cluster,avgEl in zip(clusters,avgElements):
+            avgEl._index = None
+            cluster._averageElement = avgEl
+
     return clusters
 
+def prefetchUpperLimits(elements, dataset):
+    """
+    Computes the upper limits of the elements (or average elements)
+    and stores them in el._upperLimit. The elements of each txname
+    are interpolated in a single (batched) call.
+
+    :parameter elements: list of Element or AverageElement objects
+    :parameter dataset: Dataset object to be used when computing the upper limits
+    """
+
+    txnameElements = {}
+    for el in elements:
+        txnameElements.setdefault(el.txname,[]).append(el)
+    for txname,els in txnameElements.items():
+        upperLimits = dataset.getUpperLimitsFor(els,txnames=txname)
+        if not upperLimits:
+            upperLimits = [None]*len(els)
+        for el,ul in zip(els,upperLimits):
+            el._upperLimit = ul
+
+def getDistanceMatrix(upperLimits):
+    """
+    Computes the relative distances (see relativeDistance) between
+    all pairs of upper limit values.
+
+    :parameter upperLimits: list or array of upper limit values (floats)
+
+    :returns: matrix with the relative distances (numpy array)
+    """
+
+    uls = np.asarray(upperLimits,dtype=float)
+    sums = uls[:,None] + uls[None,:]
+    diffs = np.abs(uls[:,None] - uls[None,:])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        distanceMatrix = np.where(sums == 0., 0., 2.*diffs/sums)
+    return distanceMatrix
+
 def groupElements(elements,dataset):
     """
     Group elements into groups where the average element
@@ -424,42 +477,106 @@ def groupElements(elements,dataset):
     """
 
     # First make sure all elements contain their upper limits
+    prefetchUpperLimits(elements,dataset)
     for el in elements:
-        if not hasattr(el,'._upperLimit'):
-            el._upperLimit = dataset.getUpperLimitFor(el,txnames=el.txname)
         if el._upperLimit is None:
             raise SModelSError("Trying to cluster element outside the grid.")
 
     #Group elements if they have the same UL
-    #and give the same average element (same mass and same width)
+    #and give the same average element (same mass and same width).
+    #Only the elements with the same UL need to be compared.
     avgElements = []
-    for iA,elA in enumerate(elements):
-        avgEl = AverageElement([elA])
-        avgEl._upperLimit = elA._upperLimit
-        for iB,elB in enumerate(elements):
-            if iB <= iA:
-                continue
-            if elA._upperLimit != elB._upperLimit:
-                continue
-            if avgEl != elB:
-                continue
-            avgEl.elements.append(elB)
-            avgEl.weight += elB.weight
-        if not avgEl in avgElements:
+    groups = {}
+    for el in elements:
+        sameUL = groups.setdefault(el._upperLimit.asNumber(fb),[])
+        for avgEl in sameUL:
+            if avgEl == el:
+                avgEl.elements.append(el)
+                avgEl.weight += el.weight
+                break
+        else:
+            avgEl = AverageElement([el])
+            avgEl._upperLimit = el._upperLimit
+            sameUL.append(avgEl)
             avgElements.append(avgEl)
 
-
-    #Make sure each element belongs to a average element:
-    for el in elements:
-        nclusters = sum([avgEl.contains(el) for avgEl in avgElements])
-        if nclusters != 1:
-            raise SModelSError("Error computing average elements. Element %s belongs to %i average elements."
-                               %(str(el),nclusters))
     return avgElements
 
+def _massArrays(elements):
+    """
+    Convert the masses and widths of the elements to arrays (in GeV),
+    so averages over many elements can be computed at once.
+
+    :parameter elements: list of Element or AverageElement objects
+
+    :returns: tuple with the branch lengths, the mass array and the width array
+              (with one row per element), or None if the elements have distinct
+              topologies or the masses/widths are not all Unum objects
+    """
+
+    shape = [len(br) for br in elements[0].mass]
+    masses,widths = [],[]
+    try:
+        for el in elements:
+            if [len(br) for br in el.mass] != shape or \
+                    [len(br) for br in el.totalwidth] != shape:
+                return None
+            masses.append([m.asNumber(GeV) for br in el.mass for m in br])
+            widths.append([w.asNumber(GeV) for br in el.totalwidth for w in br])
+    except (AttributeError,TypeError):
+        return None
+    return shape,np.array(masses),np.array(widths)
+
+def _consistentWindows(windows, checkWindows, consistent):
+    """
+    Find the largest consistent windows of consecutive elements
+    inside each window [start,end], removing elements from its edges
+    (breadth first, so the largest windows are found first).
+    The windows of each step are checked at once.
+
+    :parameter windows: list of (start,end) tuples with the indices of
+                        the first and last elements in each window
+    :parameter checkWindows: function checking the consistency of a list of windows
+                             and storing the results in consistent
+    :parameter consistent: dictionary with the windows as keys and
+                           True/False if the window is/is not consistent
+
+    :returns: list of (start,end) tuples
+    """
+
+    found = [[] for window in windows]
+    candidates = [[window] for window in windows]
+    while any(candidates):
+        toCheck = []
+        for ws in candidates:
+            toCheck += [w for w in ws if not w in consistent]
+        checkWindows(list(dict.fromkeys(toCheck)))
+        newCandidates = []
+        for iw,ws in enumerate(candidates):
+            found[iw] += [w for w in ws if consistent[w]]
+            newWindows = []
+            for a,b in ws:
+                if not consistent[(a,b)] and a < b:
+                    for window in [(a,b-1),(a+1,b)]:
+                        #Skip windows contained in the ones already found
+                        if any(c <= window[0] and window[1] <= d for c,d in found[iw]):
+                            continue
+                        if not window in newWindows:
+                            newWindows.append(window)
+            newCandidates.append(newWindows)
+        candidates = newCandidates
+
+    return [window for ws in found for window in ws]
+
 def doCluster(elements, dataset, maxDist):
     """
     Cluster algorithm to cluster elements.
+    The elements are sorted by their upper limits, so the clusters
+    of elements less than maxDist apart from each other (the maximal
+    cliques of the graph connecting elements closer than maxDist)
+    are windows of consecutive elements. Windows whose average element
+    is more than maxDist apart from its elements are replaced by their
+    largest consistent sub-windows.
 
     :parameter elements: list of all elements to be clustered
     :parameter dataset: Dataset object to be used when computing distances in upper limit space
@@ -477,79 +594,81 @@ def doCluster(elements, dataset, maxDist):
     for iel,el in enumerate(elementList):
         el._index = iel
 
-    #Pre-compute all necessary distances:
-    distanceMatrix = np.zeros((len(elementList),len(elementList)))
-    for iel,elA in enumerate(elementList):
-        for jel,elB in enumerate(elementList):
-            if jel <= iel:
-                continue
-            distanceMatrix[iel,jel] = relativeDistance(elA, elB, dataset)
-    distanceMatrix = distanceMatrix + distanceMatrix.T
+    #Pre-compute all distances:
+    upperLimits = np.array([el._upperLimit.asNumber(fb) for el in elementList])
+    distanceMatrix = getDistanceMatrix(upperLimits)
+
+    #Masses, widths and weights used to compute the average elements
+    arrays = _massArrays(elementList)
+    weights = np.array([el.weight.getMaxXsec().asNumber(fb) for el in elementList])
+
+    def averageElement(a,b):
+        w = weights[a:b+1]
+        if arrays is None or not w.sum() > 0. or \
+                len(set([el.txname for el in elementList[a:b+1]])) != 1:
+            return AverageElement(elementList[a:b+1])
+        shape,masses,widths = arrays
+        avgMass = np.dot(w,masses[a:b+1])/w.sum()
+        avgWidth = np.dot(w,widths[a:b+1])/w.sum()
+        avgEl = AverageElement()
+        avgEl.mass,avgEl.totalwidth = [],[]
+        i = 0
+        for n in shape:
+            avgEl.mass.append([m*GeV for m in avgMass[i:i+n]])
+            avgEl.totalwidth.append([width*GeV for width in avgWidth[i:i+n]])
+            i += n
+        avgEl.txname = elementList[a].txname
+        return avgEl
 
-    #Start building maximal clusters
-    clusterList = []
-    for el in elementList:
-        cluster = ElementCluster([],dataset,distanceMatrix)
-        for elB in elementList:
-            if distanceMatrix[el._index,elB._index] <= maxDist:
-                cluster.add(elB)
-        if not cluster.elements:
-            continue
-        if cluster.averageElement()._upperLimit is None:
+    #The results are kept, since the windows found when splitting
+    #overlapping maximal windows are often the same
+    consistent = {}
+    def checkWindows(windows):
+        #The average element must have an upper limit less than maxDist
+        #apart from the ones of the elements (the largest distances are
+        #the ones to the first and last elements)
+        avgElements = []
+        for a,b in windows:
+            if a == b:
+                consistent[(a,b)] = True
+            else:
+                avgElements.append(averageElement(a,b))
+        prefetchUpperLimits(avgElements,dataset)
+        avgElements = iter(avgElements)
+        for a,b in windows:
+            if a == b:
+                continue
+            ul = next(avgElements)._upperLimit
+            if ul is None:
+                consistent[(a,b)] = False
+            else:
+                dists = getDistanceMatrix([ul.asNumber(fb),upperLimits[a],upperLimits[b]])[0]
+                consistent[(a,b)] = dists.max() <= maxDist
+
+    #Find the maximal windows of elements less than maxDist apart
+    #(the distances grow with the separation of the sorted elements)
+    nels = len(elementList)
+    ends = [iel + max(0,np.count_nonzero(distanceMatrix[iel,iel:] < maxDist) - 1)
+            for iel in range(nels)]
+    windows = [(iel,ends[iel]) for iel in range(nels)
+               if iel == 0 or ends[iel] > ends[iel-1]]
+    windows = _consistentWindows(windows,checkWindows,consistent)
+
+    #Remove windows contained in other windows
+    windows = sorted(set(windows), key = lambda w: (w[0],-w[1]))
+    finalWindows = []
+    for a,b in windows:
+        if finalWindows and b <= maxEnd:
             continue
-        if not cluster in clusterList:
-            clusterList.append(cluster)
+        finalWindows.append((a,b))
+        maxEnd = b
 
-    #Split the maximal clusters until all elements inside each cluster are
-    #less than maxDist apart from each other and the cluster average position
-    #is less than maxDist apart from all elements
     finalClusters = []
-    while clusterList:
-        newClusters = []
-        for cluster in clusterList:
-            #Check if maximal internal distance is below maxDist
-            isConsistent = cluster.isConsistent(maxDist)
-            if isConsistent and cluster.maxInternalDist < maxDist:
-                if not cluster in finalClusters:
-                    finalClusters.append(cluster)
-
-            #Cluster violates maxDist:
-            else:
-                #Loop over cluster elements and if element distance
-                #falls outside the cluster, remove element
-                for el in cluster:
-                    if cluster.getDistanceTo(el) > maxDist or not isConsistent:
-                        newcluster = cluster.copy()
-                        newcluster.remove(el)
-                        if newcluster.averageElement()._upperLimit is None:
-                            continue
-                        if newcluster in newClusters:
-                            continue
-                        newClusters.append(newcluster)
-
-        clusterList = newClusters
-        # Check for oversized list of indexCluster (too time consuming)
-        if len(clusterList) > 100:
-            logger.warning("ElementCluster failed, using unclustered masses")
-            finalClusters = []
-            clusterList = []
-
-    # finalClusters = finalClusters + clusterList
-    # Add clusters of individual masses (just to be safe)
-    for el in elementList:
-        finalClusters.append(ElementCluster([el],dataset,distanceMatrix))
-
-    # Clean up clusters (remove redundant clusters)
-    for ic, clusterA in enumerate(finalClusters):
-        if clusterA is None:
-            continue
-        for jc, clusterB in enumerate(finalClusters):
-            if clusterB is None:
-                continue
-            if ic != jc and set(clusterB.indices()).issubset(set(clusterA.indices())):
-                finalClusters[jc] = None
-    while finalClusters.count(None) > 0:
-        finalClusters.remove(None)
+    for a,b in finalWindows:
+        cluster = ElementCluster([],dataset,distanceMatrix)
+        cluster.elements = elementList[a:b+1]
+        cluster.maxInternalDist = distanceMatrix[a,b]
+        finalClusters.append(cluster)
 
     #Replace average elements by the original elements:
     for cluster in finalClusters:
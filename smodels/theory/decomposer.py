@@ -11,8 +11,9 @@
 """
 
 import time
-from smodels.theory import element, topology
+from smodels.theory import element, topology, crossSection
 from smodels.theory.branch import Branch, decayBranches
+from smodels.theory.particle import ParticleList
 from smodels.tools.physicsUnits import fb, GeV
 from smodels.theory.exceptions import SModelSTheoryError as SModelSError
 from smodels.tools.smodelsLogging import logger
@@ -31,9 +32,36 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
 
     """
     t1 = time.time()
-    
-    xSectionList = model.xsections    
+
+    sigmacut = _checkParameters(sigmacut, doCompress, minmassgap)
+    maxWeight, xSectionListDict = _getProductionWeights(model)
+
+    # Create 1-particle branches with all possible mothers    
     pdgList = model.getValuesFor('pdg')
+    branchList = []
+    for pid in maxWeight:
+        branchList.append(_getInitialBranch(model, pid, pdgList))
+        branchList[-1].maxWeight = maxWeight[pid]        
+        
+    # Generate final branches (after all R-odd particles have decayed)
+    finalBranchList = decayBranches(branchList, sigmacut)
+
+    # Combine pairs of branches into elements according to production
+    # cross section list
+    smsTopList = _combineBranches(_getBranchPairs(finalBranchList, maxWeight,
+                                                  xSectionListDict, sigmacut),
+                                  doCompress, doInvisible, minmassgap)
+
+    logger.debug("decomposer done in %.2f s." % (time.time() -t1 ) )
+  
+    return smsTopList
+
+def _checkParameters(sigmacut, doCompress, minmassgap):
+    """
+    Check the decomposition parameters.
+
+    :return: sigmacut (float, in fb)
+    """
 
     if doCompress and minmassgap/GeV < 0.:
         logger.error("Asked for compression without specifying minmassgap. Please set minmassgap.")        
@@ -41,8 +69,20 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
 
     if isinstance(sigmacut,(float,int)):
         sigmacut = sigmacut*fb
-    sigmacut = sigmacut.asNumber(fb)
+    return sigmacut.asNumber(fb)
+
+def _getProductionWeights(model):
+    """
+    Get the maximum cross sections (weights) for single particles
+    (irrespective of sqrtS) and the cross sections for each pair of
+    produced particles.
+
+    :param model: Model object
+    :return: dictionary with the maximum weights (in fb) for each PDG,
+             dictionary with the cross sections for each PDG pair
+    """
 
+    xSectionList = model.xsections    
     xSectionList.removeLowerOrder()
     # Order xsections by PDGs to improve performance
     xSectionList.order()
@@ -59,23 +99,40 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
     for pids in xSectionList.getPIDpairs():
         xSectionListDict[pids] = xSectionList.getXsecsFor(pids)
 
-    # Create 1-particle branches with all possible mothers    
-    branchList = []
-    for pid in maxWeight:
-        branchList.append(Branch())
-        bsmParticle = model.getParticlesWith(pdg=pid)
-        if not bsmParticle:
-            raise SModelSError("Particle for pdg %i has not been defined.")
-        if len(bsmParticle) != 1:
-            raise SModelSError("Particle with pdg %i has multiple definitions.")
-        branchList[-1].oddParticles = [bsmParticle[0]]
-        if not pid in pdgList:
-            logger.error("PDG %i has not been defined" %int(pid))
-        branchList[-1].maxWeight = maxWeight[pid]        
-        
-    # Generate final branches (after all R-odd particles have decayed)
-    finalBranchList = decayBranches(branchList, sigmacut)
-    
+    return maxWeight, xSectionListDict
+
+def _getInitialBranch(model, pid, pdgList):
+    """
+    Create the 1-particle branch for the mother with PDG pid.
+
+    :param pdgList: list with the PDGs of the model particles
+    :return: Branch object
+    """
+
+    branch = Branch()
+    bsmParticle = model.getParticlesWith(pdg=pid)
+    if not bsmParticle:
+        raise SModelSError("Particle for pdg %i has not been defined.")
+    if len(bsmParticle) != 1:
+        raise SModelSError("Particle with pdg %i has multiple definitions.")
+    branch.oddParticles = [bsmParticle[0]]
+    if not pid in pdgList:
+        logger.error("PDG %i has not been defined" %int(pid))
+    return branch
+
+def _getBranchPairs(finalBranchList, maxWeight, xSectionListDict, sigmacut):
+    """
+    Generate the pairs of branches which are combined into elements,
+    according to the production cross sections.
+
+    :param finalBranchList: list of final branches (after all R-odd particles have decayed)
+    :param maxWeight: dictionary with the maximum weights (in fb) for each PDG
+    :param xSectionListDict: dictionary with the cross sections for each PDG pair
+    :param sigmacut: minimum sigma*BR (in fb)
+    :return: iterator over tuples with the PDG pair, its cross sections,
+             the two branches and their combined branching ratio
+    """
+
     # Generate dictionary, where keys are the PIDs and values are the list of branches for the PID (for performance)
     branchListDict = {}
     for branch in finalBranchList:
@@ -84,7 +141,7 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
         else:
             branchListDict[branch.oddParticles[0].pdg] = [branch]
 
-    for pid in xSectionList.getPIDs():
+    for pid in maxWeight:
         if not pid in branchListDict:
             branchListDict[pid] = []
 
@@ -93,11 +150,7 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
         branchListDict[pid] = sorted(branchListDict[pid], 
                                      key=lambda br: br.maxWeight, reverse=True)        
 
-    smsTopList = topology.TopologyList()
-
-    # Combine pairs of branches into elements according to production
-    # cross section list
-    for pids in xSectionList.getPIDpairs():
+    for pids in xSectionListDict:
         weightList = xSectionListDict[pids]
         maxxsec = weightList.getMaxXsec().asNumber(fb)
         if maxxsec == 0.: ## protection
@@ -117,15 +170,432 @@ def decompose(model, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
                 finalBR = BR1*BR2
                 if finalBR < minBR:
                     continue # Skip elements with xsec below sigmacut
-                                       
-                newElement = element.Element([branch1, branch2])
-                newElement.weight = weightList*finalBR
-                newElement.sortBranches()  #Make sure elements are sorted BEFORE adding them              
-                smsTopList.addElement(newElement)                                                 
-                                                    
+
+                yield pids, weightList, branch1, branch2, finalBR
+
+def _combineBranches(pairs, doCompress, doInvisible, minmassgap):
+    """
+    Combine the pairs of branches into elements and compress them.
+
+    :param pairs: iterator over the pairs of branches (see _getBranchPairs)
+    :return: list of topologies (TopologyList object)
+    """
+
+    smsTopList = topology.TopologyList()
+    for pids, weightList, branch1, branch2, finalBR in pairs:
+        newElement = element.Element([branch1, branch2])
+        newElement.weight = weightList*finalBR
+        newElement.sortBranches()  #Make sure elements are sorted BEFORE adding them
+        smsTopList.addElement(newElement)
+
     smsTopList.compressElements(doCompress, doInvisible, minmassgap)
-    smsTopList._setElementIds()       
-            
-    logger.debug("decomposer done in %.2f s." % (time.time() -t1 ) )
-  
+    smsTopList._setElementIds()
+
     return smsTopList
+
+class _WeightTrace(object):
+    """
+    Placeholder for an element weight (or a branch maximum weight) used while
+    building the elements of a Decomposition. It records how the weights are
+    combined (in the tape of the decomposition), so they can be recomputed
+    for new cross sections and branching ratios.
+    """
+
+    __slots__ = ('tape', 'index')
+
+    def __init__(self, tape, operation):
+        """
+        :param tape: list of operations
+        :param operation: tuple describing the operation
+        """
+        self.tape = tape
+        self.index = len(tape)
+        tape.append(operation)
+
+    def __add__(self, other):
+        return _WeightTrace(self.tape, ('add', self.index, other.index))
+
+    def copy(self):
+        """ the traces are never modified, so they can be shared """
+        return self
+
+class Decomposition(object):
+    """
+    Decomposition which can be updated for new cross sections and branching
+    ratios of the same spectrum. It keeps the branches generated by the decays
+    and the elements of the previous model:
+
+    * the branches are identified by their decay chain (the PDGs of the
+      daughters in each decay), so they are only decayed further if they were
+      not generated before (e.g. they were below sigmacut);
+    * if the pairs of branches combined into elements changed, the elements
+      are built as in decompose;
+    * if the pairs of branches are the same as for the previous model, the
+      operations combining the weights are recorded (once) and only the
+      element weights are recomputed for the following models.
+
+    The resulting TopologyList is identical to the one of a fresh decomposition
+    (see decompose). If only the weights are recomputed, the TopologyList returned
+    previously is updated in place.
+    The particles are compared by their PDGs, masses and widths, so the model
+    can also be a new Model object (e.g. built from another SLHA file).
+    If the masses or widths of the particles changed, everything is recomputed.
+    """
+
+    def __init__(self, sigmacut= 0.1*fb, doCompress=True, doInvisible=True,
+                 minmassgap= 0*GeV):
+        """
+        :param sigmacut: minimum sigma*BR to be generated, by default sigmacut = 0.1 fb
+        :param doCompress: turn mass compression on/off
+        :param doInvisible: turn invisible compression on/off
+        :param minmassgap: maximum value (in GeV) for considering two R-odd particles
+                           degenerate (only revelant for doCompress=True )
+        """
+
+        self.sigmacut = _checkParameters(sigmacut, doCompress, minmassgap)
+        self.doCompress = doCompress
+        self.doInvisible = doInvisible
+        self.minmassgap = minmassgap
+        self.lastUpdate = None #What was recomputed in the last call ("all", "elements" or "weights")
+        self.nDecayed = 0 #Number of branches decayed in the last call
+        self._reset()
+
+    def _reset(self):
+        """
+        Remove all branches and elements.
+        """
+
+        self._particles = None #PDGs, masses and widths of the BSM particles
+        self._particleObjects = [] #BSM particles of the previous model
+        self._roots = {} #Initial branches for each PDG
+        self._branches = {} #Branches generated by the decays for each decay chain
+        self._resetElements()
+
+    def _resetElements(self):
+        """
+        Remove the elements.
+        """
+
+        self._pairs = None #Pairs of branches of the elements
+        self._topList = None
+        self._tape = None
+        self._inPlace = set() #Operations which can change their first operand
+        self._elementTraces = []
+        self._branchTraces = []
+
+    def _getParticleProperties(self, model):
+        """
+        Get the PDGs, masses and widths of the BSM particles of model.
+        """
+
+        return [(particle.pdg, particle.mass, particle.totalwidth)
+                for particle in model.BSMparticles]
+
+    def _setParticles(self, newParticles, branches):
+        """
+        Replace the particles of the previous model by the (equivalent)
+        particles of a new model in the branches.
+
+        :param newParticles: dictionary mapping the ids of the previous particles
+                             to the new particles
+        :param branches: list of Branch objects
+        """
+
+        newVertices = {}
+        for branch in branches:
+            branch.oddParticles = [newParticles.get(id(ptc),ptc) for ptc in branch.oddParticles]
+            evenParticles = []
+            for vertex in branch.evenParticles:
+                #Only the vertices with (Z2-even) BSM particles change
+                if not id(vertex) in newVertices:
+                    newVertex = vertex
+                    if any(id(ptc) in newParticles for ptc in vertex):
+                        newVertex = ParticleList([newParticles.get(id(ptc),ptc) for ptc in vertex])
+                    newVertices[id(vertex)] = (vertex,newVertex)
+                evenParticles.append(newVertices[id(vertex)][1])
+            branch.evenParticles = evenParticles
+            branch._signature = None
+
+    def _setElementParticles(self, newParticles):
+        """
+        Replace the particles of the previous model by the (equivalent)
+        particles of a new model in the elements and update the element
+        signatures.
+
+        :param newParticles: dictionary mapping the ids of the previous particles
+                             to the new particles
+        """
+
+        self._setParticles(newParticles, [branch for el,_ in self._elementTraces
+                                          for branch in el.branches])
+        for el,_ in self._elementTraces:
+            el._signature = None
+        for topo in self._topList:
+            topo._elementIndex = {}
+            for el in topo.elementList:
+                signature = el.getSignature()
+                if signature is not None:
+                    topo._elementIndex.setdefault(signature,el)
+
+    def decompose(self, model):
+        """
+        Perform decomposition using the information stored in model, reusing
+        the branches and elements of the previous model.
+
+        :param model: Model object
+        :returns: list of topologies (TopologyList object)
+        """
+
+        t1 = time.time()
+
+        particles = self._getParticleProperties(model)
+        self.lastUpdate = "weights"
+        self.nDecayed = 0
+        newParticles = {}
+        if particles != self._particles:
+            self._reset()
+            self._particles = particles
+            self.lastUpdate = "all"
+        elif any(p1 is not p2 for p1,p2 in zip(model.BSMparticles,self._particleObjects)):
+            #Same particles from a new model
+            newParticles = dict([(id(p1),p2) for p1,p2 in
+                                 zip(self._particleObjects,model.BSMparticles)])
+            self._setParticles(newParticles, list(self._roots.values())
+                               + [br for br in self._branches.values() if br])
+        self._particleObjects = list(model.BSMparticles)
+
+        maxWeight, xSectionListDict = _getProductionWeights(model)
+
+        # Update the initial branches
+        pdgList = model.getValuesFor('pdg')
+        branchList = []
+        for pid in maxWeight:
+            if not pid in self._roots:
+                self._roots[pid] = _getInitialBranch(model, pid, pdgList)
+            branchList.append((self._roots[pid],(pid,)))
+            self._roots[pid].maxWeight = maxWeight[pid]
+
+        # Generate final branches (after all R-odd particles have decayed)
+        finalBranchList = self._decayBranches(branchList, self.sigmacut)
+
+        pairs = list(_getBranchPairs(finalBranchList, maxWeight, xSectionListDict,
+                                     self.sigmacut))
+        samePairs = self._samePairs(pairs)
+        if self.lastUpdate == "weights" and (not samePairs or self._tape is None):
+            self.lastUpdate = "elements"
+        if not samePairs:
+            self._buildElements(pairs)
+        else:
+            if self._tape is None:
+                # The same pairs appeared twice: trace the weights, so only
+                # the weights are recomputed for the next models
+                self._traceElements(pairs)
+            elif newParticles:
+                self._setElementParticles(newParticles)
+            self._setWeights(pairs)
+
+        logger.debug("decomposition (%s) done in %.2f s." %(self.lastUpdate,time.time()-t1))
+
+        return self._topList
+
+    def _decayDaughter(self, branch, key):
+        """
+        Get the branches generated by the decays of the branch daughter
+        (see Branch.decayDaughter). The branches generated previously
+        for the same decays are reused (with their maximum weights updated).
+
+        :param branch: Branch object
+        :param key: decay chain of the branch (initial PDG and the
+                    daughter PDGs of each decay)
+        :return: list of tuples with the new branches and their decay chains.
+                 False if the daughter is stable.
+        """
+
+        if not branch.oddParticles or not branch.oddParticles[-1].decays:
+            return False
+        daughter = branch.oddParticles[-1]
+        if daughter.isStable():
+            return False
+
+        newBranches = []
+        nChannels = {}
+        decayed = False
+        for decay in daughter.decays:
+            if not decay or not decay.br:
+                continue  #Skip decay = None and zero BRs
+            ids = tuple(decay.ids)
+            nChannels[ids] = nChannels.get(ids,0) + 1
+            newKey = key + ((ids,nChannels[ids]),)
+            if not newKey in self._branches:
+                # Generate a new branch for the decay:
+                self._branches[newKey] = branch._addDecay(decay)
+                decayed = True
+            newBr = self._branches[newKey]
+            if newBr:
+                newBr.maxWeight = branch.maxWeight*decay.br
+                newBranches.append((newBr,newKey))
+        if decayed:
+            self.nDecayed += 1
+
+        if not newBranches:
+            return False
+        return newBranches
+
+    def _decayBranches(self, branchList, sigcut):
+        """
+        Decay all branches from branchList until all unstable intermediate states
+        have decayed (see branch.decayBranches).
+
+        :parameter branchList: list of tuples with the initial branches (Branch objects)
+                               and their decay chains
+        :parameter sigcut: minimum sigma*BR (in fb) to be generated
+        :returns: list of branches (Branch objects)
+        """
+
+        stableBranches,unstableBranches = [],[]
+
+        for br,key in branchList:
+            if br.maxWeight < sigcut:
+                continue
+
+            if self._decayDaughter(br,key):
+                unstableBranches.append((br,key))
+            else:
+                stableBranches.append(br)
+
+        while unstableBranches:
+            # Store branches after adding one step cascade decay
+            newBranchList = []
+            for inbranch,key in unstableBranches:
+                if sigcut > 0. and inbranch.maxWeight < sigcut:
+                    continue
+
+                #If None appear amongst the decays, add the possibility for the particle not decaying prompt
+                if any(x is None for x in inbranch.oddParticles[-1].decays):
+                    stableBranches.append(inbranch)
+
+                newBranches = self._decayDaughter(inbranch,key)
+                if newBranches:
+                    newBranchList += [(br,newKey) for br,newKey in newBranches
+                                      if br.maxWeight > sigcut]
+                elif inbranch.maxWeight > sigcut:
+                    stableBranches.append(inbranch)
+
+            unstableBranches = newBranchList
+
+        #Sort list by initial branch pdg:
+        finalBranchList = sorted(stableBranches, key=lambda branch: branch.oddParticles[0].pdg)
+
+        return finalBranchList
+
+    def _samePairs(self, pairs):
+        """
+        Check if the pairs of branches are the same (and in the same order)
+        as for the previous model.
+        """
+
+        if self._pairs is None or len(pairs) != len(self._pairs):
+            return False
+        for (pids1,_,b11,b12,_),(pids2,b21,b22) in zip(pairs,self._pairs):
+            if pids1 != pids2 or b11 is not b21 or b12 is not b22:
+                return False
+        return True
+
+    def _buildElements(self, pairs):
+        """
+        Create the elements from the pairs of branches (as in decompose).
+        """
+
+        self._resetElements()
+        self._topList = _combineBranches(pairs, self.doCompress, self.doInvisible,
+                                         self.minmassgap)
+        self._pairs = [(pids,branch1,branch2) for pids,_,branch1,branch2,_ in pairs]
+
+    def _traceElements(self, pairs):
+        """
+        Create the elements from the pairs of branches. The weights are
+        traced, so they can be computed for the actual cross sections and
+        branching ratios (see _setWeights).
+        """
+
+        self._resetElements()
+        tape = []
+        smsTopList = topology.TopologyList()
+        for ipair,(pids, weightList, branch1, branch2, finalBR) in enumerate(pairs):
+            newElement = element.Element([branch1, branch2])
+            newElement.weight = _WeightTrace(tape,('weight',ipair))
+            for ibr,branch in enumerate(newElement.branches):
+                branch.maxWeight = _WeightTrace(tape,('maxWeight',ipair,ibr))
+            newElement.sortBranches()  #Make sure elements are sorted BEFORE adding them
+            smsTopList.addElement(newElement)
+
+        smsTopList.compressElements(self.doCompress, self.doInvisible, self.minmassgap)
+        smsTopList._setElementIds()
+
+        #Collect the elements (including the merged ones appearing as ancestors)
+        #and their branches:
+        elements = {}
+        newElements = smsTopList.getElements()
+        while newElements:
+            el = newElements.pop()
+            if not id(el) in elements:
+                elements[id(el)] = el
+                newElements += el.motherElements
+        for el in elements.values():
+            self._elementTraces.append((el,el.weight.index))
+            for branch in el.branches:
+                self._branchTraces.append((branch,branch.maxWeight.index))
+
+        #The first operand of an addition can be changed in place (instead of
+        #being copied), if it is not used anywhere else:
+        uses = [0]*len(tape)
+        for operation in tape:
+            if operation[0] == 'add':
+                uses[operation[1]] += 1
+                uses[operation[2]] += 1
+        for _,index in self._elementTraces+self._branchTraces:
+            uses[index] += 1
+        self._inPlace = set([i for i,operation in enumerate(tape)
+                             if operation[0] == 'add' and uses[operation[1]] == 1])
+
+        self._pairs = [(pids,branch1,branch2) for pids,_,branch1,branch2,_ in pairs]
+        self._topList = smsTopList
+        self._tape = tape
+
+    def _setWeights(self, pairs):
+        """
+        Compute the element weights (and the maximum weights of their branches)
+        for the pairs of branches, repeating the operations of the tape.
+        """
+
+        values = []
+        for i,operation in enumerate(self._tape):
+            if operation[0] == 'weight':
+                _, weightList, _, _, finalBR = pairs[operation[1]]
+                values.append(weightList*finalBR)
+            elif operation[0] == 'maxWeight':
+                values.append(pairs[operation[1]][2+operation[2]].maxWeight)
+            else:
+                value = values[operation[1]]
+                if isinstance(value,crossSection.XSectionList):
+                    if not i in self._inPlace:
+                        value = value.copy()
+                    value += values[operation[2]]
+                else:
+                    value = value + values[operation[2]]
+                values.append(value)
+
+        used = set()
+        for el,index in self._elementTraces:
+            weight = values[index]
+            if index in used:
+                weight = weight.copy()
+            used.add(index)
+            el.weight = weight
+            #Remove the information from previous theory predictions
+            el.coveredBy = set()
+            el.testedBy = set()
+            if hasattr(el,'_totalXsec'):
+                del el._totalXsec
+        for branch,index in self._branchTraces:
+            branch.maxWeight = values[index]
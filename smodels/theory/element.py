@@ -21,6 +21,8 @@ class Element(object):
     (cross-section * BR).
     """
 
+    _signature = None #Cached canonical signature (see getSignature)
+
     def __init__(self, info=None, finalState=None, intermediateState=None, model=None):
         """
         Initializes the element. If info is defined, tries to generate
@@ -44,6 +46,7 @@ class Element(object):
         self.elID = 0
         self.coveredBy = set()
         self.testedBy = set()
+        self._txnameMatches = {} #Cache for the branch orderings matching txnames
 
         if info:
             # Create element from particle string
@@ -128,6 +131,28 @@ class Element(object):
     def __hash__(self):
         return object.__hash__(self)
 
+    def getSignature(self):
+        """
+        Get the canonical signature of the element, given by the sorted
+        tuple of branch signatures (see Branch.getSignature).
+        Elements with the same signature are equal (see __cmp__).
+        The signature is computed once and cached.
+
+        :return: tuple with the signature. None if any of the branches has no
+                 signature (inclusive branches).
+        """
+
+        if self._signature is None:
+            branchSignatures = [br.getSignature() for br in self.branches]
+            if None in branchSignatures:
+                self._signature = False
+            else:
+                self._signature = tuple(sorted(branchSignatures))
+
+        if not self._signature:
+            return None
+        return self._signature
+
     def __getattr__(self, attr):
         """
         If the attribute has not been defined for the element
@@ -203,6 +228,7 @@ class Element(object):
         elif self.getEinfo() != other.getEinfo():
             raise SModelSError("Can not add elements with distinct topologies")
 
+        self._signature = None
         self.motherElements += other.motherElements[:]
         self.weight += other.weight
         for ibr,_ in enumerate(self.branches):
@@ -487,6 +513,7 @@ class Element(object):
         """
 
         self.branches[ibr].removeVertex(iv)
+        self._signature = None
 
     def massCompress(self, minmassgap):
         """
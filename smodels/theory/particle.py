@@ -7,6 +7,30 @@
 """
 
 import itertools,weakref
+import unum
+
+def _freeze(value):
+    """
+    Convert an attribute value to a hashable object, which is used to build
+    the keys for the particle index. Objects which can not be converted
+    are represented by their identity.
+
+    :param value: attribute value
+
+    :return: hashable object
+    """
+
+    if value is None or isinstance(value,(str,int,float)):
+        return value
+    if isinstance(value,(list,tuple)):
+        return tuple([_freeze(v) for v in value])
+    if isinstance(value,dict):
+        return tuple(sorted([(k,_freeze(v)) for k,v in value.items()],
+                            key = lambda x: str(x[0])))
+    if isinstance(value,unum.Unum):
+        return (_freeze(value._value),_freeze(value._unit))
+    return (type(value).__name__,id(value))
+
 
 class Particle(object):
     """
@@ -14,13 +38,16 @@ class Particle(object):
     The properties are: label, pdg, mass, electric charge, color charge, width
     """
 
-    _instances = set()
+    _instances = weakref.WeakSet()
+    _index = weakref.WeakValueDictionary() #Maps the attribute keys to particles
     _lastID = 0
 
     def __new__(cls,attributesDict={}, **kwargs):
         """
         Creates a particle. If a particle with the exact same attributes have
         already been created return this particle instead.
+        The existing particles are looked up by their attributes using
+        the Particle._index dictionary.
         Assigns an ID to the instance using the class Particle._instance
         list. Reset the comparison dictionary.
 
@@ -45,14 +72,9 @@ class Particle(object):
         attrDict.update(kwargs)
         attrDict.pop('_id',None)
         attrDict.pop('_comp',None)
-        for obj in Particle.getinstances():
-            if not isinstance(obj,Particle):
-                continue
-            objAttr = dict(obj.__dict__.items())
-            objAttr.pop('_id',None)
-            objAttr.pop('_comp',None)
-            if objAttr != attrDict:
-                continue
+        key = cls.getKey(attrDict)
+        obj = Particle._index.get(key)
+        if obj is not None and obj.sameAttributes(attrDict):
             return obj
 
         newParticle = super(Particle, cls).__new__(cls)
@@ -60,9 +82,62 @@ class Particle(object):
             setattr(newParticle,attr,value)
         newParticle._id = Particle.getID()
         newParticle._comp = {newParticle._id : 0}
-        Particle._instances.add(weakref.ref(newParticle))
+        Particle._instances.add(newParticle)
+        Particle._index[key] = newParticle
         return newParticle
 
+    def __setattr__(self,attr,value):
+        """
+        Sets the attribute and keeps the particle index up to date,
+        if the particle has already been created.
+        """
+
+        if attr in ['_id','_comp'] or not '_id' in self.__dict__:
+            object.__setattr__(self,attr,value)
+            return
+
+        oldKey = self.getKey(self.getAttributes())
+        object.__setattr__(self,attr,value)
+        if Particle._index.get(oldKey) is self:
+            del Particle._index[oldKey]
+        Particle._index.setdefault(self.getKey(self.getAttributes()),self)
+
+    @classmethod
+    def getKey(cls,attrDict):
+        """
+        Builds the (hashable) key used to index the particle with attributes
+        given by attrDict.
+
+        :param attrDict: Dictionary with the particle attributes (without _id and _comp)
+
+        :return: tuple
+        """
+
+        return (cls.__name__,_freeze(attrDict))
+
+    def getAttributes(self):
+        """
+        Returns the particle attributes, except for its ID and comparison dict.
+
+        :return: dictionary with the attributes
+        """
+
+        attrDict = dict(self.__dict__.items())
+        attrDict.pop('_id',None)
+        attrDict.pop('_comp',None)
+        return attrDict
+
+    def sameAttributes(self,attrDict):
+        """
+        Checks if the particle attributes are equal to attrDict.
+
+        :param attrDict: Dictionary with the particle attributes (without _id and _comp)
+
+        :return: True/False
+        """
+
+        return self.getAttributes() == attrDict
+
     def __getnewargs__(self):
         """
         Required for unpickling the object.
@@ -105,20 +180,11 @@ class Particle(object):
 
     @classmethod
     def getinstances(cls):
-        dead = set()
-        instances = []
-        for ref in Particle._instances:
-            obj = ref()
-            if obj is not None:
-                instances.append(obj)
-            else:
-                dead.add(ref)
-        Particle._instances -= dead
-        return instances
+        return list(Particle._instances)
 
     @classmethod
     def getID(cls):
-        if len(Particle.getinstances()) == 0:
+        if len(Particle._instances) == 0:
             Particle._lastID = 0
         else:
             Particle._lastID += 1
@@ -250,11 +316,12 @@ class Particle(object):
         """
 
         newParticle = object.__new__(Particle)
-        for attr,value in self.__dict__.items():
-            setattr(newParticle,attr,value)
+        newParticle.__dict__.update(self.__dict__)
         newParticle._id = Particle.getID()
         newParticle._comp = {newParticle._id : 0}
-        Particle._instances.add(weakref.ref(newParticle))
+        Particle._instances.add(newParticle)
+        Particle._index.setdefault(newParticle.getKey(newParticle.getAttributes()),
+                                   newParticle)
 
         return newParticle
 
@@ -379,22 +446,9 @@ class MultiParticle(Particle):
         attrDict.update(kwargs)
         attrDict.pop('_id',None)
         attrDict.pop('_comp',None)
-        for obj in Particle.getinstances()[:]:
-            if not isinstance(obj,MultiParticle):
-                continue
-            #Directly compare attributes, except for particles,label,id and _comp
-            objAttr = dict(obj.__dict__.items())
-            objAttr.pop('_id',None)
-            objAttr.pop('_comp',None)
-            objAttr.pop('label',None)
-            objAttr.pop('particles',None)
-            if objAttr != attrDict:
-                continue
-            pListB = obj.particles
-            if len(particles) != len(pListB):
-                continue
-            if any(pA is not pListB[i] for i,pA in enumerate(particles)):
-                continue
+        key = cls.getKey(dict(attrDict,particles=particles))
+        obj = Particle._index.get(key)
+        if obj is not None and obj.sameAttributes(dict(attrDict,particles=particles)):
             return obj
 
         newMultiParticle = super(Particle, cls).__new__(cls)
@@ -405,9 +459,52 @@ class MultiParticle(Particle):
         newMultiParticle._id = Particle.getID()
         newMultiParticle._comp = {newMultiParticle._id : 0}
         newMultiParticle._comp.update(dict([[ptc._id,0] for ptc in particles]))
-        Particle._instances.add(weakref.ref(newMultiParticle))
+        Particle._instances.add(newMultiParticle)
+        Particle._index[key] = newMultiParticle
         return newMultiParticle
 
+    @classmethod
+    def getKey(cls,attrDict):
+        """
+        Builds the (hashable) key used to index the multiparticle with attributes
+        given by attrDict. The label is not included and the particles
+        are identified by their object ids.
+
+        :param attrDict: Dictionary with the multiparticle attributes (without _id and _comp)
+
+        :return: tuple
+        """
+
+        attrDict = dict(attrDict.items())
+        attrDict.pop('label',None)
+        particles = attrDict.pop('particles',[])
+        return (cls.__name__,tuple([id(p) for p in particles]),_freeze(attrDict))
+
+    def sameAttributes(self,attrDict):
+        """
+        Checks if the multiparticle attributes (except for the label)
+        are equal to attrDict and if its particles are the same objects
+        as attrDict['particles'].
+
+        :param attrDict: Dictionary with the multiparticle attributes (without _id and _comp)
+
+        :return: True/False
+        """
+
+        attrDict = dict(attrDict.items())
+        attrDict.pop('label',None)
+        particles = attrDict.pop('particles',[])
+        objAttr = self.getAttributes()
+        objAttr.pop('label',None)
+        pListB = objAttr.pop('particles',[])
+        if objAttr != attrDict:
+            return False
+        if len(particles) != len(pListB):
+            return False
+        if any(pA is not pListB[i] for i,pA in enumerate(particles)):
+            return False
+        return True
+
     def __getnewargs__(self):
         """
         Required for unpickling the object.
@@ -611,7 +708,8 @@ class ParticleList(object):
     Simple class to store a list of particles.
     """
 
-    _instances = set()
+    _instances = weakref.WeakSet()
+    _index = weakref.WeakValueDictionary() #Maps the particle ids to particle lists
     _lastID = 0
 
 
@@ -619,6 +717,8 @@ class ParticleList(object):
         """
         Creates a particle list. If a list with the exact same particles have
         already been created return this list instead.
+        The existing lists are looked up using the ParticleList._index
+        dictionary.
         Assigns an ID to the instance using the class ParticleList._instance
         list. Reset the comparison dictionary.
 
@@ -626,18 +726,18 @@ class ParticleList(object):
         """
 
         pList = sorted(particles)
-        for obj in ParticleList.getinstances():
-            if len(obj) != len(pList):
-                continue
-            if any(ptc is not obj.particles[iptc] for iptc,ptc in enumerate(pList)):
-                continue
-            return obj
+        key = tuple([id(ptc) for ptc in pList])
+        obj = ParticleList._index.get(key)
+        if obj is not None and len(obj) == len(pList):
+            if all(ptc is obj.particles[iptc] for iptc,ptc in enumerate(pList)):
+                return obj
 
         newList = super(ParticleList, cls).__new__(cls)
         newList.particles = pList[:]
         newList._id = ParticleList.getID()
         newList._comp = {newList._id : 0}
-        ParticleList._instances.add(weakref.ref(newList))
+        ParticleList._instances.add(newList)
+        ParticleList._index[key] = newList
         return newList
 
     def __getnewargs__(self):
@@ -667,20 +767,11 @@ class ParticleList(object):
 
     @classmethod
     def getinstances(cls):
-        dead = set()
-        instances = []
-        for ref in ParticleList._instances:
-            obj = ref()
-            if obj is not None:
-                instances.append(obj)
-            else:
-                dead.add(ref)
-        ParticleList._instances -= dead
-        return instances
+        return list(ParticleList._instances)
 
     @classmethod
     def getID(cls):
-        if len(ParticleList.getinstances()) == 0:
+        if len(ParticleList._instances) == 0:
             ParticleList._lastID = 0
         else:
             ParticleList._lastID += 1
@@ -14,7 +14,9 @@ from smodels.theory.exceptions import SModelSTheoryError as SModelSError
 from smodels.experiment.datasetObj import CombinedDataSet
 from smodels.tools.smodelsLogging import logger
 from smodels.tools.statistics import likelihoodFromLimits, chi2FromLimits
-import itertools
+from smodels.tools import runtime
+from smodels.theory.particle import Particle
+import itertools,multiprocessing,pickle,io
 
 class TheoryPrediction(object):
     """
@@ -398,6 +400,144 @@ def theoryPredictionsFor(expResult, smsTopList, maxMassDist=0.2,
 
     return bestResults
 
+class _SharedObjects(object):
+    """
+    Holds the objects shared by the main process and the forked processes
+    computing the theory predictions (experimental results, elements and particles).
+    The results computed in the forked processes are pickled replacing these
+    objects by their index, so only the new objects are transferred and
+    the theory predictions refer to the objects in the main process.
+    """
+
+    def __init__(self, expResults, smsTopList, kwargs):
+
+        self.expResults = expResults
+        self.smsTopList = smsTopList
+        self.kwargs = kwargs
+        self.elements = []
+        for el in smsTopList.getElements():
+            self.elements += [el] + el.getAncestors()
+        self.objects = []
+        for expResult in expResults:
+            self.objects += [expResult,expResult.globalInfo]
+            for dataset in expResult.datasets:
+                self.objects += [dataset,dataset.globalInfo,getattr(dataset,'dataInfo',None)]
+                for txname in dataset.txnameList:
+                    self.objects += [txname,txname.txnameData,txname.txnameDataExp]
+        self.objects += self.elements + Particle.getinstances()
+        self.index = {}
+        for i,obj in enumerate(self.objects):
+            if obj is not None:
+                self.index.setdefault(id(obj),i)
+
+    def dumps(self, obj):
+        """
+        Pickle obj, replacing the shared objects by their index.
+        """
+
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda x: self.index.get(id(x))
+        pickler.dump(obj)
+        return f.getvalue()
+
+    def loads(self, data):
+        """
+        Unpickle data, restoring the shared objects.
+        """
+
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = lambda i: self.objects[i]
+        return unpickler.load()
+
+_sharedObjects = None #Set by the main process before forking
+
+def _computePredictionsFor(iexp):
+    """
+    Compute the theory predictions for the iexp-th ExpResult
+    (runs in a forked process).
+
+    :parameter iexp: index of the ExpResult in the list of shared objects
+    :returns: pickled tuple with the TheoryPredictionList and the list of
+              coverage tags set for the elements
+    """
+
+    shared = _sharedObjects
+    predictions = theoryPredictionsFor(shared.expResults[iexp], shared.smsTopList,
+                                       **shared.kwargs)
+    tags = [(iel,el.coveredBy,el.testedBy) for iel,el in enumerate(shared.elements)
+            if el.coveredBy or el.testedBy]
+    return shared.dumps((predictions,tags))
+
+def theoryPredictionsForList(expResults, smsTopList, maxMassDist=0.2,
+                useBestDataset=True, combinedResults=True,
+                marginalize=False,deltas_rel=0.2,ncpus=1):
+    """
+    Compute the theory predictions for a list of experimental results
+    (see theoryPredictionsFor).
+    If ncpus > 1, the experimental results are distributed to a pool of
+    forked processes (which share the database and the decomposition
+    with the main process). Each process computes the predictions for
+    one ExpResult at a time.
+
+    :parameter expResults: list of ExpResult objects
+    :parameter smsTopList: list of topologies containing elements
+                           (TopologyList object)
+    :parameter maxMassDist: maximum mass distance for clustering elements (float)
+    :parameter useBestDataset: If True, uses only the best dataset (signal region).
+    :parameter combinedResults: add theory predictions that result from
+               combining datasets.
+    :parameter marginalize: If true, marginalize nuisances. If false, profile them.
+    :parameter deltas_rel: relative uncertainty in signal (float). Default value is 20%.
+    :parameter ncpus: number of processes (-1 means all available CPUs)
+
+    :returns: list with the TheoryPredictionList objects (or None) for each ExpResult,
+              in the same ordering
+    """
+
+    global _sharedObjects
+
+    kwargs = {'maxMassDist' : maxMassDist, 'useBestDataset' : useBestDataset,
+              'combinedResults' : combinedResults, 'marginalize' : marginalize,
+              'deltas_rel' : deltas_rel}
+
+    if ncpus == -1:
+        ncpus = runtime.nCPUs()
+    ncpus = min(ncpus,len(expResults))
+    if ncpus > 1 and multiprocessing.current_process().daemon:
+        logger.debug("Can not start processes from a daemonic process. Theory predictions will be computed serially.")
+        ncpus = 1
+    if ncpus > 1:
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            logger.warning("Forking processes is not supported. Theory predictions will be computed serially.")
+            ncpus = 1
+    if ncpus <= 1:
+        return [theoryPredictionsFor(expResult, smsTopList, **kwargs)
+                for expResult in expResults]
+
+    _sharedObjects = _SharedObjects(expResults, smsTopList, kwargs)
+    try:
+        with context.Pool(processes=ncpus) as pool:
+            children = pool.map_async(_computePredictionsFor, range(len(expResults)),
+                                      chunksize=1)
+            #Wait in short steps, so a timeout (alarm signal) can interrupt the main process
+            while not children.ready():
+                children.wait(1.)
+            outputs = children.get()
+        predictions = []
+        for output in outputs:
+            predList,tags = _sharedObjects.loads(output)
+            for iel,coveredBy,testedBy in tags:
+                _sharedObjects.elements[iel].coveredBy.update(coveredBy)
+                _sharedObjects.elements[iel].testedBy.update(testedBy)
+            predictions.append(predList)
+    finally:
+        _sharedObjects = None
+
+    return predictions
+
 def _getCombinedResultFor(dataSetResults,expResult,marginalize=False):
     """
     Compute the combined result for all datasets, if covariance
@@ -581,9 +721,8 @@ def _getElementsFrom(smsTopList, dataset):
 
     elements = []
     for txname in dataset.txnameList:
-        for top in smsTopList:
-            itop = txname._topologyList.index(top)  #Check if the topology appear in txname
-            if itop is None: continue
+        #Get the topologies appearing in txname
+        for top in smsTopList.getMatchingTopologies(txname._topologyList):
             for el in top.getElements():
                 newEl = txname.hasElementAs(el)  #Check if element appears in txname
                 if not newEl:
@@ -34,6 +34,7 @@ class Topology(object):
         self.vertnumb = []
         self.vertparts = []
         self.elementList = []
+        self._elementIndex = {} #Maps element signatures to elements in elementList
 
         if elements:
             if isinstance(elements,Element):
@@ -93,6 +94,23 @@ class Topology(object):
         else:
             return 0
 
+    def getSignature(self):
+        """
+        Get the canonical signature of the topology, given by the sorted
+        vertnumb and vertparts. Two topologies have the same signature
+        if and only if they are equal and signatures are ordered as the topologies.
+
+        :return: tuple with the signature. None if the topology is inclusive
+        """
+
+        vertnumb = sorted(self.vertnumb,reverse=True)
+        vertparts = sorted([tuple(v) for v in self.vertparts])
+        if not all(type(n) == int for n in vertnumb):
+            return None
+        if not all(type(n) == int for v in vertparts for n in v):
+            return None
+        return (tuple(vertnumb),tuple(vertparts))
+
 
     def checkConsistency(self):
         """
@@ -163,14 +181,28 @@ class Topology(object):
             logger.warning('Element to be added does not match topology')
             return False
 
-        index = index_bisect(self.elementList,newelement)
-        if index != len(self.elementList) and self.elementList[index] == newelement:
-            self.elementList[index] += newelement
-        else:
-            self.elementList.insert(index,newelement)
+        #Look for an element with the same signature, otherwise
+        #fall back to the full comparison (required for distinct particles
+        #with equal properties, MultiParticles and inclusive elements)
+        signature = newelement.getSignature()
+        match = None
+        if signature is not None:
+            match = self._elementIndex.get(signature)
+        if match is None:
+            index = index_bisect(self.elementList,newelement)
+            if index != len(self.elementList) and self.elementList[index] == newelement:
+                match = self.elementList[index]
+            else:
+                self.elementList.insert(index,newelement)
+                if signature is not None:
+                    self._elementIndex[signature] = newelement
+                return True
 
-        return True
+        match += newelement
+        if signature is not None:
+            self._elementIndex.setdefault(signature,match)
 
+        return True
 
 
     def _getTinfo(self):
@@ -209,6 +241,8 @@ class TopologyList(object):
         """
 
         self.topos = []
+        self._topoIndex = {} #Maps topology signatures to topologies in topos
+        self._nUnsigned = 0 #Number of topologies without signature
         for topo in topologies:
             self.add(topo)
 
@@ -241,6 +275,32 @@ class TopologyList(object):
 
     def insert(self,index,topo):
         self.topos.insert(index,topo)
+        signature = topo.getSignature()
+        if signature is None:
+            self._nUnsigned += 1
+        else:
+            self._topoIndex.setdefault(signature,topo)
+
+    def _findTopology(self,topo):
+        """
+        Find the topology in the list matching topo.
+        The topology signatures are used, unless the topologies are inclusive.
+
+        :param topo: Topology object
+        :return: tuple with the matching topology (None if there is no match)
+                 and the index where topo should be inserted (None if there is a match)
+        """
+
+        signature = topo.getSignature()
+        if signature is not None and not self._nUnsigned:
+            match = self._topoIndex.get(signature)
+            if match is not None:
+                return match,None
+
+        index = index_bisect(self, topo)
+        if index != len(self) and self[index] == topo:
+            return self[index],None
+        return None,index
 
 
     def addList(self, topoList):
@@ -279,6 +339,24 @@ class TopologyList(object):
         return None
 
 
+    def getMatchingTopologies(self,topoList):
+        """
+        Get the topologies in self which also appear in topoList.
+        If the topologies are not inclusive, the matches are found through
+        the topology signatures, otherwise each topology is looked up in topoList.
+
+        :param topoList: TopologyList object
+        :return: list of Topology objects (in the same ordering as in self)
+        """
+
+        otherIndex = getattr(topoList,'_topoIndex',None)
+        if otherIndex is None or self._nUnsigned or topoList._nUnsigned:
+            return [top for top in self if topoList.index(top) is not None]
+
+        matches = [self._topoIndex[sig] for sig in otherIndex if sig in self._topoIndex]
+        #Topologies are ordered as their signatures:
+        return sorted(matches, key = lambda top: top.getSignature())
+
     def hasTopology(self,topo):
         """
         Checks if topo appears in any of the topologies in the list.
@@ -306,10 +384,10 @@ class TopologyList(object):
 
         """
 
-        index = index_bisect(self, newTopology)
-        if index != len(self) and self[index] == newTopology:
+        match,index = self._findTopology(newTopology)
+        if match is not None:
             for newelement in newTopology.elementList:
-                self.topos[index].addElement(newelement)
+                match.addElement(newelement)
         else:
             self.insert(index,newTopology)
 
@@ -327,17 +405,13 @@ class TopologyList(object):
 
         #First create a dummy topology from the element to check
         #if this topology already exists in the list:
-        elInfo = newelement.getEinfo()
-        topoDummy = Topology()
-        topoDummy.elementList.append(newelement)
-        topoDummy.vertnumb = elInfo["vertnumb"]
-        topoDummy.vertparts = elInfo["vertparts"]
-
-        index = index_bisect(self,topoDummy)
-        if index != len(self) and self.topos[index] == topoDummy:
-            self.topos[index].addElement(newelement)
+        topoDummy = Topology(newelement)
+
+        match,index = self._findTopology(topoDummy)
+        if match is not None:
+            match.addElement(newelement)
         else:
-            self.topos.insert(index,topoDummy)
+            self.insert(index,topoDummy)
 
 
     def getTotalWeight(self):
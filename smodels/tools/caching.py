@@ -7,85 +7,175 @@
 
 """
 
-from functools import wraps                                                           
+import weakref
+from functools import wraps
+from collections import OrderedDict
 from smodels.tools.physicsUnits import pb, GeV, fb, IncompatibleUnitsError
 
-def _toString ( arg ):
+def _toKey ( arg, objects = None ):
+    """
+    Build a hashable key from arg. Numbers (with or without units)
+    are rounded, lists are converted to tuples.
+
+    :param objects: if a list is given, the objects that are keyed by
+                    their id are appended to it
+    """
     try:
-        return "%.2f" % arg.asNumber(fb)
+        return ( "fb", round ( arg.asNumber(fb), 2 ) )
     except (AttributeError,IncompatibleUnitsError) as e:
         pass
     try:
-        return "%.3f" % arg.asNumber(GeV)
+        return ( "GeV", round ( arg.asNumber(GeV), 3 ) )
     except (AttributeError,IncompatibleUnitsError) as e:
         pass
     try:
-        return "%.2f" % arg.asNumber(1/fb)
+        return ( "1/fb", round ( arg.asNumber(1/fb), 2 ) )
     except (AttributeError,IncompatibleUnitsError) as e:
         pass
-    if type(arg) == float:
-        return "%.2f" % arg
-    if type(arg) == int:
-        return "%d" % arg
-    if type(arg) == str:
-        return "%s" % arg
+    if isinstance(arg,float):
+        return round ( float(arg), 2 )
+    if isinstance(arg,(int,str)):
+        return arg
     if type(arg) in [ list, tuple ]:
-        argstring=""
-        for newarg in arg:
-            argstring += _toString ( newarg ) + " "
-        argstring=argstring[:-1]
-        return argstring
-    return "%s" % ( str(arg) )
-    
+        return tuple ( [ _toKey ( newarg, objects ) for newarg in arg ] )
+    ## e.g. observed and expected data share the same string identifier,
+    ## so we also need the object id
+    if objects is not None:
+        objects.append ( arg )
+    return ( "%s" % ( str(arg) ), id(arg) )
+
+def _ref ( obj ):
+    """
+    Reference to obj for checking that a cache entry is not stale.
+    Objects that cannot be weakly referenced are held, so their id
+    cannot be reused while the entry is in the cache.
+    """
+    try:
+        return weakref.ref ( obj )
+    except TypeError:
+        return lambda: obj
+
 class Cache:
-    """ a class for storing results from interpolation """
-    _cache = {}
-    _cache_order=[]
-    n_stored = 1000 ## number of interpolations we keep per result
+    """ a least-recently-used cache for storing results from interpolation """
+    _cache = OrderedDict()
+    _stats = {} ## hits, misses and evictions per function
+    _missing = object() ## marker for keys not in the cache
+    n_stored = 1000 ## number of interpolations we keep
 
     @staticmethod
     def size():
-        return len(Cache._cache_order)
+        return len(Cache._cache)
+
+    @staticmethod
+    def _getStats ( name ):
+        if not name in Cache._stats:
+            Cache._stats[name] = { "hits": 0, "misses": 0, "evictions": 0 }
+        return Cache._stats[name]
 
     @staticmethod
     def _clear_garbage ():
         """
-        every once in a while we clear the garbage, i.e. 
-        discard half of the cached interpolations
+        discard the least recently used entries, if we have more
+        than n_stored
         """
-        if len(Cache._cache_order)<Cache.n_stored:
-            return
-        ns2 = int ( Cache.n_stored / 2 )
-        for i in range ( ns2 ):
-            Cache._cache.pop ( Cache._cache_order[i] ) ## remove 
-        Cache._cache_order=Cache._cache_order[ ns2 : ]
+        while len(Cache._cache) > Cache.n_stored:
+            key,_ = Cache._cache.popitem ( last=False ) ## remove
+            Cache._getStats ( key[0] )["evictions"] += 1
 
     @staticmethod
     def reset ():
-        """ completely reset the cache """
-        Cache._cache = {}
-        Cache._cache_order = []
+        """ completely reset the cache (and the statistics) """
+        Cache._cache = OrderedDict()
+        Cache._stats = {}
 
     @staticmethod
-    def add ( key, value ):
-        if key in Cache._cache_order:
-            return value
-        Cache._cache_order.append ( key )
-        Cache._cache[key] = value
+    def resetStatistics ():
+        """ reset the statistics, but keep the cached values """
+        Cache._stats = {}
+
+    @staticmethod
+    def get ( key ):
+        """
+        Look up key in the cache. The key is a tuple (function name, arguments).
+        Returns Cache._missing if key is not in the cache, or if an object
+        that is keyed by its id has been garbage collected (its id may since
+        have been reused by another object).
+        """
+        stats = Cache._getStats ( key[0] )
+        if not key in Cache._cache:
+            stats["misses"] += 1
+            return Cache._missing
+        value,refs = Cache._cache[key]
+        if any ( [ ref() is None for ref in refs ] ):
+            del Cache._cache[key]
+            stats["misses"] += 1
+            return Cache._missing
+        stats["hits"] += 1
+        Cache._cache.move_to_end ( key )
+        return value
+
+    @staticmethod
+    def add ( key, value, objects = () ):
+        """
+        Store value under key.
+
+        :param objects: the objects keyed by their id (see _toKey), the entry
+                        is dropped once one of them has been garbage collected
+        """
+        Cache._cache[key] = ( value, tuple ( [ _ref ( o ) for o in objects ] ) )
+        Cache._cache.move_to_end ( key )
         Cache._clear_garbage()
         return value
 
+    @staticmethod
+    def statistics ():
+        """
+        :returns: dictionary with the number of hits, misses and evictions
+                  per memoized function, in this process (see addStatistics)
+        """
+        return dict ( [ ( name, dict(stats) ) for name,stats in Cache._stats.items() ] )
+
+    @staticmethod
+    def addStatistics ( statistics ):
+        """
+        Add the statistics collected in another process (e.g. a worker
+        of a multiprocessing pool) to the statistics of this process.
+
+        :param statistics: dictionary, as returned by Cache.statistics()
+        """
+        for name,stats in statistics.items():
+            total = Cache._getStats ( name )
+            for k,v in stats.items():
+                total[k] += v
+
+    @staticmethod
+    def report ():
+        """
+        :returns: string with the cache statistics, one line per function.
+                  The number of entries refers to the cache of this process.
+        """
+        lines = [ "cache statistics (%d/%d entries):" % ( Cache.size(), Cache.n_stored ) ]
+        for name,stats in sorted ( Cache._stats.items() ):
+            lines.append ( "  %s: %d hits, %d misses, %d evictions" % \
+                    ( name, stats["hits"], stats["misses"], stats["evictions"] ) )
+        return "\n".join ( lines )
+
 def _memoize(func):
     """
     Serves as a wrapper to cache the results of func, since this is a
     computationally expensive function.
-    
+
     """
+    name = func.__qualname__
     @wraps(func)
     def _wrap(*args):
         """
         Wrapper for the function to be memoized
-        """ 
-        argstring = _toString ( args )
-        return Cache.add ( argstring, func(*args) )
+        """
+        objects = []
+        key = ( name, _toKey ( args, objects ) )
+        value = Cache.get ( key )
+        if value is not Cache._missing:
+            return value
+        return Cache.add ( key, func(*args), objects )
     return _wrap
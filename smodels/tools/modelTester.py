@@ -11,19 +11,21 @@
 """
 
 from smodels.tools import ioObjects
-from smodels.tools import coverage, runtime
+from smodels.tools import coverage, runtime, ulCache
 from smodels.theory import decomposer
 from smodels.theory import theoryPrediction
 from smodels.share.models.SMparticles import SMList
 from smodels.theory.model import Model
-from smodels.theory.theoryPrediction import theoryPredictionsFor
+from smodels.theory.theoryPrediction import theoryPredictionsForList
 from smodels.theory.exceptions import SModelSTheoryError as SModelSError
 from smodels.tools import crashReport, timeOut
 from smodels.tools.printer import MPrinter
+from smodels.tools.caching import Cache
 import multiprocessing
 import os
 import sys
 import time,gc
+import json
 try:
     from ConfigParser import SafeConfigParser,NoSectionError,NoOptionError
 except ImportError as e:
@@ -31,6 +33,7 @@ except ImportError as e:
 from smodels.tools.physicsUnits import GeV, fb, TeV
 from smodels.experiment.exceptions import DatabaseNotFoundException
 from smodels.experiment.databaseObj import Database, ExpResultList
+from smodels.experiment import sharedArrays
 from smodels.tools.smodelsLogging import logger
 import logging
 
@@ -136,10 +139,13 @@ def testPoint(inputFile, outputDir, parser, databaseVersion, listOfExpRes):
         combineResults = parser.getboolean("options","combineSRs")
     except (NoSectionError,NoOptionError) as e:
         pass
-    for expResult in listOfExpRes:
-        theorypredictions = theoryPredictionsFor(expResult, smstoplist,
-                    useBestDataset=True, combinedResults=combineResults,
-                    marginalize=False)
+    ncpusPredictions = 1
+    if parser.has_option("parameters","ncpusPredictions"):
+        ncpusPredictions = parser.getint("parameters","ncpusPredictions")
+    predictionsList = theoryPredictionsForList(list(listOfExpRes), smstoplist,
+                useBestDataset=True, combinedResults=combineResults,
+                marginalize=False, ncpus=ncpusPredictions)
+    for theorypredictions in predictionsList:
         if not theorypredictions:
             continue
         allPredictions += theorypredictions._theoryPredictions
@@ -202,7 +208,7 @@ def runSingleFile(inputFile, outputDir, parser, databaseVersion, listOfExpRes,
     return None
 
 def runSetOfFiles(inputFiles, outputDir, parser, databaseVersion, listOfExpRes,
-                    timeout, development, parameterFile):
+                    timeout, development, parameterFile, runtimes=None):
     """
     Loop over all input files in inputFiles with testPoint
 
@@ -213,15 +219,138 @@ def runSetOfFiles(inputFiles, outputDir, parser, databaseVersion, listOfExpRes,
     :parameter listOfExpRes: list of ExpResult objects to be considered
     :parameter development: turn on development mode (e.g. no crash report)
     :parameter parameterFile: parameter file, for crash reports
+    :parameter runtimes: if a dictionary is given, the running time (in seconds)
+                         of each input file is stored in it
     :returns: printers output
     """
 
     for inputFile in inputFiles:
+        t0 = time.time()
         runSingleFile(inputFile, outputDir, parser, databaseVersion,
                                   listOfExpRes, timeout, development, parameterFile)
         gc.collect()
+        if runtimes is not None:
+            runtimes[inputFile] = time.time()-t0
     return None
 
+_workerArgs = None ## arguments of runSingleFile shared by all tasks of a worker
+
+def _initWorker(*args):
+    """ store the arguments common to all input files in the worker process """
+    global _workerArgs
+    _workerArgs = args
+
+def _runFileTask(inputFile):
+    """
+    Run a single input file in a worker process.
+
+    :param inputFile: path to input file
+    :returns: tuple with the input file, its running time (in seconds),
+              False if the run raised an exception (True otherwise)
+              and the interpolation cache statistics of this input file
+    """
+
+    runtimes = {}
+    t0 = time.time()
+    Cache.resetStatistics()
+    try:
+        runSetOfFiles([inputFile], *_workerArgs, runtimes=runtimes)
+    except Exception as e:
+        logger.error("Running %s failed: %s" % (inputFile, e))
+        return inputFile, time.time()-t0, False, Cache.statistics()
+    return inputFile, runtimes[inputFile], True, Cache.statistics()
+
+def _readRuntimes(runtimesFile):
+    """
+    Read the running times of previous runs.
+
+    :param runtimesFile: path to the file storing the running times
+    :returns: dictionary with the file names (relative to the input directory)
+              as keys and the running times (in seconds) as values
+    """
+
+    if not runtimesFile or not os.path.isfile(runtimesFile):
+        return {}
+    try:
+        with open(runtimesFile) as f:
+            return dict([(str(k),float(v)) for k,v in json.load(f).items()])
+    except (ValueError,AttributeError,OSError) as e:
+        logger.warning("Could not read running times from %s: %s" % (runtimesFile, e))
+        return {}
+
+def _writeRuntimes(runtimesFile, runtimes, inDir):
+    """
+    Update the file storing the running times with the new running times.
+
+    :param runtimesFile: path to the file storing the running times
+    :param runtimes: dictionary with the input files and the running times (in seconds)
+    :param inDir: path to directory where input files are stored
+    """
+
+    if not runtimesFile:
+        return
+    allRuntimes = _readRuntimes(runtimesFile)
+    for inputFile,dt in runtimes.items():
+        allRuntimes[os.path.relpath(inputFile,inDir)] = round(dt,3)
+    try:
+        with open(runtimesFile,'w') as f:
+            json.dump(allRuntimes, f, indent=0, sort_keys=True)
+    except OSError as e:
+        logger.warning("Could not write running times to %s: %s" % (runtimesFile, e))
+
+def _sortFiles(fileList, inDir, pastRuntimes=None):
+    """
+    Sort the input files by their expected running time (longest first).
+    The running time is taken from previous runs (if available), otherwise it
+    is estimated from the file size (using the average running time per byte
+    of the files with known running times).
+
+    :param fileList: list of input files
+    :param inDir: path to directory where input files are stored
+    :param pastRuntimes: dictionary with the file names (relative to inDir) and
+                         the running times of previous runs
+    :returns: sorted list of input files
+    """
+
+    if not pastRuntimes:
+        pastRuntimes = {}
+    sizes = dict([(f,max(1,os.path.getsize(f))) for f in fileList])
+    names = dict([(f,os.path.relpath(f,inDir)) for f in fileList])
+    known = [f for f in fileList if names[f] in pastRuntimes]
+    rate = 1.
+    if known:
+        rate = sum([pastRuntimes[names[f]] for f in known])
+        rate = rate/float(sum([sizes[f] for f in known]))
+    def expectedTime(f):
+        return pastRuntimes.get(names[f],sizes[f]*rate)
+    return sorted(fileList, key=expectedTime, reverse=True)
+
+def _runtimesReport(runtimes, failed, tTotal, ncpus):
+    """
+    Build the progress/throughput report at the end of a run.
+
+    :param runtimes: dictionary with the input files and the running times (in seconds)
+    :param failed: list of input files whose run raised an exception
+    :param tTotal: total (wall) time (in seconds)
+    :param ncpus: number of processes used
+    :returns: string with the report
+    """
+
+    nFiles = len(runtimes)
+    if nFiles == 0:
+        return "No files processed."
+    tCPU = sum(runtimes.values())
+    slowest = max(runtimes, key=runtimes.get)
+    lines = ["Processed %i files with %i process(es) in %3.2f min (%1.2f files/min)"
+             % (nFiles, ncpus, tTotal/60., 60.*nFiles/max(tTotal,1e-6))]
+    lines.append("  time per file: %1.2f s (mean), %1.2f s (max, %s)"
+                 % (tCPU/nFiles, runtimes[slowest], os.path.basename(slowest)))
+    lines.append("  load balance: %3.1f%% of %i processes busy"
+                 % (100.*tCPU/max(ncpus*tTotal,1e-6), ncpus))
+    if failed:
+        lines.append("  %i file(s) failed: %s" % (len(failed),
+                     ", ".join([os.path.basename(f) for f in failed])))
+    return "\n".join(lines)
 
 def _cleanList(fileList, inDir):
     """ clean up list of files """
@@ -251,6 +380,47 @@ def _determineNCPus(cpus_wanted, n_files):
     ncpus = min(n_files, ncpus)
     return ncpus
 
+def _shareArrays(parser, listOfExpRes):
+    """
+    Move the numerical arrays of the experimental results to shared memory,
+    if requested in the parameter file ([database] sharedArrays).
+
+    :param parser: ConfigParser storing information from parameter.ini file
+    :param listOfExpRes: list of ExpResult objects to be considered
+    """
+
+    if not parser.has_option("database","sharedArrays") or \
+            not parser.getboolean("database","sharedArrays"):
+        return
+    filename = None
+    if parser.has_option("database","sharedArraysFile"):
+        filename = parser.get("database","sharedArraysFile")
+    sharedArrays.shareArrays(listOfExpRes,filename)
+
+def _openUlCache(parser, databaseVersion):
+    """
+    Open the persistent cache of the combined upper limits, if requested
+    in the parameter file ([parameters] ulCache).
+
+    :param parser: ConfigParser storing information from parameter.ini file
+    :param databaseVersion: database version (part of the keys of the cache)
+    """
+
+    if not parser.has_option("parameters","ulCache") or \
+            not parser.getboolean("parameters","ulCache"):
+        ulCache.setCache(None)
+        return
+    filename = None
+    if parser.has_option("parameters","ulCacheFile"):
+        filename = parser.get("parameters","ulCacheFile")
+    maxEntries = 100000
+    if parser.has_option("parameters","ulCacheMaxEntries"):
+        maxEntries = parser.getint("parameters","ulCacheMaxEntries")
+    cache = ulCache.UpperLimitCache(filename, maxEntries=maxEntries,
+                                    databaseVersion=databaseVersion)
+    logger.info("Using the upper limit cache %s" %cache.filename)
+    ulCache.setCache(cache)
+
 def testPoints(fileList, inDir, outputDir, parser, databaseVersion,
                  listOfExpRes, timeout, development, parameterFile):
     """
@@ -281,7 +451,12 @@ def testPoints(fileList, inDir, outputDir, parser, databaseVersion,
     if nFiles == 0:
         logger.error("No valid input files found")
         return None
-    elif nFiles == 1:
+    _openUlCache(parser, databaseVersion)
+    if parser.has_option("parameters","ncpusPredictions") and \
+            parser.getint("parameters","ncpusPredictions") != 1:
+        _shareArrays(parser, listOfExpRes)
+
+    if nFiles == 1:
         logger.info("Running SModelS for a single file")
         runSingleFile(cleanedList[0], outputDir, parser,
                         databaseVersion, listOfExpRes, timeout,
@@ -292,6 +467,19 @@ def testPoints(fileList, inDir, outputDir, parser, databaseVersion,
         fileLog = logging.FileHandler('./smodels.log')
         logger.addHandler(fileLog)
 
+        runtimesFile = None
+        if parser.has_option("parameters","runtimesFile"):
+            runtimesFile = parser.get("parameters","runtimesFile")
+        longestFirst = False
+        if parser.has_option("parameters","longestFirst"):
+            longestFirst = parser.getboolean("parameters","longestFirst")
+        if longestFirst:
+            cleanedList = _sortFiles(cleanedList,inDir,_readRuntimes(runtimesFile))
+        runtimes,failed = {},[]
+
+        if ncpus > 1:
+            _shareArrays(parser, listOfExpRes)
+
         if ncpus == 1:
             logger.info("Running SModelS for %i files with a single process. Messages will be redirected to smodels.log"
                     %(nFiles))
@@ -299,37 +487,48 @@ def testPoints(fileList, inDir, outputDir, parser, databaseVersion,
             ### Run a single process:
             runSetOfFiles(cleanedList,outputDir, parser,
                               databaseVersion, listOfExpRes, timeout,
-                              development, parameterFile)
+                              development, parameterFile, runtimes=runtimes)
         else:
             logger.info("Running SModelS for %i files with %i processes. Messages will be redirected to smodels.log"
                     %(nFiles,ncpus))
             ### Launch multiple processes.
-            ### Split list of files
-            chunkedFiles = [cleanedList[x::ncpus] for x in range(ncpus)]
-            pool = multiprocessing.Pool(processes=ncpus)
-            children = []
-            for chunkFile in chunkedFiles:
-                p = pool.apply_async(runSetOfFiles, args=(chunkFile, outputDir, parser,
-                                                          databaseVersion, listOfExpRes, timeout,
-                                                      development, parameterFile,))
-                children.append(p)
-            pool.close()
+            ### Each file is a separate task, so idle processes
+            ### pick up the next file in the list
+            maxTasksPerChild = None
+            if parser.has_option("parameters","maxTasksPerChild"):
+                maxTasksPerChild = parser.getint("parameters","maxTasksPerChild")
+                if maxTasksPerChild <= 0:
+                    maxTasksPerChild = None
+            pool = multiprocessing.Pool(processes=ncpus, initializer=_initWorker,
+                                        initargs=(outputDir, parser, databaseVersion,
+                                                  listOfExpRes, timeout, development,
+                                                  parameterFile),
+                                        maxtasksperchild=maxTasksPerChild)
             iprint, nprint = 5,5 #Define when to start printing and the percentage step
-            #Check process progress until they are all finished
-            while True:
-                done = sum([p.ready() for p in children])
-                fracDone = 100*float(done)/len(children)
+            #Check progress as the files are done
+            for inputFile,dt,success,stats in pool.imap_unordered(_runFileTask,
+                                                             cleanedList, chunksize=1):
+                runtimes[inputFile] = dt
+                Cache.addStatistics(stats)
+                if not success:
+                    failed.append(inputFile)
+                fracDone = 100*float(len(runtimes))/nFiles
                 if fracDone >= iprint:
                     while fracDone >= iprint:
                         iprint += nprint
-                    logger.info('%i%% of processes done in %1.2f min' %(iprint-nprint,(time.time()-t0)/60.))
-                if done == len(children):
-                    break
-                time.sleep(2)
+                    logger.info('%i%% of files done in %1.2f min' %(iprint-nprint,(time.time()-t0)/60.))
+            pool.close()
+            pool.join()
 
             logger.debug("All children terminated")
 
+        logger.info(_runtimesReport(runtimes, failed, time.time()-t0, ncpus))
+        _writeRuntimes(runtimesFile, runtimes, inDir)
+
     logger.info("Done in %3.2f min"%((time.time()-t0)/60.))
+    logger.debug(Cache.report())
+    if ulCache.getCache() is not None:
+        logger.debug(ulCache.getCache().report())
 
     return None
 
@@ -367,12 +566,16 @@ def loadDatabase(parser, db):
                 discard_zeroes = parser.getboolean("database", "discardZeroes")
             except (NoSectionError,NoOptionError) as e:
                 logger.debug("database:discardZeroes is not given in config file. Defaulting to 'True'.")
+            lazyLoading = False
+            if parser.has_option("database","lazyLoading"):
+                lazyLoading = parser.getboolean("database","lazyLoading")
             force_load=None
             if database == True: force_load="txt"
             if os.path.isfile(databasePath):
                 force_load="pcl"
             database = Database(databasePath, force_load=force_load, \
-                                 discard_zeroes = discard_zeroes)
+                                 discard_zeroes = discard_zeroes,
+                                 lazyLoading = lazyLoading)
         databaseVersion = database.databaseVersion
     except DatabaseNotFoundException:
         logger.error("Database not found in ``%s''" % os.path.realpath(databasePath))
@@ -440,6 +643,7 @@ def getParameters(parameterFile):
         logger.error("No such file or directory: '%s'" % parameterFile)
         sys.exit()
     setExperimentalFlag ( parser )
+    setPyhfOptions ( parser )
     try:
         from smodels.tools import runtime
         runtime.modelFile = parser.get("particles","model" )
@@ -453,6 +657,14 @@ def setExperimentalFlag ( parser ):
         if parser.getboolean("options", "experimental"):
             runtime._experimental = True
 
+def setPyhfOptions ( parser ):
+    """ set the number of workers (parameters:ncpusPyhf) and the pool type
+    (parameters:pyhfThreads) for the independent fits of the pyhf workspaces """
+    if parser.has_option("parameters", "ncpusPyhf"):
+        runtime._ncpusPyhf = parser.getint("parameters", "ncpusPyhf")
+    if parser.has_option("parameters", "pyhfThreads"):
+        runtime._pyhfThreads = parser.getboolean("parameters", "pyhfThreads")
+
 def getAllInputFiles(inFile):
     """
     Given inFile, return list of all input files
@@ -720,7 +720,7 @@ class PyPrinter(BasicPrinter):
         for key,val in obj.parameters.items():
             try:
                 infoDict[key] = eval(val)
-            except (NameError,TypeError):
+            except (NameError,TypeError,SyntaxError):
                 infoDict[key] = val
         infoDict['file status'] = obj.filestatus
         infoDict['decomposition status'] = obj.status
@@ -46,7 +46,10 @@ except pyhf.exceptions.ImportBackendError as e:
 
 from scipy import optimize
 import numpy as np
+import multiprocessing,threading,contextlib
+from multiprocessing.pool import ThreadPool
 from smodels.tools.smodelsLogging import logger
+from smodels.tools import runtime
 
 def getLogger():
     """
@@ -67,18 +70,38 @@ def getLogger():
 
 #logger=getLogger()
 
+_sharedFits = None #Set by the main process before forking (see ulSigmas)
+
+def _ulSigmaFor(workspace_index):
+    """
+    Compute the upper limit for a single workspace with a new
+    PyhfUpperLimitComputer (runs in a forked process or in a thread).
+
+    :param workspace_index: index of the workspace
+    :return: the upper limit on the signal strength modifier
+    """
+    data, cl, expected = _sharedFits
+    computer = PyhfUpperLimitComputer(data, cl)
+    return computer.ulSigma(expected=expected, workspace_index=workspace_index)
+
 class PyhfData:
     """
     Holds data for use in pyhf
     :ivar nsignals: signal predictions list divided into sublists, one for each json file
     :ivar inputJsons: list of json instances
     :ivar nWS: number of workspaces = number of json files
+    :ivar workspaces: patched workspaces (created once by `PyhfUpperLimitComputer`)
+    :ivar models: dictionary with the pyhf models (and data) of the workspaces,
+                  built once for each workspace index
     """
     def __init__ (self, nsignals, inputJsons):
         self.nsignals = nsignals # fb
         self.inputJsons = inputJsons
         self.nWS = len(inputJsons)
         self.errorFlag = False
+        self.patches = None
+        self.workspaces = None
+        self.models = {}
         self.getWSInfo()
         self.checkConsistency()
 
@@ -170,8 +193,14 @@ class PyhfUpperLimitComputer:
         self.channelsInfo = self.data.channelsInfo
         self.zeroSignalsFlag = self.data.zeroSignalsFlag
         self.nWS = self.data.nWS
-        self.patches = self.patchMaker()
-        self.workspaces = self.wsMaker()
+        if self.data.workspaces is None:
+            # The patched workspaces only depend on the (unscaled) signals,
+            # so they are built once for each PyhfData object
+            self.patches = self.patchMaker()
+            self.data.patches = self.patches
+            self.data.workspaces = self.wsMaker()
+        self.patches = self.data.patches
+        self.workspaces = self.data.workspaces
         self.cl = cl
         self.scale = 1.
         self.alreadyBeenThere = False # boolean to detect wether self.signals has returned to an older value
@@ -192,9 +221,9 @@ class PyhfUpperLimitComputer:
 
     def rescale(self, factor):
         """
-        Rescales the signal predictions (self.nsignals) and processes again the patches and workspaces
-
-        :return: updated list of patches and workspaces (self.patches and self.workspaces)
+        Rescales the signal predictions (self.nsignals). The workspaces are not
+        patched again: the scale is applied to the signal strength instead
+        (see ulSigma).
         """
         self.nsignals = [[sig*factor for sig in ws] for ws in self.nsignals]
         try:
@@ -203,8 +232,6 @@ class PyhfUpperLimitComputer:
             pass
         self.scale *= factor
         logger.debug('new signal scale : {}'.format(self.scale))
-        self.patches = self.patchMaker()
-        self.workspaces = self.wsMaker()
         try:
             self.nsignals_2 = self.nsignals_1.copy() # nsignals at previous-to-previous loop
         except AttributeError:
@@ -270,26 +297,38 @@ class PyhfUpperLimitComputer:
                 workspaces.append(ws)
             return workspaces
 
+    def getModel(self, workspace_index=0):
+        """
+        Get the pyhf model and the data of a workspace. The model is only built
+        once for each workspace and then stored in self.data.models.
+
+        :param workspace_index: index of the workspace
+        :return: the pyhf model and the data (observations and auxiliary data)
+        """
+        if not workspace_index in self.data.models:
+            workspace = self.workspaces[workspace_index]
+            # Same modifiers_settings as those used when running the 'pyhf cls' command line
+            msettings = {'normsys': {'interpcode': 'code4'}, 'histosys': {'interpcode': 'code4p'}}
+            model = workspace.model(modifier_settings=msettings)
+            self.data.models[workspace_index] = (model, workspace.data(model))
+        return self.data.models[workspace_index]
+
     def likelihood(self, workspace_index=None):
         """
         Returns the value of the likelihood.
         Inspired by the `pyhf.infer.mle` module but for non-log likelihood
         """
         logger.debug("Calling likelihood")
-        self.__init__(self.data)
         if self.nWS == 1:
-            workspace = self.workspaces[0]
+            workspace_index = 0
         elif workspace_index != None:
             if self.zeroSignalsFlag[workspace_index] == True:
                 logger.warning("Workspace number %d has zero signals" % workspace_index)
                 return None
-            else:
-                workspace = self.workspaces[workspace_index]
-        # Same modifiers_settings as those used when running the 'pyhf cls' command line
-        msettings = {'normsys': {'interpcode': 'code4'}, 'histosys': {'interpcode': 'code4p'}}
-        model = workspace.model(modifier_settings=msettings)
+        # The cached models hold the unscaled signals
+        model, data = self.getModel(workspace_index)
         test_poi = 1.
-        _, nllh = pyhf.infer.mle.fixed_poi_fit(test_poi, workspace.data(model), model, return_fitted_val=True)
+        _, nllh = pyhf.infer.mle.fixed_poi_fit(test_poi, data, model, return_fitted_val=True)
         ret = nllh.tolist()
         try:
             ret = float(ret)
@@ -301,43 +340,18 @@ class PyhfUpperLimitComputer:
         """
         Returns the chi square
         """
-        self.__init__(self.data)
         logger.debug("Calling chi2")
         if self.nWS == 1:
-            workspace = self.workspaces[0]
+            workspace_index = 0
         elif workspace_index != None:
             if self.zeroSignalsFlag[workspace_index] == True:
                 logger.warning("Workspace number %d has zero signals" % workspace_index)
                 return None
-            else:
-                workspace = self.workspaces[workspace_index]
-        # Same modifiers_settings as those used when running the 'pyhf cls' command line
-        msettings = {'normsys': {'interpcode': 'code4'}, 'histosys': {'interpcode': 'code4p'}}
-        model = workspace.model(modifier_settings=msettings)
-        _, nllh = pyhf.infer.mle.fit(workspace.data(model), model, return_fitted_val=True)
-        logger.debug(workspace['channels'][0]['samples'][0])
+        # Both fits use the cached model and data, the workspace is not modified
+        model, data = self.getModel(workspace_index)
+        _, nllh = pyhf.infer.mle.fit(data, model, return_fitted_val=True)
         logger.debug('nllh : {}'.format(nllh))
-        # Computing the background numbers and fetching the observations
-        for ch in workspace['channels']:
-            chName = ch['name']
-            # Backgrounds
-            for sp in ch['samples']:
-                if sp['name'] != 'bsm':
-                    try:
-                        bkg = [b + d for b, d in zip(bkg, sp['data'])]
-                    except NameError: # If bkg doesn't exit, intialize it
-                        bkg = sp['data']
-            # Observations
-            for observation in workspace['observations']:
-                if observation['name'] == chName:
-                    obs = observation['data']
-            dn = [ob - bk for ob, bk in zip(obs, bkg)]
-            # Feeding dn as signal input
-            for sp in ch['samples']:
-                if sp['name'] == 'bsm':
-                    sp['data'] = dn
-        logger.debug(workspace['channels'][0]['samples'][0])
-        _, maxNllh = pyhf.infer.mle.fixed_poi_fit(1., workspace.data(model), model, return_fitted_val=True)
+        _, maxNllh = pyhf.infer.mle.fixed_poi_fit(1., data, model, return_fitted_val=True)
         logger.debug('maxNllh : {}'.format(maxNllh))
         ret = (maxNllh - nllh).tolist()
         try:
@@ -376,28 +390,36 @@ class PyhfUpperLimitComputer:
             elif self.zeroSignalsFlag[workspace_index] == True:
                 logger.debug("Workspace number %d has zero signals" % workspace_index)
                 return None
-        def updateWorkspace():
-            if self.nWS == 1:
-                return self.workspaces[0]
-            else:
-                return self.workspaces[workspace_index]
-        workspace = updateWorkspace()
+        if self.nWS == 1:
+            workspace_index = 0
+        # The model holds the unscaled signals: rescaling the signals by
+        # self.scale is equivalent to rescaling the signal strength
+        # (together with its initial value and bounds)
+        model, data = self.getModel(workspace_index)
+        poi = model.config.poi_index
+        init_pars = model.config.suggested_init()
+        par_bounds = model.config.suggested_bounds()
         def root_func(mu):
-            # Same modifiers_settings as those use when running the 'pyhf cls' command line
-            msettings = {'normsys': {'interpcode': 'code4'}, 'histosys': {'interpcode': 'code4p'}}
-            model = workspace.model(modifier_settings=msettings)
             start = time.time()
             stat = "qtilde" # by default
             args = { "return_expected": expected }
+            args["init_pars"] = init_pars[:poi]+[init_pars[poi]*self.scale]+init_pars[poi+1:]
+            args["par_bounds"] = par_bounds[:poi]+[tuple(b*self.scale for b in par_bounds[poi])]+par_bounds[poi+1:]
             pver = float ( pyhf.__version__[:3] )
             if pver < 0.6:
                 args["qtilde"]=True
             else:
                 args["test_stat"]=stat
-            with np.testing.suppress_warnings() as sup:
+            if threading.current_thread() is threading.main_thread():
+                sup = np.testing.suppress_warnings()
                 if pyhfinfo["backend"] == "numpy":
                     sup.filter ( RuntimeWarning, r'invalid value encountered in log')
-                result = pyhf.infer.hypotest(mu, workspace.data(model), model, **args )
+            else:
+                # suppress_warnings replaces warnings.showwarning globally,
+                # so it can not be used by the fits running in threads
+                sup = contextlib.nullcontext()
+            with sup:
+                result = pyhf.infer.hypotest(mu*self.scale, data, model, **args )
             end = time.time()
             logger.debug("Hypotest elapsed time : %1.4f secs" % (end - start))
             if expected:
@@ -438,12 +460,10 @@ class PyhfUpperLimitComputer:
             if np.isnan(rt1):
                 nNan += 1
                 self.rescale(factor)
-                workspace = updateWorkspace()
                 continue
             if np.isnan(rt10):
                 nNan += 1
                 self.rescale(1/factor)
-                workspace = updateWorkspace()
                 continue
             # Analyzing previous values of wereBoth***
             if rt10 < 0 and rt1 < 0 and wereBothLarge:
@@ -458,11 +478,9 @@ class PyhfUpperLimitComputer:
             # Main rescaling code
             if rt10 < 0.:
                 self.rescale(factor)
-                workspace = updateWorkspace()
                 continue
             if rt1 > 0.:
                 self.rescale(1/factor)
-                workspace = updateWorkspace()
                 continue
         # Finding the root (Brent bracketing part)
         logger.debug("Final scale : %f" % self.scale)
@@ -472,6 +490,67 @@ class PyhfUpperLimitComputer:
         logger.debug("ulSigma elpased time : %1.4f secs" % (endUL - startUL))
         return ul*self.scale # self.scale has been updated whithin self.rescale() method
 
+    def ulSigmas(self, expected=False, workspace_indices=None, ncpus=None):
+        """
+        Compute the upper limits on the signal strength modifier for several
+        workspaces (see ulSigma). The fits of the workspaces are independent,
+        so for ncpus > 1 they are distributed to a pool of forked processes
+        (or of threads, if runtime._pyhfThreads is set or if forking is not
+        possible). Each fit starts from a new computer (also for ncpus = 1),
+        so the results do not depend on the number of workers.
+
+        :param expected: if True, compute the expected upper limits
+        :param workspace_indices: list of workspace indices (default: all workspaces)
+        :param ncpus: number of workers (-1 means all available CPUs).
+                      If None, runtime._ncpusPyhf is used.
+        :return: list of upper limits (None for workspaces without signal),
+                 in the order of workspace_indices
+        """
+        global _sharedFits
+
+        if workspace_indices is None:
+            workspace_indices = list(range(self.nWS))
+        if ncpus is None:
+            ncpus = runtime._ncpusPyhf
+        if ncpus == -1:
+            ncpus = runtime.nCPUs()
+        ncpus = min(ncpus,len(workspace_indices))
+        if self.data.errorFlag or self.workspaces == None:
+            return [None]*len(workspace_indices)
+        if ncpus <= 1:
+            # The scale found for one workspace does not carry over to the next
+            return [PyhfUpperLimitComputer(self.data, self.cl).ulSigma(expected=expected,
+                                                                       workspace_index=i_ws)
+                    for i_ws in workspace_indices]
+
+        useThreads = runtime._pyhfThreads
+        if not useThreads and multiprocessing.current_process().daemon:
+            logger.debug("Can not start processes from a daemonic process. Using threads for the pyhf fits.")
+            useThreads = True
+        if not useThreads:
+            try:
+                context = multiprocessing.get_context("fork")
+            except ValueError:
+                logger.debug("Forking processes is not supported. Using threads for the pyhf fits.")
+                useThreads = True
+        if useThreads:
+            # Build the models beforehand, so the threads only read the cache
+            for i_ws in workspace_indices:
+                if not self.zeroSignalsFlag[i_ws]:
+                    self.getModel(i_ws)
+        _sharedFits = (self.data, self.cl, expected)
+        try:
+            if useThreads:
+                pool = ThreadPool(processes=ncpus)
+            else:
+                pool = context.Pool(processes=ncpus)
+            with pool:
+                # map returns the results in the order of the indices
+                uls = pool.map(_ulSigmaFor, workspace_indices, chunksize=1)
+        finally:
+            _sharedFits = None
+        return uls
+
 if __name__ == "__main__":
     C = [ 18774.2, -2866.97, -5807.3, -4460.52, -2777.25, -1572.97, -846.653, -442.531,
        -2866.97, 496.273, 900.195, 667.591, 403.92, 222.614, 116.779, 59.5958,
@@ -17,6 +17,8 @@ _experimental = False ## turn on experimental features
 _cap_likelihoods = False ## cap the likelihoods in likelihoodFromLimits?
 # here, capping means that if an observed UL >> expected UL we "cap"
 # the observed UL such that dr == drmax
+_ncpusPyhf = 1 ## number of workers for the independent fits of the pyhf workspaces (-1 means all CPUs)
+_pyhfThreads = False ## use threads (instead of forked processes) for these fits?
 _drmax = 0.867 # maximum ratio 2*(oUL - eUL)/(oUL + eUL) that we allow before capping or returning None ( depending on _cap_likelihoods), 0.867 corresponds to three sigmas
 
 def filetype ( filename ):
@@ -14,7 +14,6 @@
 from __future__ import print_function
 from scipy import stats, optimize, integrate, special
 from numpy  import sqrt, exp, log, sign, array, ndarray
-from functools import reduce
 import numpy as NP
 import math
 import copy
@@ -37,6 +36,9 @@ def getLogger():
 
 logger=getLogger()
 
+_legendre = NP.polynomial.legendre.leggauss(100) ## nodes and weights for the 1D integrals
+_log2pi = math.log(2.*math.pi)
+
 
 class Data:
     """ A very simple observed container to collect all the data
@@ -241,18 +243,104 @@ class Data:
         
         return (mu*self.signal_rel)
 
+    def gaussianTerms(self):
+        """
+        The Cholesky factor, the inverse and the log-determinant of V,
+        as needed for the gaussian term of the likelihood. They are
+        computed once and reused (recomputed only if V changes).
+
+        If V is only positive semi-definite, the pseudo-inverse and
+        pseudo-determinant are used instead.
+
+        :returns: Cholesky factor, inverse and log-determinant of V
+        """
+
+        terms = getattr(self,"_gaussianTerms",None)
+        if terms is None or terms[0] is not self.V:
+            try:
+                L = NP.linalg.cholesky(self.V)
+                inverse = NP.linalg.inv(self.V)
+                logdet = 2.*NP.sum(NP.log(NP.diag(L)))
+            except NP.linalg.LinAlgError as e:
+                ## V only positive semi-definite (e.g. rounded covariances):
+                ## clip the small eigenvalues, use the pseudo-inverse and
+                ## pseudo-determinant, as scipy.stats.multivariate_normal does
+                s,U = NP.linalg.eigh(self.V)
+                eps = 1e6 * NP.finfo(float).eps * NP.max(NP.abs(s))
+                if NP.min(s) < -eps:
+                    raise Exception("ValueError %s, %s" % ( e, self.V ))
+                positive = s > eps
+                L = U*sqrt(NP.clip(s,0.,None))
+                inverse = NP.dot(U[:,positive]/s[positive],U[:,positive].T)
+                ## the density lives on the rank-dimensional support of V
+                logdet = NP.sum(NP.log(s[positive])) \
+                         - (self.n - NP.sum(positive))*_log2pi
+            terms = (self.V,L,inverse,logdet)
+            self._gaussianTerms = terms
+        return terms[1:]
+
+    def lngammaObserved(self):
+        """
+        gammaln(observed+1), the log of the factorials of the observed
+        numbers of events. Computed once (recomputed only if observed changes).
+        """
+
+        terms = getattr(self,"_lngammaObserved",None)
+        if terms is None or terms[0] is not self.observed:
+            terms = (self.observed,special.gammaln(self.observed + 1))
+            self._lngammaObserved = terms
+        return terms[1]
+
+    def toyBank(self, ntoys, seed):
+        """
+        Fixed bank of nuisance parameter draws, distributed according to
+        a multivariate normal with covariance V. The standard-normal draws
+        are generated with the given seed and transformed with the Cholesky
+        factor of V. The bank is computed once and reused
+        (it is recomputed only if V changes).
+
+        :param ntoys: number of draws
+        :param seed: seed of the random number generator
+        :returns: (ntoys,n) array of nuisance parameters
+        """
+
+        key = (ntoys,seed)
+        bank = getattr(self,"_toyBank",None)
+        if bank is not None and bank[0] is self.V and bank[1] == key:
+            return bank[2]
+        normal = NP.random.RandomState(seed).standard_normal((ntoys,self.n))
+        try:
+            L = NP.linalg.cholesky(self.V)
+        except NP.linalg.LinAlgError:
+            ## V only positive semi-definite, use the eigen decomposition
+            s,U = NP.linalg.eigh(self.V)
+            L = U*sqrt(NP.clip(s,0.,None))
+        thetas = NP.dot(normal,L.T)
+        self._toyBank = (self.V,key,thetas)
+        return thetas
+
 class LikelihoodComputer:
 
     debug_mode = False
+    ## number of nuisance fits (findThetaHat), Newton iterations, converged
+    ## Newton fits, and fits which needed the scipy minimizers
+    fitStatistics = { "fits" : 0, "iterations" : 0, "converged" : 0, "fallbacks" : 0 }
 
-    def __init__(self, data, ntoys = 10000 ):
+    def __init__(self, data, ntoys = 10000, toySeed = None ):
         """
         :param data: a Data object.
         :param ntoys: number of toys when marginalizing
+        :param toySeed: if not None, reuse a fixed bank of nuisance draws
+                        generated with this seed when marginalizing
+                        (see Data.toyBank), instead of drawing new toys
+                        for every likelihood evaluation.
         """
-        
+
         self.model = data
         self.ntoys = ntoys
+        self.toySeed = toySeed
+        self._thetaHats = {} ## cache of the nuisance fits, per signal hypothesis
+        self._lastThetaHat = None ## last fit, used as a starting point
 
     def dLdMu(self, mu, signal_rel, theta_hat):
         """
@@ -369,29 +457,17 @@ class LikelihoodComputer:
         else:
             lmbda = self.nsig + self.model.A + theta + self.model.C * theta**2 / self.model.B**2
         lmbda[lmbda<=0.] = 1e-30 ## turn zeroes to small values
+        ## log of the poissonians and of the gaussian, with the factorials,
+        ## inverse and determinant of the covariance computed only once
+        poisson = special.xlogy(self.model.observed, lmbda) - lmbda \
+                  - self.model.lngammaObserved()
+        _,weight,logdet = self.model.gaussianTerms()
+        gaussian = -.5*NP.dot(theta, NP.dot(weight, theta)) \
+                   - .5*(self.model.n*_log2pi + logdet)
+        ret = - gaussian - NP.sum(poisson)
         if nll:
-            #poisson = self.model.observed * log ( lmbda ) - lmbda #- self.gammaln
-            poisson = stats.poisson.logpmf( self.model.observed, lmbda )
-            #print ( "p",poisson,poisson2 )
-        else:
-            poisson = stats.poisson.pmf( self.model.observed, lmbda )
-            #print ( "nonll",poisson )
-        try:
-            M = [0.]*len(theta)
-            C = self.model.V
-            #if self.model.n == 1: I think not a good idea
-            #    C = self.model.totalCovariance(self.nsig)
-            if nll:
-                gaussian = stats.multivariate_normal.logpdf(theta,mean=M,cov=C)
-                ret = - gaussian - sum(poisson)
-            else:
-                gaussian = stats.multivariate_normal.pdf(theta,mean=M,cov=C)
-                ret = gaussian * ( reduce(lambda x, y: x*y, poisson) )
             return ret
-        except ValueError as e:
-            raise Exception("ValueError %s, %s" % ( e, self.model.V ))
-            #raise Exception("ValueError %s, %s" % ( e, self.model.totalCovariance(self.nsig) ))
-            # raise Exception("ValueError %s, %s" % ( e, self.model.V ))
+        return exp(-ret)
 
     def nll( self, theta ):
         """ probability, for nuicance parameters theta,
@@ -431,69 +507,66 @@ class LikelihoodComputer:
 
     def getThetaHat(self, nobs, nb, nsig, covb, max_iterations ):
             """ Compute nuisance parameter theta that
-            maximizes our likelihood (poisson*gauss).  """
+            maximizes our likelihood (poisson*gauss), solving the quadratic
+            equations of the uncorrelated case and iterating on the
+            correlations (with max_iterations=0, the uncorrelated
+            solution is returned). """
             self.nsig = nsig
             sigma2 = covb + self.model.var_s(nsig) ## NP.diag ( (self.model.deltas)**2 )
-            ## for now deal with variances only
             ntot = nb + nsig
             cov = NP.array(sigma2)
             weight = cov**(-1) ## weight matrix
             diag_cov = NP.diag(cov)
             # first: no covariances:
-            q = diag_cov * ( ntot - nobs )
-            p = ntot + diag_cov
-            thetamaxes = []
-            thetamax = -p/2. * ( 1 - sign(p) * sqrt ( 1. - 4*q / p**2 ) )
-            thetamaxes.append ( thetamax )
-            ndims = len(p)
+            q0 = diag_cov * ( ntot - nobs )
+            p0 = ntot + diag_cov
+            thetamax = -p0/2. * ( 1 - sign(p0) * sqrt ( 1. - 4*q0 / p0**2 ) )
+            offdiag = weight * ( 1. - NP.eye(len(p0)) )
+
             def distance ( theta1, theta2 ):
-                for ctr,i in enumerate ( theta1 ):
-                    if i == 0.:
-                        theta1[ctr]=1e-20
-                for ctr,i in enumerate ( theta2 ):
-                    if i == 0.:
-                        theta2[ctr]=1e-20
-                return sum ( NP.abs(theta1 - theta2) / NP.abs ( theta1+theta2 ) )
-
-            ictr = 0
-            while ictr < max_iterations:
-                ictr += 1
-                q = diag_cov * ( ntot - nobs )
-                p = ntot + diag_cov
-                for i in range(ndims):
-                    #q[i] = diag_cov[i] * ( ntot[i] - nobs[i] )
-                    #p[i] = ntot[i] + diag_cov[i]
-                    for j in range(ndims):
-                        if i==j: continue
-                        dq = thetamax[j]*ntot[i]*diag_cov[i]*weight[i,j]
-                        dp = thetamax[j]*weight[i,j]*diag_cov[i]
-                        if abs ( dq / q[i] ) > .3:
-                            #logger.warning ( "too big a change in iteration." )
-                            dq=NP.abs( .3 * q[i] ) * NP.sign ( dq )
-                        if abs ( dp / p[i] ) > .3:
-                            #logger.warning ( "too big a change in iteration." )
-                            dp=NP.abs( .3 * p[i] ) * NP.sign ( dp )
-                        q[i] += dq
-                        p[i] += dp
-                    thetamax = -p/2. * ( 1 - sign(p) * sqrt ( 1. - 4*q / p**2 ) )
-                thetamaxes.append ( thetamax )
-                if len(thetamaxes)>2:
-                    d1 = distance ( thetamaxes[-2], thetamax )
-                    d2 = distance ( thetamaxes[-3], thetamaxes[-2] )
-                    if d1 > d2:
-                        raise Exception("diverging when computing thetamax: %f > %f" % ( d1, d2 ))
-                    if d1 < 1e-5:
-                        return thetamax
+                theta1 = NP.where ( theta1 == 0., 1e-20, theta1 )
+                theta2 = NP.where ( theta2 == 0., 1e-20, theta2 )
+                return NP.sum ( NP.abs(theta1 - theta2) / NP.abs ( theta1+theta2 ) )
+
+            d2 = None
+            for ictr in range(max_iterations):
+                ## the shifts from the correlations, limited to 30%
+                ## of the uncorrelated terms
+                dq = ( ntot*diag_cov )[:,None] * offdiag * thetamax[None,:]
+                dp = diag_cov[:,None] * offdiag * thetamax[None,:]
+                dq = NP.clip ( dq, -.3*NP.abs(q0)[:,None], .3*NP.abs(q0)[:,None] )
+                dp = NP.clip ( dp, -.3*NP.abs(p0)[:,None], .3*NP.abs(p0)[:,None] )
+                q = q0 + NP.sum ( dq, axis=1 )
+                p = p0 + NP.sum ( dp, axis=1 )
+                newThetamax = -p/2. * ( 1 - sign(p) * sqrt ( 1. - 4*q / p**2 ) )
+                d1 = distance ( thetamax, newThetamax )
+                thetamax = newThetamax
+                if d2 is not None and d1 > d2:
+                    raise Exception("diverging when computing thetamax: %f > %f" % ( d1, d2 ))
+                if d1 < 1e-5:
+                    break
+                d2 = d1
             return thetamax
 
     def findThetaHat(self, nsig):
             """ Compute nuisance parameter theta that maximizes our likelihood
                 (poisson*gauss).
+                The solutions are cached per signal hypothesis, and the fit
+                is warm-started from the last solution, if that is closer
+                to the maximum than the approximate solution.
             """
-            
+
+            key = NP.asarray(nsig,dtype=float).tobytes()
+            if key in self._thetaHats:
+                self.nsig = nsig
+                theta_hat,err = self._thetaHats[key]
+                return NP.copy(theta_hat),err
             ## first step is to disregard the covariances and solve the
             ## quadratic equations
             ini = self.getThetaHat ( self.model.observed, self.model.backgrounds, nsig, self.model.covariance, 0 )
+            if self._lastThetaHat is not None and \
+                    self.nll(self._lastThetaHat) < self.nll(ini):
+                ini = NP.copy(self._lastThetaHat)
             self.cov_tot = self.model.V
             #if self.model.n == 1:
             #    self.cov_tot = self.model.totalCovariance ( nsig )
@@ -502,11 +575,30 @@ class LikelihoodComputer:
                 # self.cov_tot = self.model.V + self.model.var_s(nsig)
                 # self.cov_tot = self.model.totalCovariance (nsig)
                 #self.ntot = None
-            self.weight = NP.linalg.inv(self.cov_tot)
+            _,self.weight,_ = self.model.gaussianTerms()
             self.ones = 1.
             if type ( self.model.observed) in [ list, ndarray ]:
                 self.ones = NP.ones ( len (self.model.observed) )
-            self.gammaln = special.gammaln(self.model.observed + 1)
+            self.gammaln = self.model.lngammaObserved()
+            ## Newton iterations, starting from ini
+            fitStats = LikelihoodComputer.fitStatistics
+            thetas,converged,iterations = self._newtonThetaHats(
+                    NP.array([nsig],dtype=float), NP.array([ini]) )
+            theta_hat = thetas[0]
+            fitStats["fits"] += 1
+            fitStats["iterations"] += int(iterations[0])
+            ## the bounds used by fmin_tnc below
+            if converged[0] and NP.all(NP.abs(theta_hat) <= 10.*NP.abs(self.model.observed)):
+                fitStats["converged"] += 1
+                logger.debug("theta hat converged after %d Newton iterations" % iterations[0])
+                self._thetaHats[key] = ( theta_hat, 0 )
+                self._lastThetaHat = theta_hat
+                return NP.copy(theta_hat),0
+            ## no convergence, continue with scipy
+            fitStats["fallbacks"] += 1
+            logger.debug("theta hat did not converge after %d Newton iterations, using scipy" % iterations[0])
+            if NP.all(NP.isfinite(theta_hat)) and self.nll(theta_hat) < self.nll(ini):
+                ini = theta_hat
             try:
                 ret_c = optimize.fmin_ncg ( self.nll, ini, fprime=self.nllprime,
                                        fhess=self.nllHess, full_output=True, disp=0 )
@@ -519,14 +611,12 @@ class LikelihoodComputer:
                 ret_c = optimize.fmin_tnc ( self.nll, ret_c[0], fprime=self.nllprime,
                                             disp=0, bounds=bounds )
                 # print ( "[findThetaHat] mu=%s bg=%s observed=%s V=%s, nsig=%s theta=%s, nll=%s" % ( self.nsig[0]/self.model.efficiencies[0], self.model.backgrounds, self.model.observed,self.model.covariance, self.nsig, ret_c[0], self.nll(ret_c[0]) ) )
+                err = 0
                 if ret_c[-1] not in [ 0, 1, 2 ]:
-                    return ret_c[0],ret_c[-1]
-                else:
-                    return ret_c[0],0
-                    logger.debug ( "tnc worked." )
-
-                ret = ret_c[0]
-                return ret,-2
+                    err = ret_c[-1]
+                self._thetaHats[key] = ( ret_c[0], err )
+                self._lastThetaHat = ret_c[0]
+                return NP.copy(ret_c[0]),err
             except (IndexError,ValueError) as e:
                 logger.error("exception: %s. ini[-3:]=%s" % (e,ini[-3:]) )
                 raise Exception("cov-1=%s" % (self.model.covariance+self.model.var_s(nsig))**(-1))
@@ -537,16 +627,85 @@ class LikelihoodComputer:
             Return the likelihood (of 1 signal region) to observe nobs events given the
             predicted background nb, error on this background (deltab),
             expected number of signal events nsig and the relative error on the signal (deltas_rel).
+            For a normal background error, the integral is computed for all
+            signal hypotheses at once, with a Gauss-Legendre quadrature over
+            the range where the (log-concave) integrand is not negligible.
 
-            :param nsig: predicted signal (float)
-            :param nobs: number of observed events (float)
-            :param nb: predicted background (float)
-            :param deltab: uncertainty on background (float)
+            :param nsig: predicted signal (float), or array of predicted signals
             :param bg_error: wheter to use a normal ("normal") or lognormal ("lognormal") distribution to model the bg-signal. Defaults to "normal"
 
+            :return: likelihood to observe nobs events (float), or array of
+                     likelihoods if nsig is an array of signal hypotheses
+            """
+            if bg_error == "lognormal":
+                return self._lognormalLLHD1D ( nsig, nll )
+            if bg_error != "normal":
+                raise Exception("bg_error has to be one of normal and lognormal")
+            nsigs = NP.ravel ( NP.asarray ( nsig, dtype=float ) )
+            nobs = self.model.observed[0]
+            sigma2 = self.model.covariance[0][0] + (nsigs*self.model.deltas_rel)**2
+            sigma_tot = sqrt(sigma2)
+            mean = self.model.backgrounds[0] + nsigs
+            lngamma = math.lgamma(nobs + 1)
+
+            #Log of the integrand (gaussian_(bg+signal)*poisson(nobs)),
+            #for x = (len(nsigs),npoints) array of background values:
+            def logprob ( x ):
+                m, s = mean[:,None], sigma_tot[:,None]
+                return special.xlogy(nobs,x) - x - lngamma - (x-m)**2/(2.*s**2) \
+                       - log(s) - .5*log(2.*NP.pi)
 
-            :return: likelihood to observe nobs events (float)
+            #Compute maximum value for the integrand:
+            xm = mean - sigma2
+            #If nb + nsig = sigma2, shift the values slightly:
+            xm[xm == 0.] = 0.001
+            xmax = xm*(1.+sign(xm)*sqrt(1. + 4.*nobs*sigma2/xm**2))/2.
+            logmax = logprob ( xmax[:,None] )[:,0]
+
+            #Find the range where the integrand drops by less than exp(-dlog)
+            #(the integrand is log-concave, so it is unimodal):
+            dlog = 30.
+            width = 1./sqrt(1./sigma2 + nobs/NP.maximum(xmax,1e-3)**2)
+            ranges = []
+            for direction in [ -1., 1. ]:
+                inner = NP.copy ( xmax )
+                outer = xmax + direction*width
+                for ctr in range(100):
+                    outer = NP.maximum ( outer, 0. )
+                    larger = logprob ( outer[:,None] )[:,0] > logmax - dlog
+                    larger[outer == 0.] = False
+                    if not larger.any():
+                        break
+                    inner[larger] = outer[larger]
+                    outer[larger] = xmax[larger] + 2.*(outer[larger] - xmax[larger])
+                for ctr in range(30):
+                    middle = (inner + outer)/2.
+                    larger = logprob ( middle[:,None] )[:,0] > logmax - dlog
+                    inner = NP.where ( larger, middle, inner )
+                    outer = NP.where ( larger, outer, middle )
+                ranges.append ( outer )
+            a, b = ranges
+            nodes, weights = _legendre
+            x = (a[:,None] + b[:,None])/2. + (b[:,None] - a[:,None])/2.*nodes[None,:]
+            integral = (b - a)/2.*NP.sum ( weights*exp ( logprob ( x ) - logmax[:,None] ), axis=1 )
+            #Renormalize the likelihood to account for the cut at x = 0.
+            #The integral of the gaussian from 0 to infinity gives:
+            #(1/2)*(1 + Erf(mu/sqrt(2*sigma2))), so we need to divide by it
+            #(for mu - sigma >> 0, the normalization gives 1.)
+            loglike = logmax + log ( integral ) - special.log_ndtr ( mean/sigma_tot )
+
+            ret = - loglike if nll else exp ( loglike )
+            if NP.ndim ( nsig ) == 0 or NP.size ( nsig ) == 1:
+                return ret[0]
+            return ret
 
+    def _lognormalLLHD1D(self, nsig, nll):
+            """
+            Return the likelihood (of 1 signal region) to observe nobs events,
+            using a lognormal distribution to model the background error.
+
+            :param nsig: predicted signal (float)
+            :return: likelihood to observe nobs events (float)
             """
             self.sigma2 = self.model.covariance + self.model.var_s(nsig)## (self.model.deltas)**2
             self.sigma_tot = sqrt(self.sigma2)
@@ -567,24 +726,18 @@ class LikelihoodComputer:
             #     instead to avoid using large numbers.
 
 
-            #Define integrand (gaussian_(bg+signal)*poisson(nobs)):
+            #Define integrand (lognormal_(bg+signal)*poisson(nobs)):
             def prob( x, nsig ):
                 poisson = exp(self.model.observed*log(x) - x - self.lngamma )
-                if bg_error == "normal":
-                    gaussian = stats.norm.pdf(x,loc=self.model.backgrounds+nsig,scale=self.sigma_tot)
-                    return poisson*gaussian
-                elif bg_error == "lognormal":
-                    mu = self.model.backgrounds+nsig
-                    if self.model.backgrounds==0:
-                        #case makes problems, integral diverges
-                        mu = 0.001+nsig
-                    sig = self.sigma_tot
-                    loc = mu**2 / NP.sqrt(mu**2 + sig**2)
-                    stderr = NP.sqrt(NP.log(mu**2 + sig**2) - 2*NP.log(mu))
-                    lognormal = stats.lognorm.pdf(x, s=stderr, scale=loc)
-                    return poisson*lognormal
-                else:
-                    raise Exception("bg_error has to be one of normal and lognormal")
+                mu = self.model.backgrounds+nsig
+                if self.model.backgrounds==0:
+                    #case makes problems, integral diverges
+                    mu = 0.001+nsig
+                sig = self.sigma_tot
+                loc = mu**2 / NP.sqrt(mu**2 + sig**2)
+                stderr = NP.sqrt(NP.log(mu**2 + sig**2) - 2*NP.log(mu))
+                lognormal = stats.lognorm.pdf(x, s=stderr, scale=loc)
+                return poisson*lognormal
 
             #Compute maximum value for the integrand:
             xm = self.model.backgrounds + nsig - self.sigma2
@@ -608,7 +761,7 @@ class LikelihoodComputer:
                 ctr+=1
                 if ctr > 10.:
                     raise Exception("Could not compute likelihood within required precision")
-                    
+
                 like_old = like
                 nrange = nrange*2
                 a = max(0.,(xmax-nrange*self.sigma_tot)[0][0] )
@@ -619,53 +772,37 @@ class LikelihoodComputer:
                     continue
                 err = abs(like_old-like)/like
 
-            if bg_error == "normal":
-                #Renormalize the likelihood to account for the cut at x = 0.
-                #The integral of the gaussian from 0 to infinity gives:
-                #(1/2)*(1 + Erf(mu/sqrt(2*sigma2))), so we need to divide by it
-                #(for mu - sigma >> 0, the normalization gives 1.)
-                norm = (1./2.)*(1. + special.erf((self.model.backgrounds+nsig)/sqrt(2.*self.sigma2)))
-                like = like/norm
-
             if nll:
                 like = - log ( like )
 
-            if bg_error == "normal" : return like[0][0]
-            elif bg_error == "lognormal": return like
-            else:
-                 raise Exception("Could not compute likelihood within required precision")
+            return like
 
     def marginalizedLikelihood(self, nsig, nll ):
             """ compute the marginalized likelihood of observing nsig signal event"""
             if self.model.isLinear() and self.model.n == 1: ## 1-dimensional non-skewed llhds we can integrate analytically
                 return self.marginalizedLLHD1D ( nsig, nll )
 
-            vals=[]
-            self.gammaln = special.gammaln(self.model.observed + 1)
-            thetas = stats.multivariate_normal.rvs(mean=[0.]*self.model.n,
-                          # cov=(self.model.totalCovariance(nsig)),
-                          cov=self.model.V,
-                          size=self.ntoys ) ## get ntoys values
-            for theta in thetas :
-                if self.model.isLinear():
-                    lmbda = nsig + self.model.backgrounds + theta
-                else:
-                    lmbda = nsig + self.model.A + theta + self.model.C*theta**2/self.model.B**2
-                if self.model.isScalar( lmbda ):
-                    lmbda = array([lmbda])
-                for ctr,v in enumerate( lmbda ):
-                    if v<=0.: lmbda[ctr]=1e-30
-                    #print ( "lmbda=",lmbda )
-                poisson = self.model.observed*NP.log(lmbda) - lmbda - self.gammaln
-                # poisson = NP.exp(self.model.observed*NP.log(lmbda) - lmbda - self.model.backgrounds - self.gammaln)
-                vals.append( NP.exp ( sum(poisson) ) )
-                #vals.append ( reduce(lambda x, y: x*y, poisson) )
-            mean = NP.mean( vals )
+            self.gammaln = self.model.lngammaObserved()
+            if self.toySeed is None:
+                thetas = stats.multivariate_normal.rvs(mean=[0.]*self.model.n,
+                              # cov=(self.model.totalCovariance(nsig)),
+                              cov=self.model.V,
+                              size=self.ntoys ) ## get ntoys values
+                thetas = NP.reshape(thetas,(self.ntoys,self.model.n))
+            else:
+                thetas = self.model.toyBank(self.ntoys,self.toySeed)
+            ## (ntoys,nSR) matrix of poisson rates
+            if self.model.isLinear():
+                lmbda = nsig + self.model.backgrounds + thetas
+            else:
+                lmbda = nsig + self.model.A + thetas + self.model.C*thetas**2/self.model.B**2
+            lmbda[lmbda<=0.] = 1e-30 ## turn zeroes to small values
+            poisson = self.model.observed*NP.log(lmbda) - lmbda - self.gammaln
+            ## log of the mean over the toys of the product of the poissonians
+            logmean = special.logsumexp(NP.sum(poisson,axis=1)) - log(self.ntoys)
             if nll:
-                if mean == 0.:
-                    mean = 1e-100
-                mean = - log ( mean )
-            return mean
+                return - logmean
+            return NP.exp(logmean)
 
 
     def profileLikelihood( self, nsig, nll ):
@@ -723,26 +860,229 @@ class LikelihoodComputer:
             # Return the test statistic -2log(H0/H1)
             return chi2
 
+    def signalVectors(self, nsigs):
+        """
+        Convert an array of signal hypotheses to a (k,n) array.
+
+        :param nsigs: array of k signal strengths mu (the total numbers of
+                      signal events, distributed according to the relative
+                      signals of the model), or (k,n) array of numbers of
+                      signal events in each dataset
+        :returns: (k,n) array of numbers of signal events
+        """
+        nsigs = NP.asarray(nsigs,dtype=float)
+        if nsigs.ndim <= 1:
+            nsigs = NP.outer(NP.atleast_1d(nsigs),self.model.signal_rel)
+        if nsigs.ndim != 2 or nsigs.shape[1] != self.model.n:
+            raise Exception("signal hypotheses of shape %s do not match %d datasets" \
+                            % ( str(nsigs.shape), self.model.n ) )
+        return nsigs
+
+    def _rates(self, nsigs, thetas):
+        """ the poisson rates for (k,n) arrays of signals and nuisances """
+        if self.model.isLinear():
+            return nsigs + self.model.backgrounds + thetas
+        return nsigs + self.model.A + thetas + self.model.C * thetas**2 / self.model.B**2
+
+    def nlls(self, nsigs, thetas):
+        """ negative log likelihoods, for (k,n) arrays of signals and
+            nuisances. Equivalent to probMV(True,theta) for each hypothesis. """
+        lmbda = self._rates(nsigs, thetas)
+        lmbda[lmbda<=0.] = 1e-30 ## turn zeroes to small values
+        poisson = special.xlogy(self.model.observed, lmbda) - lmbda \
+                  - self.model.lngammaObserved()
+        _,weight,logdet = self.model.gaussianTerms()
+        gaussian = -.5*NP.einsum("ki,ij,kj->k", thetas, weight, thetas) \
+                   - .5*(self.model.n*_log2pi + logdet)
+        return - gaussian - NP.sum(poisson, axis=1)
+
+    def _newtonThetaHats(self, nsigs, thetas, max_iterations=50):
+        """ Damped Newton iterations (with the analytic gradient and hessian
+            of the nll, see nllprime and nllHess) for several signal
+            hypotheses simultaneously. If the hessian is not positive
+            definite, its positive definite part is used.
+
+        :param nsigs: (k,n) array of signal hypotheses
+        :param thetas: (k,n) array of starting points
+        :param max_iterations: maximum number of Newton iterations
+        :returns: (k,n) array of nuisance parameters, boolean array with the
+                  converged hypotheses, and array with the number of iterations
+        """
+        nobs = self.model.observed
+        _,weight,_ = self.model.gaussianTerms()
+        linear = self.model.isLinear()
+        thetas = NP.array(thetas, dtype=float)
+
+        def derivatives(nsigs, thetas):
+            ## gradient and hessian of the nll, and a positive definite
+            ## approximation of the hessian
+            lmbda = self._rates(nsigs, thetas)
+            lmbda[lmbda<=0.] = 1e-30
+            if linear:
+                T = NP.ones(thetas.shape)
+                dT = 0.
+            else:
+                T = 1. + 2.*self.model.C/self.model.B**2*thetas
+                dT = 2.*self.model.C/self.model.B**2
+            grad = T - nobs/lmbda*T + NP.dot(thetas, weight)
+            diagPD = nobs*T**2/lmbda**2
+            hessPD = weight + diagPD[:,:,None]*NP.eye(self.model.n)
+            hess = hessPD + ((1. - nobs/lmbda)*dT)[:,:,None]*NP.eye(self.model.n)
+            return grad, hess, hessPD
+
+        def solve(hess, grad):
+            try:
+                return NP.linalg.solve(hess, grad[:,:,None])[:,:,0]
+            except NP.linalg.LinAlgError:
+                return NP.full(grad.shape, NP.nan)
+
+        active = NP.all(NP.isfinite(thetas),axis=1) & \
+                 NP.all(self._rates(nsigs,thetas) > 0.,axis=1)
+        converged = NP.zeros(len(nsigs),dtype=bool)
+        iterations = NP.zeros(len(nsigs),dtype=int)
+        nlls = NP.full(len(nsigs),NP.inf)
+        nlls[active] = self.nlls(nsigs[active], thetas[active])
+        for ictr in range(max_iterations):
+            if not active.any():
+                break
+            idx = NP.where(active)[0]
+            iterations[idx] += 1
+            th, ns = thetas[idx], nsigs[idx]
+            grad, hess, hessPD = derivatives(ns, th)
+            step = solve(hess, grad)
+            slope = NP.sum(grad*step, axis=1)
+            ## not a descent direction: use the positive definite approximation
+            bad = ~NP.isfinite(slope) | (slope <= 0.)
+            if bad.any():
+                step[bad] = solve(hessPD[bad], grad[bad])
+                slope[bad] = NP.sum(grad[bad]*step[bad], axis=1)
+            ## the Newton decrement is negligible: we are at the minimum
+            atMinimum = NP.isfinite(slope) & ( slope <= 1e-12*(1.+NP.abs(nlls[idx])) )
+            alpha = NP.ones(len(idx))
+            newNlls = NP.full(len(idx),NP.inf)
+            newTh = NP.copy(th)
+            todo = NP.isfinite(slope) & ~atMinimum
+            for lctr in range(30): ## backtracking line search
+                if not todo.any():
+                    break
+                trial = th[todo] - alpha[todo,None]*step[todo]
+                trialNlls = NP.full(len(trial),NP.inf)
+                feasible = NP.all(self._rates(ns[todo],trial) > 0.,axis=1)
+                trialNlls[feasible] = self.nlls(ns[todo][feasible], trial[feasible])
+                ok = trialNlls <= nlls[idx][todo] - 1e-4*alpha[todo]*slope[todo]
+                okIdx = NP.where(todo)[0][ok]
+                newNlls[okIdx] = trialNlls[ok]
+                newTh[okIdx] = trial[ok]
+                todo[okIdx] = False
+                alpha[todo] = alpha[todo]/2.
+            moved = NP.isfinite(newNlls)
+            delta = NP.max(NP.abs(newTh - th),axis=1)
+            done = moved & ( delta <= 1e-9*(1.+NP.max(NP.abs(th),axis=1)) )
+            done = done | ( moved & ( NP.abs(nlls[idx]-newNlls) <= 1e-12*(1.+NP.abs(nlls[idx])) ) )
+            done = done | atMinimum
+            thetas[idx[moved]] = newTh[moved]
+            nlls[idx[moved]] = newNlls[moved]
+            ## converged, or no more progress possible
+            converged[idx[done]] = True
+            active[idx[done | ~moved]] = False
+        return thetas, converged, iterations
+
+    def findThetaHats(self, nsigs, max_iterations=50):
+        """ Compute the nuisance parameters theta that maximize the likelihood
+            for several signal hypotheses at once, with damped Newton
+            iterations (see _newtonThetaHats) on all hypotheses
+            simultaneously. Hypotheses which do not converge (or whose
+            solution is outside the bounds used by findThetaHat) are
+            fitted with findThetaHat.
+
+        :param nsigs: (k,n) array of signal hypotheses
+        :param max_iterations: maximum number of Newton iterations
+        :returns: (k,n) array of nuisance parameters
+        """
+        nobs = self.model.observed
+        ## starting point: the solution of the quadratic equations,
+        ## disregarding the covariances (see getThetaHat)
+        diag_cov = NP.diag(self.model.covariance) + (nsigs*self.model.deltas_rel)**2
+        ntot = self.model.backgrounds + nsigs
+        q = diag_cov * ( ntot - nobs )
+        p = ntot + diag_cov
+        with NP.errstate(divide="ignore",invalid="ignore"):
+            thetas = -p/2. * ( 1 - sign(p) * sqrt ( 1. - 4*q / p**2 ) )
+        thetas,converged,_ = self._newtonThetaHats(nsigs, thetas, max_iterations)
+        ## the bounds used by findThetaHat
+        bounds = 10.*NP.abs(nobs)
+        converged = converged & NP.all(NP.abs(thetas) <= bounds,axis=1)
+        for i in NP.where(~converged)[0]:
+            thetas[i],_ = self.findThetaHat(nsigs[i])
+        return thetas
+
+    def likelihoods(self, nsigs, marginalize=False, nll=False ):
+        """ compute the likelihoods for several signal hypotheses at once.
+        The profiling is done for all hypotheses simultaneously
+        (see findThetaHats).
+
+        :param nsigs: array of signal strengths mu, or (k,n) array of signal
+                      hypotheses (see signalVectors)
+        :param marginalize: if true, marginalize, if false, profile
+        :param nll: return nlls instead of likelihoods
+        :returns: array of (negative log) likelihoods
+        """
+        nsigs = self.signalVectors(nsigs)
+        if marginalize:
+            if self.model.isLinear() and self.model.n == 1:
+                return NP.atleast_1d(self.marginalizedLLHD1D(nsigs[:,0], nll))
+            return array([self.marginalizedLikelihood(nsig, nll) for nsig in nsigs])
+        thetas = self.findThetaHats(nsigs)
+        nlls = self.nlls(nsigs, thetas)
+        if nll:
+            return nlls
+        return exp(-nlls)
+
+    def chi2s(self, nsigs, marginalize=False):
+        """
+        Computes the chi2 for several signal hypotheses at once
+        (see chi2).
+
+        :param nsigs: array of signal strengths mu, or (k,n) array of signal
+                      hypotheses (see signalVectors)
+        :param marginalize: if true, marginalize, if false, profile
+        :return: array of chi2 values
+        """
+        llhds = self.likelihoods(nsigs, marginalize=marginalize, nll=True)
+        dn = self.model.observed-self.model.backgrounds
+        maxllhd = self.likelihood(dn, marginalize=marginalize, nll=True )
+        return 2*(llhds-maxllhd)
+
 class UpperLimitComputer:
     debug_mode = False
 
-    def __init__(self, ntoys=10000, cl=.95):
+    def __init__(self, ntoys=10000, cl=.95, toySeed=None):
 
         """
         :param ntoys: number of toys when marginalizing
         :param cl: desired quantile for limits
+        :param toySeed: if not None, use a fixed bank of nuisance draws
+                        (generated with this seed) when marginalizing
         """
         self.ntoys = ntoys
         self.cl = cl
+        self.toySeed = toySeed
 
-    def ulSigma(self, model, marginalize=False, toys=None, expected=False ):
+    def ulSigma(self, model, marginalize=False, toys=None, expected=False,
+                computer=None ):
         """ upper limit obtained from the defined Data (using the signal prediction
             for each signal regio/dataset), by using
             the q_mu test statistic from the CCGV paper (arXiv:1007.1727).
+            The root is first bracketed around the asymptotic limit, and
+            the test statistics are computed only once for each mu.
 
         :params marginalize: if true, marginalize nuisances, else profile them
         :params toys: specify number of toys. Use default is none
         :params expected: compute the expected value, not the observed.
+        :params computer: LikelihoodComputer for the (observed or, if expected
+                          is True, expected) data of the model. If given, it is
+                          used instead of a new one, so its nuisance fits are
+                          reused (see StatisticalModel).
         :returns: upper limit on *production* xsec (efficiencies unfolded)
         """
         if model.zeroSignal():
@@ -750,23 +1090,25 @@ class UpperLimitComputer:
             return None
         if toys==None:
             toys=self.ntoys
-        oldmodel = model
-        if expected:
-            model = copy.deepcopy(oldmodel)
-            #model.observed = model.backgrounds
-            for i,d in enumerate(model.backgrounds):
-                model.observed[i]=int(NP.round(d))
-        computer = LikelihoodComputer(model, toys)
+        if computer is not None:
+            model = computer.model
+        else:
+            if expected:
+                ## only the observed numbers of events change,
+                ## so a shallow copy is sufficient
+                model = copy.copy(model)
+                model.observed = NP.round(model.backgrounds)
+            computer = LikelihoodComputer(model, toys, self.toySeed)
         mu_hat = computer.findMuHat(model.signal_rel)
         theta_hat0,_ = computer.findThetaHat(0*model.signal_rel)
         sigma_mu = computer.getSigmaMu(model.signal_rel)
 
-        aModel = copy.deepcopy(model)
+        aModel = copy.copy(model)
         aModel.observed = array([NP.round(x+y) for x,y in zip(model.backgrounds,theta_hat0)])
         #print ( "aModeldata=", aModel.observed )
         #aModel.observed = array ( [ round(x) for x in model.backgrounds ] )
         aModel.name = aModel.name + "A"
-        compA = LikelihoodComputer(aModel, toys)
+        compA = LikelihoodComputer(aModel, toys, self.toySeed)
         ## compute
         mu_hatA = compA.findMuHat(aModel.signal_rel)
         if mu_hat < 0.:
@@ -788,20 +1130,28 @@ class UpperLimitComputer:
         nll0A = compA.likelihood(aModel.signals(mu_hatA),
                                    marginalize=marginalize,
                                    nll=True)
-        
+
+        qValues = {}
+        def getQs(mu):
+            ## the test statistics q_mu and q_A (computed once per mu)
+            if not mu in qValues:
+                nsig = model.signals(mu)
+                computer.ntot = model.backgrounds + nsig
+                nll = computer.likelihood(nsig, marginalize=marginalize, nll=True )
+                nllA = compA.likelihood(nsig, marginalize=marginalize, nll=True )
+                qmu =  2*( nll - nll0 )
+                if qmu<0.: qmu=0.
+                qA =  2*( nllA - nll0A )
+                # print ( "mu: %s, qMu: %s, qA: %s nll0A: %s nllA: %s" % ( mu, qmu, qA, nll0A, nllA ) )
+                if qA<0.:
+                    qA=0.
+                qValues[mu] = ( qmu, qA )
+            return qValues[mu]
+
         def root_func(mu):
             ## the function to find the zero of (ie CLs - alpha)
-            nsig = model.signals(mu)
-            computer.ntot = model.backgrounds + nsig
-            nll = computer.likelihood(nsig, marginalize=marginalize, nll=True )
-            nllA = compA.likelihood(nsig, marginalize=marginalize, nll=True )
-            qmu =  2*( nll - nll0 )
-            if qmu<0.: qmu=0.
+            qmu,qA = getQs(mu)
             sqmu = sqrt (qmu)
-            qA =  2*( nllA - nll0A )
-            # print ( "mu: %s, qMu: %s, qA: %s nll0A: %s nllA: %s" % ( mu, qmu, qA, nll0A, nllA ) )
-            if qA<0.:
-                qA=0.
             sqA = sqrt(qA)
             CLsb = 1. - stats.multivariate_normal.cdf(sqmu)
             CLb = 0.
@@ -820,6 +1170,19 @@ class UpperLimitComputer:
             root = CLs - 1. + self.cl
             return root
 
+        def asymptoticLimit(sigma):
+            ## closed form of the limit, for q_mu = ((mu-mu_hat)/sigma)**2
+            ## and q_A = (mu/sigma)**2: CLs = (1-Phi((mu-mu_hat)/sigma))/Phi(mu_hat/sigma)
+            return mu_hat + sigma*stats.norm.ppf(1.-(1.-self.cl)*stats.norm.cdf(mu_hat/sigma))
+
+        ## bracket the root around the asymptotic limit, using sigma_mu
+        ## and then the width obtained from the Asimov data
+        bracket = self._asymptoticBracket(root_func, getQs, asymptoticLimit, sigma_mu)
+        if bracket is not None:
+            a,b = bracket
+            if a == b:
+                return a
+            return optimize.brentq ( root_func, a, b, rtol=1e-03, xtol=1e-06 )
 
         a,b=1.5*mu_hat,2.5*mu_hat+2*sigma_mu
         ctr=0
@@ -843,6 +1206,123 @@ class UpperLimitComputer:
                 # in that case, try again
                 pass
 
+    def _asymptoticBracket(self, root_func, getQs, asymptoticLimit, sigma_mu,
+                           step=.05, maxTrials=6):
+        """ find a bracket for the root of root_func around the
+            asymptotic limit.
+
+        :param root_func: CLs - alpha, as a function of mu
+        :param getQs: q_mu and q_A, as a function of mu
+        :param asymptoticLimit: closed form of the limit, as a function of sigma
+        :param sigma_mu: rough estimate of the width of mu
+        :param step: initial relative step around the asymptotic limit
+        :param maxTrials: maximum number of steps
+        :returns: (a,b) bracketing the root (a==b if the root is hit),
+                  None if no bracket could be found
+        """
+        mu0 = asymptoticLimit(sigma_mu)
+        if not NP.isfinite(mu0) or mu0 <= 0.:
+            return None
+        _,qA = getQs(mu0)
+        if qA > 0.:
+            mu1 = asymptoticLimit(mu0/sqrt(qA))
+            if NP.isfinite(mu1) and mu1 > 0.:
+                mu0 = mu1
+        r0 = root_func(mu0)
+        ## CLs decreases with mu
+        mu1 = mu0*(1.+step) if r0 > 0. else mu0/(1.+step)
+        for i in range(maxTrials):
+            if r0 == 0.:
+                return mu0,mu0
+            r1 = root_func(mu1)
+            if NP.sign(r0*r1) < -.5:
+                return min(mu0,mu1),max(mu0,mu1)
+            ## same sign: extrapolate (with the secant) slightly beyond the root
+            step = 2.*step
+            mu2 = None
+            if r1 != r0:
+                mu2 = mu1 - 1.1*r1*(mu1-mu0)/(r1-r0)
+            if mu2 is None or not NP.isfinite(mu2) or mu2 <= 0. or (mu2-mu1)*(mu1-mu0) <= 0.:
+                mu2 = mu1*(1.+step) if r1 > 0. else mu1/(1.+step)
+            mu0,r0,mu1 = mu1,r1,mu2
+        return None
+
+class StatisticalModel:
+    """
+    A Data object (with its signal hypothesis) together with the likelihood
+    computers for its observed and expected data. The upper limits,
+    likelihoods and chi2 values of the signal hypothesis are all computed
+    with these computers, so the covariance algebra and the nuisance fits
+    are shared, and the upper limits are computed only once.
+    """
+
+    def __init__(self, data, ntoys=10000, cl=.95, toySeed=None):
+        """
+        :param data: a Data object, with the signal hypothesis (nsignal)
+        :param ntoys: number of toys when marginalizing
+        :param cl: desired quantile for limits
+        :param toySeed: if not None, use a fixed bank of nuisance draws
+                        (generated with this seed) when marginalizing
+        """
+        self.data = data
+        self.ntoys = ntoys
+        self.cl = cl
+        self.toySeed = toySeed
+        self._computers = {}
+        self._upperLimits = {}
+
+    def computer(self, expected=False):
+        """
+        The likelihood computer for the observed data or, if expected is True,
+        for the expected data (the observed numbers of events are replaced by
+        the rounded backgrounds). Created once.
+        """
+        expected = bool(expected)
+        if not expected in self._computers:
+            data = self.data
+            if expected:
+                ## only the observed numbers of events change,
+                ## so a shallow copy is sufficient
+                data = copy.copy(data)
+                data.observed = NP.round(data.backgrounds)
+            self._computers[expected] = LikelihoodComputer(data, self.ntoys, self.toySeed)
+        return self._computers[expected]
+
+    def upperLimit(self, marginalize=False, expected=False):
+        """
+        Upper limit on the total number of signal events (see
+        UpperLimitComputer.ulSigma), computed once.
+
+        :param marginalize: if true, marginalize nuisances, else profile them
+        :param expected: compute the expected value, not the observed.
+        """
+        key = (marginalize, bool(expected))
+        if not key in self._upperLimits:
+            ulComputer = UpperLimitComputer(self.ntoys, self.cl, self.toySeed)
+            self._upperLimits[key] = ulComputer.ulSigma(self.data, marginalize=marginalize,
+                        expected=expected, computer=self.computer(expected))
+        return self._upperLimits[key]
+
+    def likelihood(self, nsig=None, marginalize=False, nll=False):
+        """
+        Likelihood for nsig (see LikelihoodComputer.likelihood).
+
+        :param nsig: signal hypothesis. If None, the signal of the data is used.
+        """
+        if nsig is None:
+            nsig = self.data.nsignal
+        return self.computer().likelihood(nsig, marginalize=marginalize, nll=nll)
+
+    def chi2(self, nsig=None, marginalize=False):
+        """
+        Chi2 for nsig (see LikelihoodComputer.chi2).
+
+        :param nsig: signal hypothesis. If None, the signal of the data is used.
+        """
+        if nsig is None:
+            nsig = self.data.nsignal
+        return self.computer().chi2(nsig, marginalize=marginalize)
+
 if __name__ == "__main__":
     C = [ 18774.2, -2866.97, -5807.3, -4460.52, -2777.25, -1572.97, -846.653, -442.531,
        -2866.97, 496.273, 900.195, 667.591, 403.92, 222.614, 116.779, 59.5958,
@@ -11,10 +11,62 @@ import sys, os
 sys.path.append(os.path.abspath('./smodels'))
 from scipy import stats, optimize
 from smodels.tools.smodelsLogging import logger
-from scipy.special import erf
+from scipy.special import erf, erfcx, ndtr
 import numpy as np
 from smodels.tools import runtime
 
+_mumaxTable = None ## spline of mumax/sigma_exp as a function of log(upperLimit/expectedUpperLimit)
+_ratioRange = ( .05, 10. ) ## range of the ratios upperLimit/expectedUpperLimit covered by the table
+_log2pi = .5 * np.log ( 2. * np.pi )
+
+def _scaledRootFunc ( u, ratio ):
+    """ the root function of the truncated Gaussian (see likelihoodFromLimits),
+        in terms of u = mumax/expectedUpperLimit and ratio = upperLimit/expectedUpperLimit.
+        Written with the scaled complementary error function, so it can also be
+        evaluated for large negative values of u. """
+    c = 1.96 / np.sqrt(2.)
+    a, b = ( ratio - u ) * c, - u * c
+    return .05 - erfcx(a) / erfcx(b) * np.exp( b*b - a*a )
+
+def _buildMumaxTable ( npoints = 500 ):
+    """ compute the table of mumax/sigma_exp for the truncated Gaussian, which only
+        depends on the ratio upperLimit/expectedUpperLimit. """
+    from scipy.interpolate import CubicSpline
+    ratios = np.geomspace ( _ratioRange[0], _ratioRange[1], npoints )
+    mumaxs = []
+    for ratio in ratios:
+        if ratio > 1.:
+            xa, xb = 0., ratio
+        else:
+            xa, xb = -1., 0.
+            while _scaledRootFunc ( xa, ratio ) < 0.:
+                xa = 2*xa
+        if _scaledRootFunc ( xb, ratio ) == 0.:
+            mumaxs.append ( xb )
+            continue
+        mumaxs.append ( optimize.brentq ( _scaledRootFunc, xa, xb, args=(ratio,),
+                                          rtol=1e-12, xtol=1e-14 ) )
+    return CubicSpline ( np.log(ratios), 1.96*np.array(mumaxs) )
+
+def _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func ):
+    """ get the position of the maximum of the truncated Gaussian (mumax) from the
+        precomputed table, if the ratio of the limits is covered by the table
+        and the result passes the accuracy check.
+
+    :param root_func: the root function of mumax, used for the accuracy check
+    :returns: mumax, or None if the exact solution is needed
+    """
+    global _mumaxTable
+    ratio = upperLimit / expectedUpperLimit
+    if not _ratioRange[0] <= ratio <= _ratioRange[1]:
+        return None
+    if _mumaxTable is None:
+        _mumaxTable = _buildMumaxTable()
+    mumax = float ( _mumaxTable ( np.log(ratio) ) ) * expectedUpperLimit / 1.96
+    if not abs ( root_func ( mumax ) ) < 1e-6:
+        return None
+    return mumax
+
 
 def likelihoodFromLimits( upperLimit, expectedUpperLimit, nsig, nll=False, underfluct="norm_0"):
     """ computes the likelihood from an expected and an observed upper limit.
@@ -42,10 +94,12 @@ def likelihoodFromLimits( upperLimit, expectedUpperLimit, nsig, nll=False, under
         ## first compute how many sigmas left of center is 0.
         Zprime = mumax / sigma_exp
         ## now compute the area of the truncated gaussian
-        A = stats.norm.cdf(Zprime)
+        ## (scipy.special instead of scipy.stats, which has a large overhead per call)
+        A = ndtr(Zprime)
+        logpdf = - .5 * ( ( nsig - mumax ) / sigma_exp )**2 - np.log ( sigma_exp ) - _log2pi
         if nll:
-            return np.log(A ) - stats.norm.logpdf ( nsig, mumax, sigma_exp )
-        return float ( stats.norm.pdf ( nsig, mumax, sigma_exp ) / A )
+            return np.log(A ) - logpdf
+        return float ( np.exp ( logpdf ) / A )
 
     # sigma_exp = expectedUpperLimit / 1.96 # the expected scale, eq 3.24 in arXiv:1202.3415
     sigma_exp = getSigma ( expectedUpperLimit ) # the expected scale, eq 3.24 in arXiv:1202.3415
@@ -91,9 +145,11 @@ def likelihoodFromLimits( upperLimit, expectedUpperLimit, nsig, nll=False, under
         if underfluct == "norm_0":
             return llhd ( nsig, 0., sigma_exp, nll )
         elif underfluct == "norm_neg":
-            xa = -expectedUpperLimit
-            xb = 1
-            mumax = find_neg_mumax(upperLimit, expectedUpperLimit, xa, xb)
+            mumax = _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func )
+            if mumax is None:
+                xa = -expectedUpperLimit
+                xb = 1
+                mumax = find_neg_mumax(upperLimit, expectedUpperLimit, xa, xb)
             return llhd(nsig, mumax, sigma_exp, nll)
         elif underfluct == "exp":
             lam = getLam(upperLimit)
@@ -103,14 +159,16 @@ def likelihoodFromLimits( upperLimit, expectedUpperLimit, nsig, nll=False, under
 
     
    
-    fA = root_func ( 0. )
-    fB = root_func ( max(upperLimit,expectedUpperLimit) )
-    if np.sign(fA*fB) > 0.:
-        ## the have the same sign
-        logger.error ( "when computing likelihood: fA and fB have same sign")
-        return None
-    mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit),
-                              rtol=1e-03, xtol=1e-06 )
+    mumax = _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func )
+    if mumax is None:
+        fA = root_func ( 0. )
+        fB = root_func ( max(upperLimit,expectedUpperLimit) )
+        if np.sign(fA*fB) > 0.:
+            ## the have the same sign
+            logger.error ( "when computing likelihood: fA and fB have same sign")
+            return None
+        mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit),
+                                  rtol=1e-03, xtol=1e-06 )
     llhdexp = llhd ( nsig, mumax, sigma_exp, nll )
     return llhdexp
 
@@ -131,12 +189,14 @@ def rvsFromLimits( upperLimit, expectedUpperLimit, n=1 ):
     def root_func ( x ): ## we want the root of this one
         return (erf((upperLimit-x)/denominator)+erf(x/denominator)) / ( 1. + erf(x/denominator)) - .95
 
-    fA,fB = root_func ( 0. ), root_func ( max(upperLimit,expectedUpperLimit) )
-    if np.sign(fA*fB) > 0.:
-        ## the have the same sign
-        logger.error ( "when computing likelihood for %s: fA and fB have same sign" % self.analysisId() )
-        return None
-    mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit), rtol=1e-03, xtol=1e-06 )
+    mumax = _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func )
+    if mumax is None or mumax < 0.:
+        fA,fB = root_func ( 0. ), root_func ( max(upperLimit,expectedUpperLimit) )
+        if np.sign(fA*fB) > 0.:
+            ## the have the same sign
+            logger.error ( "when computing likelihood for %s: fA and fB have same sign" % self.analysisId() )
+            return None
+        mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit), rtol=1e-03, xtol=1e-06 )
     ret = []
     while len(ret)<n:
         tmp = stats.norm.rvs ( mumax, sigma_exp )
@@ -209,7 +269,7 @@ def llhdFromLimits_moments ( upperLimit, expectedUpperLimit, nll=False, underflu
         return float (stats.expon.pdf(nsig, scale=1/lam))
 
     def trunc_norm_moments(mumax, sigma):
-        rho = np.exp(-mumax**2/(2*sigma**2)) / (np.sqrt(2*np.pi)*(1 - stats.norm.cdf(0,loc=mumax,scale=sigma)))
+        rho = np.exp(-mumax**2/(2*sigma**2)) / (np.sqrt(2*np.pi)*ndtr(mumax/sigma))
         h = -mumax/sigma
 
         ev = mumax +(sigma*rho)
@@ -251,9 +311,11 @@ def llhdFromLimits_moments ( upperLimit, expectedUpperLimit, nll=False, underflu
             mumax = 0
             return trunc_norm_moments(mumax, sigma_exp)
         elif underfluct == "norm_neg":
-            xa = -expectedUpperLimit
-            xb = 1
-            mumax = find_neg_mumax(upperLimit, expectedUpperLimit, xa, xb)
+            mumax = _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func )
+            if mumax is None:
+                xa = -expectedUpperLimit
+                xb = 1
+                mumax = find_neg_mumax(upperLimit, expectedUpperLimit, xa, xb)
             return trunc_norm_moments(mumax, sigma_exp)
         elif underfluct == "exp":
             lam = getLam(upperLimit)
@@ -263,14 +325,16 @@ def llhdFromLimits_moments ( upperLimit, expectedUpperLimit, nll=False, underflu
 
     
    
-    fA = root_func ( 0. )
-    fB = root_func ( max(upperLimit,expectedUpperLimit) )
-    if np.sign(fA*fB) > 0.:
-        ## the have the same sign
-        logger.error ( "when computing likelihood: fA and fB have same sign")
-        return None
-    mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit),
-                              rtol=1e-03, xtol=1e-06 )
+    mumax = _mumaxFromTable ( upperLimit, expectedUpperLimit, root_func )
+    if mumax is None:
+        fA = root_func ( 0. )
+        fB = root_func ( max(upperLimit,expectedUpperLimit) )
+        if np.sign(fA*fB) > 0.:
+            ## the have the same sign
+            logger.error ( "when computing likelihood: fA and fB have same sign")
+            return None
+        mumax = optimize.brentq ( root_func, 0., max(upperLimit, expectedUpperLimit),
+                                  rtol=1e-03, xtol=1e-06 )
     return trunc_norm_moments(mumax, sigma_exp)
     
     
\ No newline at end of file
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: ulCache
+   :synopsis: Persistent (on-disk) cache of the upper limits computed from
+              the signal yields (simplified likelihoods and pyhf), shared by
+              all processes using the same file.
+
+"""
+
+import os,time,hashlib,sqlite3
+from smodels.tools.smodelsLogging import logger
+from smodels.tools import runtime
+from smodels import installation
+
+_cache = None ## the cache used by the datasets (see setCache)
+
+def setCache(cache):
+    """
+    Set the upper limit cache used when computing the upper limits
+    of the datasets (None switches the cache off).
+
+    :param cache: UpperLimitCache object or None
+    """
+    global _cache
+    _cache = cache
+
+def getCache():
+    """
+    Get the upper limit cache (None if the cache is off).
+    """
+    return _cache
+
+class UpperLimitCache(object):
+    """
+    Stores the upper limits in an SQLite file, keyed on the analysis id,
+    the dataset ids, the database version, the smodels version, the expected
+    flag, the (quantized) signal yields, the runtime settings of the
+    likelihoods and the remaining parameters of the computation (e.g. the
+    pyhf version and backend).
+    The file can be shared by concurrent processes. If the number of entries
+    exceeds maxEntries, the least recently used entries are removed.
+    """
+
+    def __init__(self, filename=None, maxEntries=100000, databaseVersion=None,
+                 digits=4, timeout=60.):
+        """
+        :param filename: name of the SQLite file. If None, ulcache.sqlite in the
+                         smodels cache directory (SMODELS_CACHEDIR) is used.
+        :param maxEntries: maximum number of entries (0 means no limit)
+        :param databaseVersion: version of the database, part of the keys
+        :param digits: number of significant digits kept for the signal yields
+        :param timeout: time (in seconds) to wait for the lock of the file
+        """
+
+        if filename is None:
+            from smodels.installation import cacheDirectory
+            filename = os.path.join(cacheDirectory(create=True),"ulcache.sqlite")
+        self.filename = filename
+        self.maxEntries = maxEntries
+        self.databaseVersion = databaseVersion
+        self.smodelsVersion = installation.version()
+        self.digits = digits
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+        self._nInserted = 0
+
+    def __getstate__(self):
+        """ the connection is not pickled """
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    def connection(self):
+        """
+        The connection to the SQLite file. A new connection is opened in
+        each (forked) process.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                                   isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.Error as e: ## e.g. not supported by the file system
+                logger.debug("Could not use WAL mode for %s: %s" %(self.filename,e))
+            conn.execute("CREATE TABLE IF NOT EXISTS uls (key TEXT PRIMARY KEY,"
+                         " value REAL, info TEXT, atime REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS atimes ON uls (atime)")
+            self._connection = conn
+            self._pid = os.getpid()
+        return self._connection
+
+    def quantize(self, x):
+        """ round x to self.digits significant digits """
+        return float("%.*g" %(self.digits,x))
+
+    def key(self, analysisID, datasetIDs, expected, nsig, **kwargs):
+        """
+        Build the key for an upper limit.
+
+        :param analysisID: id of the analysis
+        :param datasetIDs: list of the dataset ids
+        :param expected: expected flag of the upper limit
+        :param nsig: list of signal yields (one per dataset)
+        :param kwargs: further parameters of the computation
+                       (e.g. deltas_rel, marginalize or the pyhf version)
+        :return: key (string)
+        """
+
+        signals = [self.quantize(float(s)) for s in nsig]
+        items = [analysisID,list(datasetIDs),self.databaseVersion,
+                 self.smodelsVersion,str(expected),signals,
+                 runtime._cap_likelihoods,runtime._drmax,sorted(kwargs.items())]
+        return hashlib.sha1(repr(items).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Get the upper limit for key.
+
+        :return: tuple with the upper limit (None, if no limit was found)
+                 and the additional information, or None if key is not
+                 in the cache.
+        """
+        try:
+            conn = self.connection()
+            row = conn.execute("SELECT value,info FROM uls WHERE key=?",
+                               (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE uls SET atime=? WHERE key=?",(time.time(),key))
+        except sqlite3.Error as e:
+            logger.warning("Could not read from the upper limit cache %s: %s"
+                           %(self.filename,e))
+            return None
+        self.hits += 1
+        return row
+
+    def set(self, key, value, info=None):
+        """
+        Store the upper limit for key. If the cache is full, the least
+        recently used entries are removed.
+
+        :param value: upper limit (float or None)
+        :param info: additional information (string)
+        """
+        try:
+            conn = self.connection()
+            conn.execute("INSERT OR REPLACE INTO uls VALUES (?,?,?,?)",
+                         (key,value,info,time.time()))
+            self._nInserted += 1
+            ## check the size only every few insertions
+            if self.maxEntries and self._nInserted % max(1,self.maxEntries//100) == 0:
+                self.evict()
+        except sqlite3.Error as e:
+            logger.warning("Could not write to the upper limit cache %s: %s"
+                           %(self.filename,e))
+
+    def evict(self):
+        """
+        Remove the least recently used entries, if the number of entries
+        exceeds self.maxEntries.
+        """
+        conn = self.connection()
+        n = conn.execute("SELECT COUNT(*) FROM uls").fetchone()[0]
+        if n <= self.maxEntries:
+            return
+        ## keep 90% of the maximum, so we do not evict at every insertion
+        nRemove = n - int(.9*self.maxEntries)
+        conn.execute("DELETE FROM uls WHERE key IN (SELECT key FROM uls"
+                     " ORDER BY atime LIMIT ?)",(nRemove,))
+        logger.debug("Removed %i entries from the upper limit cache" %nRemove)
+
+    def clear(self):
+        """ remove all entries """
+        self.connection().execute("DELETE FROM uls")
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM uls").fetchone()[0]
+
+    def report(self):
+        """ report on the usage of the cache """
+        return "upper limit cache %s: %i hits, %i misses" %(self.filename,self.hits,self.misses)
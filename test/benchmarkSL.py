@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: benchmarkSL
+   :synopsis: Micro-benchmark of the negative log likelihood of the simplified
+              likelihoods (LikelihoodComputer.nll), compared with the
+              evaluation via scipy.stats, for 1, 10 and 100 signal regions.
+
+"""
+
+import sys,time
+sys.path.insert(0,"../")
+import numpy as np
+from scipy import stats
+from smodels.tools.simplifiedLikelihoods import Data, LikelihoodComputer
+
+def createModel(n, seed=1):
+    """ a random model with n signal regions and a correlated covariance matrix """
+    rng = np.random.RandomState(seed)
+    bg = rng.uniform(5.,100.,n)
+    A = rng.normal(size=(n,n))*.1
+    cov = np.diag(.1*bg) + np.dot(A,A.T)*.01*bg.mean()
+    return Data(list(np.round(bg)), list(bg), [ list(r) for r in cov ],
+                nsignal=list(np.ones(n)), name="model%d" % n)
+
+def scipyNll(computer, theta):
+    """ the nll evaluated with the scipy.stats distributions for every call """
+    model = computer.model
+    lmbda = model.backgrounds + computer.nsig + theta
+    lmbda[lmbda<=0.] = 1e-30
+    poisson = stats.poisson.logpmf(model.observed, lmbda)
+    gaussian = stats.multivariate_normal.logpdf(theta, mean=[0.]*len(theta), cov=model.V)
+    return - gaussian - sum(poisson)
+
+def timePerCall(func, theta, ncalls):
+    """ average time per call, in microseconds """
+    func(theta)
+    t0 = time.time()
+    for i in range(ncalls):
+        func(theta)
+    return (time.time()-t0)/ncalls*1e6
+
+def run(ncalls=2000):
+    print("%5s %15s %15s %8s %10s" % ("nSR","scipy [us]","numpy [us]","speedup","rel.diff"))
+    for n in [ 1, 10, 100 ]:
+        model = createModel(n)
+        computer = LikelihoodComputer(model)
+        computer.nsig = model.signals(float(n))
+        theta = np.random.RandomState(2).normal(size=n)*.1
+        tScipy = timePerCall(lambda x: scipyNll(computer,x), theta, ncalls)
+        tNumpy = timePerCall(computer.nll, theta, ncalls)
+        diff = abs(computer.nll(theta)/scipyNll(computer,theta)-1.)
+        print("%5d %15.1f %15.1f %8.1f %10.1e" % (n,tScipy,tNumpy,tScipy/tNumpy,diff))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: benchmarkUnits
+   :synopsis: Benchmark of the cost of the physical units: measures the
+              end-to-end runtime (decomposition and theory predictions) for
+              the test SLHA files and the fraction of it spent in the unum
+              package (masses, widths and cross sections with units).
+
+"""
+
+import sys,time,os
+import cProfile,pstats
+sys.path.insert(0,"../")
+from smodels.tools.physicsUnits import fb, GeV
+from smodels.theory import decomposer
+from smodels.theory.theoryPrediction import theoryPredictionsFor
+from smodels.theory.model import Model
+from smodels.share.models.mssm import BSMList
+from smodels.share.models.SMparticles import SMList
+from databaseLoader import database
+import unum
+
+slhafiles = [ "416126634.slha", "complicated.slha", "gluino_squarks.slha",
+              "lightEWinos.slha", "higgsinoStop.slha", "simplyGluino.slha" ]
+
+def runFile(slhafile, expResults):
+    """ decompose slhafile and compute the theory predictions
+    :return: list of the results
+    """
+    model = Model(BSMparticles=BSMList, SMparticles=SMList)
+    model.updateParticles("./testFiles/slha/"+slhafile)
+    topos = decomposer.decompose(model, 0.005*fb, doCompress=True,
+                                 doInvisible=True, minmassgap=5*GeV)
+    ret = []
+    for expRes in expResults:
+        preds = theoryPredictionsFor(expRes, topos, combinedResults=False)
+        if not preds:
+            continue
+        for pred in preds:
+            ret.append((pred.analysisId(), pred.dataset.getID(),
+                        pred.xsection.value.asNumber(fb),
+                        pred.getUpperLimit().asNumber(fb)))
+    return sorted(ret)
+
+def unumFraction(slhafile, expResults):
+    """ fraction of the (profiled) running time spent inside unum """
+    profile = cProfile.Profile()
+    profile.runcall(runFile, slhafile, expResults)
+    stats = pstats.Stats(profile).stats
+    unumDir = os.path.dirname(unum.__file__)
+    total = sum([v[2] for v in stats.values()])
+    inUnum = sum([v[2] for k,v in stats.items() if k[0].startswith(unumDir)])
+    return inUnum/total
+
+def run():
+    expResults = database.getExpResults()
+    print("%25s %12s %12s" % ("file","time [s]","in unum"))
+    for slhafile in slhafiles:
+        t0 = time.time()
+        runFile(slhafile, expResults)
+        dt = time.time()-t0
+        print("%25s %12.2f %11.1f%%" % (slhafile,dt,100.*unumFraction(slhafile, expResults)))
+
+if __name__ == "__main__":
+    run()
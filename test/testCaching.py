@@ -3,7 +3,7 @@
 """
 .. module:: testCaching
    :synopsis: Tests the interpolation caching,
-        the cache should be slahsed into half after n_stored entries
+        the cache should keep the n_stored most recently used entries
 
 .. moduleauthor:: Wolfgang Waltenberger <wolfgang.waltenberger@gmail.com>
 
@@ -29,10 +29,58 @@ class CachingTest(unittest.TestCase):
         for masses in massesvec:
             txname.txnameData.getValueFor( [ masses, masses ])
         #    print masses,result,Cache.size()
-        self.assertEqual ( Cache.size(), 7 )
+        self.assertEqual ( Cache.size(), 10 )
+        stats = Cache.statistics()["TxNameData.getValueForPoint"]
+        self.assertEqual ( stats["misses"], 12 )
+        self.assertEqual ( stats["evictions"], 2 )
         m = [ [ 270*GeV, 100*GeV], [ 270*GeV, 100*GeV ] ]
         result=txname.txnameData.getValueFor(m)
         self.assertAlmostEqual(result.asNumber(fb) , 459.658) 
+        stats = Cache.statistics()["TxNameData.getValueForPoint"]
+        self.assertEqual ( stats["hits"], 1 )
+        ## the oldest entries have been evicted
+        txname.txnameData.getValueFor( [ massesvec[0], massesvec[0] ] )
+        stats = Cache.statistics()["TxNameData.getValueForPoint"]
+        self.assertEqual ( stats["misses"], 13 )
+        self.assertEqual ( Cache.size(), 10 )
+
+    def testStaleEntries(self):
+        """ entries keyed by the id of a garbage collected object
+            are not returned """
+        from smodels.tools.caching import _memoize
+        class Data:
+            def __init__ ( self, value ):
+                self.value = value
+            def __str__ ( self ):
+                return "data"
+            @_memoize
+            def getValue ( self ):
+                return self.value
+        Cache.n_stored = 10
+        Cache.reset()
+        data = Data ( 1 )
+        self.assertEqual ( data.getValue(), 1 )
+        self.assertEqual ( data.getValue(), 1 )
+        key = list ( Cache._cache.keys() )[0]
+        del data
+        ## the key (and thus the id) may be reused by a new object
+        self.assertTrue ( Cache.get ( key ) is Cache._missing )
+        self.assertEqual ( Cache.size(), 0 )
+        self.assertEqual ( Data ( 2 ).getValue(), 2 )
+        stats = Cache.statistics()["CachingTest.testStaleEntries.<locals>.Data.getValue"]
+        self.assertEqual ( stats["hits"], 1 )
+        self.assertEqual ( stats["misses"], 3 )
+
+    def testAddStatistics(self):
+        """ statistics of the worker processes are added to the parent's """
+        Cache.reset()
+        Cache._getStats ( "f" )["hits"] += 1
+        Cache.addStatistics ( { "f": { "hits": 2, "misses": 3, "evictions": 0 },
+                                "g": { "hits": 0, "misses": 1, "evictions": 0 } } )
+        self.assertEqual ( Cache.statistics()["f"], { "hits": 3, "misses": 3, "evictions": 0 } )
+        self.assertEqual ( Cache.statistics()["g"]["misses"], 1 )
+        Cache.resetStatistics()
+        self.assertEqual ( Cache.statistics(), {} )
 
 if __name__ == "__main__":
     unittest.main()
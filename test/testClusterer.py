@@ -210,6 +210,79 @@ class ClustererTest(unittest.TestCase):
         clusters = clusterElements([el1,el2,el3],maxDist=0.1,dataset=dataset)
         self.assertEqual(len(clusters),2)
 
+    def testManyElements(self):
+        """ test the clustering of many elements """
+
+        slhafile = 'testFiles/slha/lightEWinos.slha'
+        model = Model(BSMparticles=BSMList, SMparticles=SMList)
+        model.updateParticles(slhafile)
+        toplist = decomposer.decompose(model, 5.*fb, doCompress=True, doInvisible=True, minmassgap=5.*GeV)
+        dataset = database.getExpResults(analysisIDs='ATLAS-SUSY-2013-02',datasetIDs=None)[0].getDataset(None)
+        txname = [tx for tx in dataset.txnameList if tx.txName == 'T1'][0]
+
+        elements = []
+        for i in range(200):
+            el = toplist[1].elementList[0].copy()
+            el.motherElements = [el] #Enforce elements not to be related
+            el.mass = [[(600.+3.*i)*GeV,(50.+(7*i)%250)*GeV]]*2
+            el.txname = txname
+            el.eff = 1.
+            elements.append(el)
+
+        maxDist = 0.2
+        clusters = clusterElements(elements,maxDist=maxDist,dataset=dataset)
+        self.assertTrue(len(clusters) < len(elements))
+        #All elements are clustered
+        self.assertEqual(set([id(el) for c in clusters for el in c]),set([id(el) for el in elements]))
+        clusterIds = [set([id(el) for el in c]) for c in clusters]
+        for ic,cluster in enumerate(clusters):
+            uls = [el._upperLimit.asNumber(fb) for el in cluster]
+            distances = clusterTools.getDistanceMatrix(uls)
+            self.assertTrue(distances.max() < maxDist)
+            self.assertAlmostEqual(distances[0,-1],
+                                   clusterTools.relativeDistance(cluster[0],cluster[-1],dataset))
+            if len(cluster) > 1:
+                avgEl = cluster.averageElement()
+                self.assertTrue(max([clusterTools.relativeDistance(avgEl,el,dataset)
+                                     for el in cluster]) <= maxDist)
+            #No cluster is contained in another one
+            self.assertFalse(any(clusterIds[ic] <= other for jc,other in enumerate(clusterIds) if jc != ic))
+
+    def testPrefetchUpperLimits(self):
+        """ test the batched computation of the upper limits """
+
+        slhafile = 'testFiles/slha/lightEWinos.slha'
+        model = Model(BSMparticles=BSMList, SMparticles=SMList)
+        model.updateParticles(slhafile)
+        toplist = decomposer.decompose(model, 5.*fb, doCompress=True, doInvisible=True, minmassgap=5.*GeV)
+        dataset = database.getExpResults(analysisIDs='ATLAS-SUSY-2013-02',datasetIDs=None)[0].getDataset(None)
+        txname = [tx for tx in dataset.txnameList if tx.txName == 'T1'][0]
+
+        elements = []
+        for i in range(20):
+            el = toplist[1].elementList[0].copy()
+            el.motherElements = [el]
+            el.mass = [[(600.+20.*i)*GeV,(100.+5.*i)*GeV]]*2
+            el.txname = txname
+            el.eff = 1.
+            elements.append(el)
+        clusterTools.prefetchUpperLimits(elements,dataset)
+        for el in elements:
+            ul = dataset.getUpperLimitFor(el,txnames=txname)
+            self.assertAlmostEqual(el._upperLimit.asNumber(fb),ul.asNumber(fb))
+
+        #The average elements of the clusters are computed when clustering
+        clusters = clusterElements(elements,maxDist=0.2,dataset=dataset)
+        for cluster in clusters:
+            avgEl = cluster.averageElement()
+            self.assertTrue(avgEl is cluster.averageElement())
+            ul = dataset.getUpperLimitFor(avgEl,txnames=txname)
+            self.assertAlmostEqual(avgEl._upperLimit.asNumber(fb),ul.asNumber(fb))
+        #but not if the cluster changes
+        cluster = clusters[0]
+        cluster.elements = cluster.elements[:1]
+        self.assertEqual(len(cluster.averageElement().elements),1)
+
     def testClustererLifeTimes(self):
         """ test the clustering with distinct lifetimes"""
 
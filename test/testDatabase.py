@@ -34,6 +34,117 @@ class DatabaseTest(unittest.TestCase):
         os.unlink ( binfile )
         self.assertEqual( writer, reader )
 
+    def testWriteMmap(self):
+        """ tests writing and lazily reading the memory-mappable format """
+        binfile = "./.database.smdb"
+        if os.path.exists ( binfile ):
+            os.unlink ( binfile )
+        writer = Database ( "./tinydb/", force_load = "txt" )
+        writer.createBinaryFile ( binfile )
+        reader = Database ( binfile )
+        self.assertEqual( writer, reader )
+
+        from databaseLoader import database
+        database.createBinaryFile ( binfile )
+        reader = Database ( binfile )
+        ids = ['*:8*TeV','CMS-PAS-SUS-15-002','CMS-PAS-SUS-16-024']
+        selected = reader.getExpResults(analysisIDs=ids)
+        ## only the results matching the ids are loaded
+        ## (the validation flags are stored in the txnames)
+        loaded = [ reader.expResultList.isLoaded(i) for i in range(len(reader.expResultList)) ]
+        matching = database.getExpResults(analysisIDs=ids, useNonValidated=True)
+        self.assertEqual( sum(loaded), len(matching) )
+        self.assertTrue( sum(loaded) < len(loaded) )
+        self.assertEqual( selected, database.getExpResults(analysisIDs=ids) )
+        txnames = reader.getExpResults(txnames=['T1'])
+        self.assertEqual( txnames, database.getExpResults(txnames=['T1']) )
+        txnameData = txnames[0].getTxNames()[0].txnameData
+        self.assertFalse( txnameData.tri.simplices.flags.writeable )
+        os.unlink ( binfile )
+
+    def testMmapSharedArrays(self):
+        """ tests that shared arrays are written once, and that the
+            summary does not load the results """
+        binfile = "./.database.smdb"
+        if os.path.exists ( binfile ):
+            os.unlink ( binfile )
+        writer = Database ( "./tinydb/", force_load = "txt" )
+        txnameData = writer.expResultList[0].getTxNames()[0].txnameData
+        writer.createBinaryFile ( binfile )
+        size = os.path.getsize ( binfile )
+        txnameData.shared_values = txnameData.y_values
+        writer.createBinaryFile ( binfile )
+        self.assertTrue ( os.path.getsize ( binfile ) - size < 100 )
+        reader = Database ( binfile )
+        self.assertEqual ( str(reader), str(writer) )
+        self.assertFalse ( reader.expResultList.isLoaded ( 0 ) )
+        loaded = reader.expResultList[0].getTxNames()[0].txnameData
+        self.assertTrue ( loaded.shared_values is loaded.y_values )
+        os.unlink ( binfile )
+
+    def testLazyLoading(self):
+        """ tests building the txname data only when needed """
+        import pickle
+        from smodels.experiment import sharedArrays
+        eager = Database ( "./tinydb/", force_load = "txt", subpickle = False )
+        lazy = Database ( "./tinydb/", force_load = "txt", lazyLoading = True )
+        txnameDatas = sharedArrays.getTxNameDatas ( lazy.expResultList )
+        self.assertTrue ( len(txnameDatas) > 0 )
+        self.assertFalse ( any ( [ t.isLoaded() for t in txnameDatas ] ) )
+        self.assertEqual( lazy.getExpResults(), eager.getExpResults() )
+        ## selecting only parses the data, it does not build the triangulations
+        self.assertFalse ( any ( [ t.isLoaded() for t in txnameDatas ] ) )
+        for lazyTx,eagerTx in zip ( lazy.getExpResults()[0].getTxNames(),
+                                    eager.getExpResults()[0].getTxNames() ):
+            lazyData,eagerData = lazyTx.txnameData,eagerTx.txnameData
+            point = eagerData.tri.points[0]
+            value = eagerData.getValueForPoint ( point )
+            self.assertTrue ( value is not None )
+            self.assertEqual ( lazyData.getValueForPoint ( point ), value )
+            self.assertTrue ( lazyData.isLoaded() )
+        ## pickled objects are never lazy
+        txnameData = txnameDatas[-1]
+        copied = pickle.loads ( pickle.dumps ( txnameData ) )
+        self.assertTrue ( txnameData.isLoaded() and copied.isLoaded() )
+
+    def testLazyLoadingFilter(self):
+        """ tests that txnames dropped by the filters are not parsed """
+        lazy = Database ( "./database/", force_load = "txt", lazyLoading = True )
+        results = lazy.getExpResults( analysisIDs = [ "CMS-PAS-SUS-15-002" ],
+                                      txnames = [ "T1" ] )
+        self.assertEqual ( [ str(tx) for tx in results[0].getTxNames() ], [ "T1" ] )
+        expResult = [ er for er in lazy.expResultList if \
+                      er.globalInfo.id == "CMS-PAS-SUS-15-002" ][0]
+        parsed = {}
+        for txname in expResult.getTxNames():
+            parsed[txname.txName] = not "_value" in txname.txnameData.__dict__
+        self.assertTrue ( parsed["T1"] )
+        self.assertFalse ( parsed["T1tttt"] )
+
+    def testLazyLoadingNoPickle(self):
+        """ tests that lazy loading parses the text database by default,
+            without writing a pickle file """
+        from smodels.experiment import sharedArrays
+        lazy = Database ( "./tinydb/", lazyLoading = True )
+        self.assertEqual ( lazy.force_load, "txt" )
+        self.assertFalse ( os.path.exists ( lazy.pcl_meta.pathname ) )
+        txnameDatas = sharedArrays.getTxNameDatas ( lazy.expResultList )
+        self.assertFalse ( any ( [ t.isLoaded() for t in txnameDatas ] ) )
+
+    def testLazyLoadingOption(self):
+        """ tests enabling the lazy loading in the parameter file """
+        from configparser import ConfigParser
+        from smodels.tools import modelTester
+        from smodels.experiment import sharedArrays
+        parser = ConfigParser()
+        parser.read_dict ( { "database" : { "path" : "./tinydb/",
+                                            "lazyLoading" : "True" } } )
+        db, dbVersion = modelTester.loadDatabase ( parser, None )
+        self.assertTrue ( db.lazyLoading )
+        txnameDatas = sharedArrays.getTxNameDatas ( db.expResultList )
+        self.assertTrue ( len(txnameDatas) > 0 )
+        self.assertFalse ( any ( [ t.isLoaded() for t in txnameDatas ] ) )
+
     def testSelectors(self):
         from databaseLoader import database
         validated = database.getExpResults(analysisIDs=['*:8*TeV','CMS-PAS-SUS-15-002','CMS-PAS-SUS-16-024'],
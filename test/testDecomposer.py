@@ -10,6 +10,7 @@
 """
 import unittest
 import sys
+import tempfile
 sys.path.insert(0,"../")
 from smodels.share.models.mssm import BSMList
 from smodels.share.models.SMparticles import SMList
@@ -81,6 +82,117 @@ class DecomposerTest(unittest.TestCase):
             xsec = el.weight.getXsecsFor(8.*TeV)[0].value.asNumber(fb)
             self.assertAlmostEqual(expectedWeights[bsmLabels], xsec,2)
 
+    def testDecomposition(self):
+
+        def getWeights(topList):
+            return sorted([(str(el),el.weight.niceStr()) for el in topList.getElements()])
+
+        filename = "./testFiles/slha/higgsinoStop.slha"
+        model = Model(BSMList,SMList)
+        model.updateParticles(filename)
+        decomposition = decomposer.Decomposition(sigmacut=0.1*fb, minmassgap=5.*GeV)
+        topos = decomposition.decompose(model)
+        self.assertEqual(decomposition.lastUpdate,"all")
+        self.assertEqual(getWeights(topos),
+                         getWeights(decomposer.decompose(model, sigmacut=0.1*fb, minmassgap=5.*GeV)))
+        #The weights are traced when the same pairs of branches appear again:
+        topos = decomposition.decompose(model)
+        self.assertEqual(decomposition.lastUpdate,"elements")
+        self.assertEqual(decomposition.nDecayed,0)
+        topos = decomposition.decompose(model)
+        self.assertEqual(decomposition.lastUpdate,"weights")
+        self.assertEqual(decomposition.nDecayed,0)
+
+        #Change the cross sections and a branching ratio:
+        for xsec in model.xsections:
+            xsec.value = 1.3*xsec.value
+        particle = [p for p in model.BSMparticles if len([d for d in p.decays if d]) > 1][0]
+        decays = [d for d in particle.decays if d]
+        dBR = 0.1*decays[0].br
+        decays[0].br -= dBR
+        decays[1].br += dBR
+        topos = decomposition.decompose(model)
+        self.assertIn(decomposition.lastUpdate,["elements","weights"])
+        self.assertEqual(getWeights(topos),
+                         getWeights(decomposer.decompose(model, sigmacut=0.1*fb, minmassgap=5.*GeV)))
+
+    def testDecompositionNewModel(self):
+
+        def getWeights(topList):
+            return sorted([(str(el),el.weight.niceStr()) for el in topList.getElements()])
+
+        def getParticles(topList):
+            return [ptc for el in topList.getElements() for branch in el.branches
+                    for ptc in branch.oddParticles if ptc.label != 'inv']
+
+        filename = "./testFiles/slha/higgsinoStop.slha"
+        model = Model(BSMList,SMList)
+        model.updateParticles(filename)
+        decomposition = decomposer.Decomposition(sigmacut=0.1*fb, minmassgap=5.*GeV)
+        decomposition.decompose(model)
+        decomposition.decompose(model)
+
+        #A new model with the same masses and widths only updates the weights:
+        newModel = Model(BSMList,SMList)
+        newModel.updateParticles(filename)
+        topos = decomposition.decompose(newModel)
+        self.assertEqual(decomposition.lastUpdate,"weights")
+        self.assertEqual(getWeights(topos),
+                         getWeights(decomposer.decompose(newModel, sigmacut=0.1*fb, minmassgap=5.*GeV)))
+        particles = [id(ptc) for ptc in newModel.BSMparticles]
+        self.assertTrue(all(id(ptc) in particles for ptc in getParticles(topos)))
+
+        #Change the cross sections and branching ratios in the SLHA file:
+        with open(filename) as f:
+            lines = f.readlines()
+        inXsec = False
+        for i,line in enumerate(lines):
+            if line.startswith('XSECTION'):
+                inXsec = True
+            elif inXsec and line.strip():
+                fields = line.split()
+                fields[6] = str(0.7*float(fields[6]))
+                lines[i] = '  '+'  '.join(fields)+'\n'
+            else:
+                inXsec = False
+        slha = ''.join(lines)
+        slha = slha.replace('2.30885744E-01    2     1000022','1.30885744E-01    2     1000022')
+        slha = slha.replace('2.11305478E-01    2     1000023','3.11305478E-01    2     1000023')
+        with tempfile.NamedTemporaryFile(mode='w',suffix='.slha') as f:
+            f.write(slha)
+            f.flush()
+            newModel = Model(BSMList,SMList)
+            newModel.updateParticles(f.name)
+        topos = decomposition.decompose(newModel)
+        self.assertIn(decomposition.lastUpdate,["elements","weights"])
+        self.assertEqual(getWeights(topos),
+                         getWeights(decomposer.decompose(newModel, sigmacut=0.1*fb, minmassgap=5.*GeV)))
+        particles = [id(ptc) for ptc in newModel.BSMparticles]
+        self.assertTrue(all(id(ptc) in particles for ptc in getParticles(topos)))
+
+        #Swap the largest and smallest BRs of the heavy charginos, so that
+        #subtrees below sigmacut are expanded and others are cut:
+        before = set([str(el) for el in topos.getElements()])
+        for pdg in [1000037,-1000037]:
+            particle = newModel.getParticlesWith(pdg=pdg)[0]
+            decays = sorted([d for d in particle.decays if d], key=lambda d: d.br)
+            decays[0].br,decays[-1].br = decays[-1].br,decays[0].br
+        topos = decomposition.decompose(newModel)
+        after = set([str(el) for el in topos.getElements()])
+        self.assertEqual(decomposition.lastUpdate,"elements")
+        self.assertTrue(decomposition.nDecayed > 0)
+        self.assertTrue(after - before)
+        self.assertTrue(before - after)
+        self.assertEqual(getWeights(topos),
+                         getWeights(decomposer.decompose(newModel, sigmacut=0.1*fb, minmassgap=5.*GeV)))
+
+        #Changing a mass recomputes everything:
+        newModel = Model(BSMList,SMList)
+        newModel.updateParticles(filename)
+        newModel.getParticlesWith(pdg=1000022)[0].mass = 10.*GeV
+        topos = decomposition.decompose(newModel)
+        self.assertEqual(decomposition.lastUpdate,"all")
+
     def testCompression(self):
 
         filename = "./testFiles/slha/higgsinoStop.slha"
@@ -61,6 +61,30 @@ class InterpolationTest(unittest.TestCase):
         result=txname.txnameData.getValueFor(
                 [[ 300.*GeV,270.*GeV,200.*GeV], [ 300.*GeV,271.*GeV,200.*GeV] ])
         self.assertAlmostEqual( result.asNumber(pb), 88.6505675 )
+    def testBatchInterpolation(self):
+        expRes = database.getExpResults(analysisIDs=["ATLAS-SUSY-2013-05"],
+                txnames=[ "T6bbWW" ] )
+        txname=expRes[0].datasets[0].txnameList[0] # T6bbWW
+        masses = [ [[ 300.*GeV,105.*GeV,100.*GeV], [ 300.*GeV,105.*GeV,100.*GeV] ],
+                   [[ 300.*GeV,270.*GeV,200.*GeV], [ 300.*GeV,270.*GeV,200.*GeV] ],
+                   [[ 300.*GeV,270.*GeV,200.*GeV], [ 300.*GeV,271.*GeV,200.*GeV] ],
+                   [[ 3000.*GeV,270.*GeV,200.*GeV], [ 3000.*GeV,270.*GeV,200.*GeV] ] ]
+        results = txname.getULsFor(masses)
+        self.assertEqual(len(results),len(masses))
+        for m,result in zip(masses,results):
+            single = txname.getULFor(m)
+            if single is None:
+                self.assertTrue(result is None)
+            else:
+                self.assertAlmostEqual(result.asNumber(pb),single.asNumber(pb))
+        self.assertAlmostEqual( results[0].asNumber(pb),0.176266 )
+        self.assertAlmostEqual( results[2].asNumber(pb), 88.6505675 )
+        self.assertTrue( results[3] is None )
+        uls = expRes[0].datasets[0].getUpperLimitsFor(masses,txnames=txname)
+        self.assertAlmostEqual( uls[1].asNumber(pb), 87.0403 )
+        effs = txname.getEfficienciesFor(masses)
+        self.assertEqual(effs,[1.,1.,1.,0.])
+
     def testOutsidePlane(self):
         expRes = database.getExpResults( analysisIDs=["ATLAS-SUSY-2013-05"], 
                                          txnames=["T2bb" ] )
@@ -111,6 +135,12 @@ class InterpolationTest(unittest.TestCase):
                 sys._getframe().f_code.co_name )
         result=txnameData.getValueFor([[ 300.*GeV,125.*GeV], [ 300.*GeV,125.*GeV] ])
         self.assertAlmostEqual( result,0.115 ) 
+        results=txnameData.getValuesFor([[[ 300.*GeV,125.*GeV], [ 300.*GeV,125.*GeV] ],
+                                         [[ 300.*GeV,125.*GeV], [ 300.*GeV,100.*GeV] ],
+                                         [[ 350.*GeV,200.*GeV], [ 350.*GeV,200.*GeV] ]])
+        self.assertAlmostEqual( results[0],0.115 ) 
+        self.assertEqual( results[1], None )
+        self.assertAlmostEqual( results[2],0.135 ) 
         
     def testOutsideConvexHull( self ):
         data = [ [ [[ 150.*GeV, 50.*GeV], [ 150.*GeV, 50.*GeV] ],  .03 ], 
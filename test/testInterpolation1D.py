@@ -48,6 +48,11 @@ class Interpolation1DTest(unittest.TestCase):
         result=txnameData.getValueFor([[ 2000.*GeV]]*2)
         self.assertEqual( result,None)
         
+        #Check batch interpolation:
+        results=txnameData.getValuesFor([[[ 1100.*GeV]]*2,[[ 2000.*GeV]]*2])
+        self.assertAlmostEqual( results[0].asNumber(pb),0.00049953) 
+        self.assertEqual( results[1],None)
+
         #Check class methods:
         isimplex = txnameData.tri.find_simplex(np.array([350.-dataShift]))
         self.assertEqual(isimplex,3)
@@ -86,6 +86,26 @@ class ParticleTest(unittest.TestCase):
         self.assertTrue(l1 == p1)
         self.assertTrue(l1.pdg == [None,1000021] or l1.pdg == [1000021,None])
 
+    def testParticleInterning(self):
+        import pickle
+        from smodels.theory.particle import ParticleList
+        pA = Particle(Z2parity=-1, label='pA', pdg=3000001, mass=100.*GeV)
+        pB = Particle(Z2parity=-1, label='pA', pdg=3000001, mass=100.*GeV)
+        self.assertTrue(pA is pB)
+        #The index must follow changes in the particle attributes:
+        pA.mass = 200.*GeV
+        pC = Particle(Z2parity=-1, label='pA', pdg=3000001, mass=100.*GeV)
+        self.assertFalse(pC is pA)
+        pD = Particle(Z2parity=-1, label='pA', pdg=3000001, mass=200.*GeV)
+        self.assertTrue(pD is pA)
+        #Unpickling goes through the same path:
+        self.assertTrue(pickle.loads(pickle.dumps(pA)) is pA)
+        mp = MultiParticle(label='mpA', particles=[pA,pC])
+        self.assertTrue(MultiParticle(label='mpB', particles=[pC,pA]) is mp)
+        self.assertTrue(pickle.loads(pickle.dumps(mp)) is mp)
+        pl = ParticleList([pA,pC])
+        self.assertTrue(ParticleList([pC,pA]) is pl)
+
     def testChargeConjugation(self):
         p5cc = p5.chargeConjugate()
         p3cc = p3.chargeConjugate()
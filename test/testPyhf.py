@@ -14,6 +14,7 @@ import unittest
 import json
 import jsonpatch
 from smodels.tools.pyhfInterface import PyhfData, PyhfUpperLimitComputer, pyhf
+from smodels.tools import runtime
 
 class PyhfTest(unittest.TestCase):
 
@@ -336,6 +337,54 @@ class PyhfTest(unittest.TestCase):
             CLs = float(result)
         self.assertAlmostEqual(CLs, 0.05, 2)
 
+    def testModelReuse(self):
+        """
+        Tests that the pyhf models are built once and reused when the
+        signals are rescaled
+        """
+        ws = self.simpleJson([0.8, 0.9], [10, 11])
+        data = PyhfData([[0.4, 0.2]], [ws])
+        ulcomputer = PyhfUpperLimitComputer(data)
+        model, _ = ulcomputer.getModel()
+        workspaces = ulcomputer.workspaces
+        ul = ulcomputer.ulSigma()
+        self.assertIs(ulcomputer.workspaces, workspaces)
+        self.assertIs(ulcomputer.getModel()[0], model)
+        # The same limit is found for a rescaled signal
+        data2 = PyhfData([[0.04, 0.02]], [ws])
+        ul2 = PyhfUpperLimitComputer(data2).ulSigma()
+        self.assertAlmostEqual(ul/ul2, 0.1, 2)
+        # A new computer for the same data reuses the workspaces and models
+        ulcomputer = PyhfUpperLimitComputer(data)
+        self.assertIs(ulcomputer.workspaces, workspaces)
+        self.assertIs(ulcomputer.getModel()[0], model)
+        self.assertAlmostEqual(ulcomputer.ulSigma()/ul, 1., 5)
+        llhd = ulcomputer.likelihood()
+        chi2 = ulcomputer.chi2()
+        self.assertAlmostEqual(ulcomputer.likelihood()/llhd, 1., 5)
+        self.assertAlmostEqual(ulcomputer.chi2(), chi2, 5)
+
+    def testParallelFits(self):
+        """
+        Tests the fits of several workspaces in parallel (processes and threads)
+        """
+        wss = [self.simpleJson([0.8], [1]), self.simpleJson([5.], [4]),
+               self.simpleJson([0.5], [2])]
+        data = PyhfData([[0.4], [0.], [0.3]], wss)
+        ulcomputer = PyhfUpperLimitComputer(data)
+        uls = ulcomputer.ulSigmas(expected=True, ncpus=1)
+        self.assertIsNone(uls[1])
+        ulsP = PyhfUpperLimitComputer(data).ulSigmas(expected=True, ncpus=3)
+        runtime._pyhfThreads = True
+        try:
+            ulsT = PyhfUpperLimitComputer(data).ulSigmas(expected=True, ncpus=2)
+        finally:
+            runtime._pyhfThreads = False
+        self.assertEqual(ulsP, ulsT)
+        # The serial fits do not depend on the previous workspaces either
+        self.assertEqual(uls, ulsP)
+        self.assertEqual(ulcomputer.ulSigmas(expected=True, ncpus=1), uls)
+
 
 if __name__ == "__main__":
     unittest.main()
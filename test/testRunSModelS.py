@@ -39,6 +39,54 @@ class RunSModelSTest(unittest.TestCase):
                           (nout, nin))
         self.assertEqual(nout,nin)
 
+    def testScheduling(self):
+        from smodels.tools import modelTester
+        dirname = "./testFiles/slha/"
+        files = [os.path.join(dirname,f) for f in sorted(os.listdir(dirname))
+                 if f.endswith(".slha")]
+        sizes = [os.path.getsize(f) for f in modelTester._sortFiles(files,dirname)]
+        self.assertEqual(sizes,sorted(sizes,reverse=True))
+        #Past running times take precedence over file sizes
+        smallest = min(files,key=os.path.getsize)
+        past = dict([(os.path.basename(f),1.) for f in files])
+        past[os.path.basename(smallest)] = 100.
+        ordered = modelTester._sortFiles(files,dirname,past)
+        self.assertEqual(ordered[0],smallest)
+        self.assertEqual(sorted(ordered),sorted(files))
+        #Running times are stored and updated
+        runtimesFile = "./unitTestOutput/runtimes.json"
+        if os.path.exists(runtimesFile):
+            os.remove(runtimesFile)
+        modelTester._writeRuntimes(runtimesFile,{files[0] : 2.,files[1] : 3.},dirname)
+        modelTester._writeRuntimes(runtimesFile,{files[0] : 1.},dirname)
+        runtimes = modelTester._readRuntimes(runtimesFile)
+        self.assertEqual(runtimes,{os.path.basename(files[0]) : 1.,
+                                   os.path.basename(files[1]) : 3.})
+        #Files with the same name in different directories are kept apart
+        os.remove(runtimesFile)
+        sameName = {os.path.join(dirname,"a","x.slha") : 1.,
+                    os.path.join(dirname,"b","x.slha") : 2.}
+        modelTester._writeRuntimes(runtimesFile,sameName,dirname)
+        runtimes = modelTester._readRuntimes(runtimesFile)
+        self.assertEqual(runtimes,{os.path.join("a","x.slha") : 1.,
+                                   os.path.join("b","x.slha") : 2.})
+        os.remove(runtimesFile)
+        report = modelTester._runtimesReport({files[0] : 1., files[1] : 3.},
+                                              [files[1]], 2., 2)
+        self.assertTrue("2 files with 2 process(es)" in report)
+        self.assertTrue("100.0% of 2 processes busy" in report)
+        self.assertTrue(os.path.basename(files[1]) in report)
+
+    def testParallelPredictions(self):
+        filename = "./testFiles/slha/simplyGluino.slha"
+        outputfile = os.path.join("./unitTestOutput","simplyGluino.slha.py")
+        self.removeOutputs(outputfile)
+        outputfile = runMain(filename,inifile='testParameters_ncpusPredictions.ini')
+        self.assertTrue(os.path.exists(outputfile))
+        smodelsOutput = importModule(outputfile)
+        self.assertTrue(len(smodelsOutput['ExptRes']) > 0)
+        self.removeOutputs(outputfile)
+
     def testTimeout(self):
         try:
             filename = "./testFiles/slha/complicated.slha"
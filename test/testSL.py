@@ -11,8 +11,10 @@
 import sys
 sys.path.insert(0,"../")
 import unittest
-from smodels.tools.simplifiedLikelihoods import Data, UpperLimitComputer
+from smodels.tools.simplifiedLikelihoods import Data, UpperLimitComputer, LikelihoodComputer, \
+     StatisticalModel
 from numpy  import sqrt
+import numpy as np
 
 class SLTest(unittest.TestCase):
 
@@ -125,5 +127,160 @@ class SLTest(unittest.TestCase):
         self.assertAlmostEqual ( ul/(66.*sum(m.nsignal)), 1., 1 )
         self.assertAlmostEqual( ulProf/(63.*sum(m.nsignal)), 1.0, 1 )
 
+    def testThetaHatCache(self):
+        """ nuisance fits are cached and warm-started """
+        m = self.createModel ( 10 )
+        comp = LikelihoodComputer ( m )
+        nsig = m.signals ( 100. )
+        theta1,_ = comp.findThetaHat ( nsig )
+        theta2,_ = comp.findThetaHat ( m.signals ( 110. ) )
+        nll2 = comp.nll ( theta2 )
+        theta3,_ = comp.findThetaHat ( nsig )
+        self.assertTrue ( np.allclose ( theta1, theta3 ) )
+        self.assertEqual ( comp.nll ( theta3 ), comp.nll ( theta1 ) )
+        ## the warm-started fit finds the same minimum
+        fresh = LikelihoodComputer ( m )
+        theta4,_ = fresh.findThetaHat ( m.signals ( 110. ) )
+        self.assertAlmostEqual ( fresh.nll ( theta4 ) / nll2, 1., 5 )
+
+    def testNewtonThetaHat(self):
+        """ the nuisance fits converge with the Newton iterations """
+        m = self.createModel ( 10 )
+        stats = dict ( LikelihoodComputer.fitStatistics )
+        comp = LikelihoodComputer ( m )
+        nsig = m.signals ( 30. )
+        theta,err = comp.findThetaHat ( nsig )
+        self.assertEqual ( err, 0 )
+        self.assertEqual ( LikelihoodComputer.fitStatistics["fits"], stats["fits"]+1 )
+        self.assertEqual ( LikelihoodComputer.fitStatistics["converged"], stats["converged"]+1 )
+        self.assertTrue ( LikelihoodComputer.fitStatistics["iterations"] > stats["iterations"] )
+        ## the gradient vanishes at the minimum
+        self.assertTrue ( np.max ( np.abs ( comp.nllprime ( theta ) ) ) < 1e-6 )
+        ## and the minimum is at least as good as the one from scipy
+        from scipy import optimize
+        ret = optimize.fmin_ncg ( comp.nll, np.zeros(10), fprime=comp.nllprime,
+                                  fhess=comp.nllHess, disp=0 )
+        self.assertTrue ( comp.nll ( theta ) <= comp.nll ( ret ) + 1e-9 )
+
+    def testExpectedLimit(self):
+        """ the expected limit does not modify the model """
+        m = self.createModel ( 10 )
+        observed = np.copy ( m.observed )
+        ulComp = UpperLimitComputer(ntoys=2000, cl=.95 )
+        ulExp = ulComp.ulSigma ( m, expected=True )
+        self.assertTrue ( np.all ( m.observed == observed ) )
+        self.assertAlmostEqual ( ulExp/(79.66), 1.0, 2 )
+        ## the same limit, from a model with observed = backgrounds
+        mExp = self.createModel ( 10 )
+        mExp.observed = np.round ( mExp.backgrounds )
+        self.assertAlmostEqual ( ulComp.ulSigma ( mExp ) / ulExp, 1., 5 )
+
+    def testStatisticalModel(self):
+        """ limits, likelihood and chi2 of a signal from shared computers """
+        m = self.createModel ( 10 )
+        model = StatisticalModel ( m, ntoys=2000 )
+        ulComp = UpperLimitComputer(ntoys=2000, cl=.95 )
+        ul = model.upperLimit()
+        ulExp = model.upperLimit ( expected=True )
+        self.assertAlmostEqual ( ul / ulComp.ulSigma ( self.createModel ( 10 ) ), 1., 5 )
+        self.assertAlmostEqual ( ulExp/(79.66), 1.0, 2 )
+        self.assertTrue ( model.upperLimit() is ul )
+        self.assertTrue ( model.computer ( expected=True ).model is not m )
+        self.assertTrue ( model.computer() is model.computer() )
+        comp = LikelihoodComputer ( self.createModel ( 10 ) )
+        self.assertAlmostEqual ( model.likelihood() / comp.likelihood ( m.nsignal ), 1., 5 )
+        self.assertAlmostEqual ( model.chi2() / comp.chi2 ( m.nsignal ), 1., 5 )
+
+    def testBatchedLikelihoods(self):
+        """ likelihoods for several signal hypotheses at once """
+        for n in [ 3, 10 ]:
+            m = self.createModel ( n )
+            comp = LikelihoodComputer ( m )
+            mus = np.linspace ( 0., 500., 11 )
+            nlls = comp.likelihoods ( mus, nll=True )
+            chi2s = comp.chi2s ( mus )
+            for mu,nll,chi2 in zip ( mus, nlls, chi2s ):
+                single = LikelihoodComputer ( m )
+                self.assertAlmostEqual ( single.likelihood ( m.signals(mu), nll=True ), nll, 6 )
+                self.assertAlmostEqual ( single.chi2 ( m.signals(mu) ), chi2, 6 )
+            ## the same, with signal vectors
+            nsigs = [ m.signals(mu) for mu in mus ]
+            llhds = comp.likelihoods ( nsigs )
+            self.assertTrue ( np.allclose ( llhds, np.exp(-nlls) ) )
+        ## one signal region, marginalized analytically
+        m = Data ( 24, 37., 36., deltas_rel=.2 )
+        comp = LikelihoodComputer ( m )
+        nsigs = np.array ( [ 0., 1., 5.18888, 15.56664, 40. ] )
+        nlls = comp.likelihoods ( nsigs, marginalize=True, nll=True )
+        self.assertEqual ( nlls.shape, ( 5, ) )
+        for nsig,nll in zip ( nsigs, nlls ):
+            self.assertAlmostEqual ( comp.likelihood ( nsig, marginalize=True, nll=True ), nll, 8 )
+        self.assertAlmostEqual ( nlls[2], 5.309742772743358, 6 )
+        self.assertAlmostEqual ( comp.likelihood ( 15.56664, marginalize=True, nll=True ),
+                                 8.07349738206382, 6 )
+
+    def testPrecomputedNll(self):
+        """ the nll with the precomputed gaussian terms and factorials """
+        from scipy import stats
+        m = self.createModel ( 10 )
+        comp = LikelihoodComputer ( m )
+        comp.nsig = m.signals ( 50. )
+        theta = np.linspace ( -1., 1., 10 )
+        lmbda = comp.nsig + m.A + theta + m.C * theta**2 / m.B**2
+        nll = - stats.multivariate_normal.logpdf ( theta, mean=[0.]*10, cov=m.V ) \
+              - sum ( stats.poisson.logpmf ( m.observed, lmbda ) )
+        self.assertAlmostEqual ( comp.nll ( theta ) / nll, 1., 10 )
+        self.assertAlmostEqual ( comp.probMV ( False, theta ) / np.exp(-nll), 1., 8 )
+        terms = m.gaussianTerms()
+        self.assertTrue ( m.gaussianTerms()[1] is terms[1] )
+        self.assertAlmostEqual ( terms[2], np.linalg.slogdet ( m.V )[1], 8 )
+
+    def testSingularCovariance(self):
+        """ the gaussian terms of a covariance that is only positive
+            semi-definite, as happens with rounded published covariances """
+        from scipy import stats
+        C = [[ 4., 6. ], [ 6., 9. ]]
+        m = Data ( observed=[ 5, 8 ], backgrounds=[ 4., 7. ], covariance=C,
+                   nsignal=[ 1., 1. ], deltas_rel=0. )
+        comp = LikelihoodComputer ( m )
+        comp.nsig = m.signals ( 1. )
+        theta = np.array ( [ .2, .3 ] )
+        lmbda = comp.nsig + m.backgrounds + theta
+        nll = - stats.multivariate_normal.logpdf ( theta, mean=[0.,0.], cov=C,
+                                                   allow_singular=True ) \
+              - sum ( stats.poisson.logpmf ( m.observed, lmbda ) )
+        self.assertAlmostEqual ( comp.nll ( theta ) / nll, 1., 8 )
+        m = Data ( observed=[ 5, 8 ], backgrounds=[ 4., 7. ],
+                   covariance=[[ 1., 0. ], [ 0., -1. ]],
+                   nsignal=[ 1., 1. ], deltas_rel=0. )
+        self.assertRaises ( Exception, m.gaussianTerms )
+
+    def testMarginalizedToys(self):
+        """ vectorized marginalization, with a fixed bank of toys """
+        m = self.createModel ( 10 )
+        nsig = m.signals ( 300. )
+        comp = LikelihoodComputer ( m, ntoys=20000, toySeed=42 )
+        nll = comp.likelihood ( nsig, marginalize=True, nll=True )
+        ## the bank of toys is reused, so the result is reproducible
+        thetas = m.toyBank ( 20000, 42 )
+        self.assertTrue ( m.toyBank ( 20000, 42 ) is thetas )
+        self.assertEqual ( comp.likelihood ( nsig, marginalize=True, nll=True ), nll )
+        self.assertAlmostEqual ( comp.likelihood ( nsig, marginalize=True ),
+                                 np.exp(-nll), 12 )
+        ## compare with the mean over the toys computed toy by toy
+        gammaln = comp.gammaln
+        vals = []
+        for theta in thetas:
+            lmbda = nsig + m.A + theta + m.C*theta**2/m.B**2
+            lmbda[lmbda<=0.] = 1e-30
+            vals.append ( np.exp ( sum ( m.observed*np.log(lmbda) - lmbda - gammaln ) ) )
+        self.assertAlmostEqual ( nll/( -np.log ( np.mean ( vals ) ) ), 1., 6 )
+        ## and with another bank of toys
+        comp = LikelihoodComputer ( m, ntoys=20000, toySeed=7 )
+        nll2 = comp.likelihood ( nsig, marginalize=True, nll=True )
+        self.assertAlmostEqual ( nll2/nll, 1., 2 )
+        ## draws follow the covariance matrix
+        self.assertTrue ( np.allclose ( np.cov ( thetas.T ), m.V, rtol=.1, atol=.1*np.sqrt(np.outer(np.diag(m.V),np.diag(m.V))) ) )
+
 if __name__ == "__main__":
     unittest.main()
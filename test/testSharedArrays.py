@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: testSharedArrays
+   :synopsis: Tests moving the database arrays to shared memory.
+
+"""
+
+import sys,os
+sys.path.insert(0,"../")
+import unittest
+from smodels.experiment.databaseObj import Database
+from smodels.experiment import sharedArrays
+from smodels.experiment.txnameObj import Delaunay1D
+from smodels.theory import decomposer
+from smodels.theory.model import Model
+from smodels.theory.theoryPrediction import theoryPredictionsFor
+from smodels.share.models.mssm import BSMList
+from smodels.share.models.SMparticles import SMList
+from smodels.tools.physicsUnits import fb, GeV
+
+
+class SharedArraysTest(unittest.TestCase):
+
+    def getPredictions(self,expResults,smstoplist):
+        predictions = []
+        for expResult in expResults:
+            preds = theoryPredictionsFor(expResult, smstoplist, useBestDataset=False)
+            if not preds:
+                continue
+            for pred in preds:
+                predictions.append((pred.dataId(),pred.xsection.value.asNumber(fb),
+                                    pred.getUpperLimit().asNumber(fb)))
+        return predictions
+
+    def testSharedArrays(self):
+        #Use a separate database object, so the arrays of the
+        #database used by the other tests are not modified
+        database = Database("unittest", discard_zeroes = False)
+        expResults = database.getExpResults(analysisIDs=['CMS-SUS-13-012',
+                                                         'ATLAS-SUSY-2013-02'])
+        model = Model(BSMList,SMList)
+        model.updateParticles('../inputFiles/slha/gluino_squarks.slha')
+        smstoplist = decomposer.decompose(model, .1*fb, doCompress=True,
+                                          doInvisible=True, minmassgap=5.*GeV)
+        predictions = self.getPredictions(expResults,smstoplist)
+        self.assertTrue(len(predictions) > 0)
+
+        size = sharedArrays.shareArrays(expResults[:1])
+        self.assertTrue(size > 0)
+        filename = "./unitTestOutput/sharedArrays.bin"
+        size2 = sharedArrays.shareArrays(expResults,filename)
+        self.assertEqual(os.path.getsize(filename),size2)
+        #Arrays already shared are not moved again:
+        self.assertEqual(sharedArrays.shareArrays(expResults),0)
+
+        for txnameData in sharedArrays.getTxNameDatas(expResults):
+            self.assertEqual(txnameData.y_values.dtype,float)
+            for label,array in txnameData.getArrays().items():
+                self.assertFalse(array.flags.writeable)
+        sharedPredictions = self.getPredictions(expResults,smstoplist)
+        self.assertEqual(len(sharedPredictions),len(predictions))
+        for pred,sharedPred in zip(predictions,sharedPredictions):
+            self.assertEqual(pred[0],sharedPred[0])
+            for x,y in zip(pred[1:],sharedPred[1:]):
+                self.assertAlmostEqual(x,y,delta=1e-10*abs(x))
+        os.remove(filename)
+
+    def testReadOnlyTriangulation(self):
+        #Triangulations whose read-only properties do not return the shared
+        #arrays keep their own arrays
+        database = Database("unittest", discard_zeroes = False)
+        expResult = database.getExpResults(analysisIDs=['ATLAS-SUSY-2013-02'])[0]
+        txnameData = [txd for txd in sharedArrays.getTxNameDatas([expResult])
+                      if not isinstance(txd.tri,Delaunay1D)][0]
+        tri = txnameData.tri
+        transform = tri.transform
+
+        class Triangulation(type(tri)):
+            @property
+            def transform(self):
+                return transform
+
+        tri.__class__ = Triangulation
+        sharedArrays.shareArrays([expResult])
+        self.assertIs(tri.transform,transform)
+        self.assertFalse(tri.simplices.flags.writeable)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -83,6 +83,29 @@ class StatisticsTest(unittest.TestCase):
         rel = abs (chi2lim - chi2marg ) / chi2marg
         self.assertAlmostEqual ( rel, 0.04, 1 )
 
+    def testMumaxTable(self):
+        """ the maximum of the truncated Gaussian from the table, compared with
+        the exact solution """
+        from smodels.tools import statistics
+        from scipy import optimize
+        from scipy.special import erf
+        for ratio in [ 0.3, 0.8, 1.01, 1.3, 2.5 ]:
+            for eul in [ 0.1, 3., 500. ]:
+                ul = ratio * eul
+                denominator = np.sqrt(2.) * eul / 1.96
+                def root_func ( x ):
+                    return (erf((ul-x)/denominator)+erf(x/denominator)) / ( 1. + erf(x/denominator)) - .95
+                mumax = statistics._mumaxFromTable ( ul, eul, root_func )
+                xa, xb = ( 0., ul ) if ratio > 1. else ( -3.*eul, 0. )
+                exact = optimize.brentq ( root_func, xa, xb, xtol=1e-12*eul )
+                self.assertAlmostEqual ( mumax / eul, exact / eul, 6 )
+        ## outside of the range of the table, the exact solution is needed
+        self.assertIsNone ( statistics._mumaxFromTable ( 30., 1., lambda x: 0. ) )
+        ## and also if the accuracy check fails
+        self.assertIsNone ( statistics._mumaxFromTable ( 2., 1., lambda x: 1e-3 ) )
+        self.assertAlmostEqual ( likelihoodFromLimits ( 2., 1.5, 1. ), 0.586401, 5 )
+        self.assertAlmostEqual ( likelihoodFromLimits ( 1.2, 1.5, 1., underfluct="norm_neg" ), 0.293423, 5 )
+
     def testUpperLimit(self):
         m = Data( 100., 100., 0.001, None, 1.0,deltas_rel=0.)
         comp = UpperLimitComputer()
@@ -135,6 +158,27 @@ class StatisticsTest(unittest.TestCase):
         # print ( "dchi2,ichi2",dchi2,ichi2)
         self.assertAlmostEqual(ichi2, dchi2, places=2)
 
+    def testBatchedInterface(self):
+        """ likelihoods and chi2 values for several signal hypotheses
+        in DataSet and CombinedDataSet """
+        from smodels.experiment.datasetObj import CombinedDataSet
+        expRes = database.getExpResults(analysisIDs=['CMS-SUS-16-050-agg'])[0]
+        dataset = expRes.datasets[0]
+        nsigs = np.array ( [ 0., .5, 2., 10. ] )
+        llhds = dataset.likelihoods ( nsigs )
+        chi2s = dataset.chi2s ( nsigs )
+        for nsig,llhd,chi2 in zip ( nsigs, llhds, chi2s ):
+            self.assertAlmostEqual ( dataset.likelihood ( nsig ) / llhd, 1., 6 )
+            self.assertAlmostEqual ( dataset.chi2 ( nsig ), chi2, 6 )
+        combined = CombinedDataSet ( expRes )
+        n = len(expRes.datasets)
+        nsigs = [ [ x ] * n for x in [ 0., .1, .3 ] ]
+        llhds = combined.combinedLikelihoods ( nsigs )
+        chi2s = combined.totalChi2s ( nsigs )
+        for nsig,llhd,chi2 in zip ( nsigs, llhds, chi2s ):
+            self.assertAlmostEqual ( combined.combinedLikelihood ( nsig ) / llhd, 1., 6 )
+            self.assertAlmostEqual ( combined.totalChi2 ( nsig ), chi2, 5 )
+
     def round_to_sign(self, x, sig=3):
         """
         Round the given number to the significant number of digits.
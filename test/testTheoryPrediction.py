@@ -19,7 +19,7 @@ from smodels.theory import decomposer
 from smodels.share.models.mssm import BSMList
 from smodels.share.models.SMparticles import SMList
 from smodels.theory.model import Model
-from smodels.theory.theoryPrediction import theoryPredictionsFor
+from smodels.theory.theoryPrediction import theoryPredictionsFor, theoryPredictionsForList
 
 
 class IntegrationTest(unittest.TestCase):
@@ -73,6 +73,43 @@ class IntegrationTest(unittest.TestCase):
         for analysis in listofanalyses:
             self.checkAnalysis(analysis,smstoplist)
 
+    def testParallelPredictions(self):
+
+        slhafile = '../inputFiles/slha/gluino_squarks.slha'
+        model = Model(BSMList,SMList)
+        model.updateParticles(slhafile)
+        smstoplist = decomposer.decompose(model, .1*fb, doCompress=True,
+                doInvisible=True, minmassgap=5.*GeV)
+        expresults = [expRes for expRes in database.getExpResults()
+                      if not hasattr(expRes.globalInfo,'jsonFiles')]
+        serial = theoryPredictionsForList(expresults, smstoplist)
+        covered = [el.coveredBy.copy() for el in smstoplist.getElements()]
+        for el in smstoplist.getElements():
+            el.coveredBy = set()
+            el.testedBy = set()
+        parallel = theoryPredictionsForList(expresults, smstoplist, ncpus=2)
+
+        self.assertEqual(len(serial),len(expresults))
+        self.assertEqual(len(parallel),len(expresults))
+        self.assertTrue(any(serial))
+        for i,predList in enumerate(serial):
+            if not predList:
+                self.assertFalse(parallel[i])
+                continue
+            predsA = list(predList)
+            predsB = list(parallel[i])
+            self.assertEqual(len(predsA),len(predsB))
+            for predA,predB in zip(predsA,predsB):
+                #Predictions refer to the objects in the main process
+                self.assertTrue(predB.expResult is expresults[i])
+                self.assertEqual(predA.dataId(),predB.dataId())
+                self.assertTrue(all(txA is txB for txA,txB in zip(predA.txnames,predB.txnames)))
+                self.assertAlmostEqual(predA.xsection.value.asNumber(fb),
+                                       predB.xsection.value.asNumber(fb))
+                self.assertAlmostEqual(predA.upperLimit.asNumber(fb),
+                                       predB.upperLimit.asNumber(fb))
+        self.assertEqual(covered,[el.coveredBy for el in smstoplist.getElements()])
+
     def checkPrediction(self,slhafile,expID,expectedValues, datasetID):
 
         reducedModel = [ptc for ptc in BSMList if abs(ptc.pdg) in [1000011,1000012]]
@@ -107,6 +107,36 @@ class TopologyTest(unittest.TestCase):
         self.assertEqual(topL.describe() == "TopologyList:\n[2][2]\n[1,2][2]\n", True)        
         topL.addElement(el1B.copy())
         self.assertEqual(topL.getTotalWeight()[0].value == 34.*fb, True)
-        
+
+    def testSignatures(self):
+
+        self.assertEqual(el1.getSignature(),el1B.copy().getSignature())
+        self.assertEqual(el1.getSignature(),el1.switchBranches().getSignature())
+        self.assertNotEqual(el1.getSignature(),el2.getSignature())
+        self.assertEqual(Topology(el1.switchBranches()).getSignature(),
+                         Topology(el1).getSignature())
+
+        #Elements with distinct (but equal) particles have distinct signatures,
+        #but are still combined by the topology
+        b3 = Branch()
+        b3.evenParticles = [[b,t]]
+        b3.oddParticles = [st1.copy(),n1]
+        b3.setInfo()
+        el3 = Element()
+        el3.branches = [b1.copy(),b3]
+        el3.weight = w3.copy()
+        self.assertNotEqual(el3.getSignature(),el1.getSignature())
+        self.assertEqual(el3,el1)
+
+        topL = TopologyList()
+        topL.addElement(el1.copy())
+        topL.addElement(el1B.copy())
+        topL.addElement(el3)
+        topL.addElement(el2.copy())
+        self.assertEqual(len(topL),2)
+        self.assertEqual(len(topL.getElements()),2)
+        self.assertEqual(topL.getTotalWeight()[0].value == 36.*fb, True)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -7,7 +7,7 @@
 .. moduleauthor:: Wolfgang Waltenberger <wolfgang.waltenberger@gmail.com>
 
 """
-import sys
+import sys,copy
 sys.path.insert(0,"../")
 from smodels.share.models import mssm
 from smodels.theory.element import Element
@@ -112,6 +112,41 @@ class TxTest(unittest.TestCase):
         setattr(c1, 'totalwidth', 10**(-17)*GeV)
         self.assertAlmostEqual(tx.txnameData.getValueFor(el),0.49*0.21496,3)
 
+    def testElementMatches(self):
+
+        g = mssm.gluino
+        n1.mass = 100*GeV
+        g.mass = 1000*GeV
+        el = Element(info="[[[q,q]],[[q,q]]]", model=finalStates)
+        el.branches[0].oddParticles = [g,n1]
+        el.branches[1].oddParticles = [g,n1]
+
+        txA = database.getExpResults(analysisIDs=["ATLAS-SUSY-2016-08"],
+                    datasetIDs=[None], txnames=["T5Disp" ] )[0].datasets[0].txnameList[0]
+        txB = database.getExpResults(analysisIDs=["ATLAS-SUSY-2016-081"],
+                    datasetIDs=[None], txnames=["T5Disp" ] )[0].datasets[0].txnameList[0]
+        #Txnames differ by their intermediate states
+        self.assertNotEqual(txA.getMatchKey(),txB.getMatchKey())
+
+        newEl = txA.hasElementAs(el)
+        self.assertEqual(newEl,el)
+        self.assertFalse(newEl is el)
+        self.assertEqual(el._txnameMatches[txA.getMatchKey()],(0,1))
+        #The cached ordering is used for the second call
+        self.assertEqual(txA.hasElementAs(el),el)
+        self.assertEqual(len(el._txnameMatches),1)
+        self.assertEqual(txB.hasElementAs(el),el)
+        self.assertEqual(len(el._txnameMatches),2)
+        #Txnames of databases with other particle definitions do not share the cache
+        databaseParticles = txA.globalInfo._databaseParticles
+        try:
+            txA.globalInfo._databaseParticles = copy.copy(databaseParticles)
+            self.assertNotEqual(txA.getMatchKey(),list(el._txnameMatches.keys())[0])
+            self.assertEqual(txA.hasElementAs(el),el)
+            self.assertEqual(len(el._txnameMatches),3)
+        finally:
+            txA.globalInfo._databaseParticles = databaseParticles
+
     def testCoordinateTransf(self):
         """ test the transformation of data into coordinates, back into data """
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+.. module:: testULCache
+   :synopsis: Tests the persistent cache of the combined upper limits.
+
+"""
+
+import sys,os
+sys.path.insert(0,"../")
+import unittest
+import multiprocessing
+from smodels.tools import ulCache
+from smodels.tools.ulCache import UpperLimitCache
+from smodels.experiment.datasetObj import CombinedDataSet
+from databaseLoader import database
+
+filename = "./unitTestOutput/ulcache.sqlite"
+
+def _fillCache(i):
+    """ store a few entries (runs in a separate process) """
+    cache = UpperLimitCache(filename)
+    for j in range(20):
+        cache.set(cache.key("ana",["SR1"],False,[i,j]),float(i*j))
+    return len(cache)
+
+class ULCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def tearDown(self):
+        ulCache.setCache(None)
+        for f in [filename,filename+"-wal",filename+"-shm"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def testKeys(self):
+        cache = UpperLimitCache(filename, databaseVersion="1.0")
+        key = cache.key("ana",["SR1","SR2"],False,[1.23456,2.])
+        self.assertEqual(key,cache.key("ana",["SR1","SR2"],False,[1.234561,2.]))
+        self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],True,[1.23456,2.]))
+        self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],False,[1.2356,2.]))
+        self.assertNotEqual(key,cache.key("ana",["SR1","SR3"],False,[1.23456,2.]))
+        self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],False,[1.23456,2.],
+                                          deltas_rel=0.))
+        cache2 = UpperLimitCache(filename, databaseVersion="1.1")
+        self.assertNotEqual(key,cache2.key("ana",["SR1","SR2"],False,[1.23456,2.]))
+        cache2 = UpperLimitCache(filename, databaseVersion="1.0")
+        cache2.smodelsVersion = "0.0.0"
+        self.assertNotEqual(key,cache2.key("ana",["SR1","SR2"],False,[1.23456,2.]))
+        self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],False,[1.23456,2.],
+                                          pyhf=("0.6.3","numpy","1.21.0")))
+        #The runtime settings of the likelihoods are part of the key
+        from smodels.tools import runtime
+        drmax = runtime._drmax
+        try:
+            runtime._drmax = 2*drmax
+            self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],False,[1.23456,2.]))
+            runtime._drmax = drmax
+            runtime._cap_likelihoods = not runtime._cap_likelihoods
+            self.assertNotEqual(key,cache.key("ana",["SR1","SR2"],False,[1.23456,2.]))
+        finally:
+            runtime._drmax = drmax
+            runtime._cap_likelihoods = not runtime._cap_likelihoods
+        self.assertEqual(key,cache.key("ana",["SR1","SR2"],False,[1.23456,2.]))
+
+    def testStoreAndEvict(self):
+        cache = UpperLimitCache(filename, maxEntries=100)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a",1.5,"bestCB")
+        cache.set("b",None)
+        self.assertEqual(cache.get("a"),(1.5,"bestCB"))
+        self.assertEqual(cache.get("b"),(None,None))
+        #Entries are kept on disk
+        self.assertEqual(UpperLimitCache(filename).get("a"),(1.5,"bestCB"))
+        for i in range(200):
+            cache.set("key%d" %i,float(i))
+        self.assertTrue(len(cache) <= 100)
+        self.assertEqual(cache.get("key199"),(199.,None))
+        self.assertIsNone(cache.get("key0"))
+        cache.clear()
+        self.assertEqual(len(cache),0)
+
+    def testConcurrentProcesses(self):
+        UpperLimitCache(filename).clear()
+        with multiprocessing.Pool(processes=3) as pool:
+            pool.map(_fillCache,range(3))
+        cache = UpperLimitCache(filename)
+        self.assertEqual(len(cache),60)
+        self.assertEqual(cache.get(cache.key("ana",["SR1"],False,[2,3]))[0],6.)
+
+    def testCombinedUpperLimit(self):
+        expRes = database.getExpResults(analysisIDs=['CMS-SUS-16-050-agg'])[0]
+        nsig = [ .5 ] * len(expRes.datasets)
+        ul = CombinedDataSet(expRes).getCombinedUpperLimitFor(nsig)
+        cache = UpperLimitCache(filename, databaseVersion=database.databaseVersion)
+        ulCache.setCache(cache)
+        self.assertEqual(CombinedDataSet(expRes).getCombinedUpperLimitFor(nsig),ul)
+        self.assertEqual((cache.hits,cache.misses),(0,1))
+        self.assertEqual(CombinedDataSet(expRes).getCombinedUpperLimitFor(nsig),ul)
+        self.assertEqual((cache.hits,cache.misses),(1,1))
+        CombinedDataSet(expRes).getCombinedUpperLimitFor(nsig,expected=True)
+        self.assertEqual((cache.hits,cache.misses),(1,2))
+
+
+if __name__ == "__main__":
+    unittest.main()